@@ -0,0 +1,78 @@
+"""
+    Add the actuals and tabquery logs of finished test sets to the output zip files in the background.
+
+    Test sets hand their files to a ResultArchiver as soon as they finish, so compressing them overlaps with the test
+    sets that are still running. Each zip file is opened once and written by the archiver thread until it's closed,
+    instead of being reopened in append mode for every test set.
+"""
+
+import logging
+import os
+import queue
+import threading
+import zipfile
+from typing import Callable, Dict, List, Optional, Tuple
+
+
+def get_zip_compression(compression_level: Optional[int]) -> Tuple[int, Optional[int]]:
+    """Return the zipfile compression and compresslevel. Level 0 stores the files without compressing them and None
+    uses the default deflate level."""
+    if compression_level == 0:
+        return zipfile.ZIP_STORED, None
+    return zipfile.ZIP_DEFLATED, compression_level
+
+
+class ResultArchiver(object):
+    """Write files to zip archives on a background thread. Files and callbacks are processed in the order they are
+    added, so a callback can remove the files added before it."""
+
+    def __init__(self, compression_level: Optional[int] = None):
+        self.compression, self.compresslevel = get_zip_compression(compression_level)
+        self.archives: Dict[str, zipfile.ZipFile] = {}
+        self.work = queue.Queue()
+        self.thread = threading.Thread(target=self.process_work, name='tdvt-archiver', daemon=True)
+        self.thread.start()
+
+    def add_files(self, zip_path: str, files: List[Tuple[str, str]]):
+        """Add (file path, name in archive) pairs to the zip file."""
+        if files:
+            self.work.put((zip_path, files))
+
+    def call(self, callback: Callable[[], None]):
+        """Call callback on the archiver thread once the files added so far are written."""
+        self.work.put(callback)
+
+    def close(self):
+        """Wait for the pending files and close the zip files."""
+        self.work.put(None)
+        self.thread.join()
+        for zip_path, archive in self.archives.items():
+            try:
+                archive.close()
+            except (IOError, OSError, zipfile.BadZipFile) as e:
+                logging.error("Exception while closing {}: {}".format(zip_path, e))
+        self.archives = {}
+
+    def get_archive(self, zip_path: str) -> zipfile.ZipFile:
+        archive = self.archives.get(zip_path)
+        if archive is None:
+            mode = 'a' if os.path.isfile(zip_path) else 'w'
+            archive = zipfile.ZipFile(zip_path, mode, self.compression, compresslevel=self.compresslevel)
+            self.archives[zip_path] = archive
+        return archive
+
+    def process_work(self):
+        while True:
+            item = self.work.get()
+            if item is None:
+                return
+            try:
+                if callable(item):
+                    item()
+                else:
+                    zip_path, files = item
+                    archive = self.get_archive(zip_path)
+                    for src, arcname in files:
+                        archive.write(src, arcname)
+            except Exception as e:
+                logging.error("Exception while archiving test output: " + str(e))
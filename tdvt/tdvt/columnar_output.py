@@ -0,0 +1,150 @@
+"""
+    Typed, columnar copy of the test results for analysis across runs.
+
+    With --columnar-output each test set's csv rows are also written with typed columns, partitioned by suite and run
+    id. Parquet files are written to tdvt_results/suite_name=<suite>/run_id=<run id>/ when pyarrow is installed, which
+    most analysis tools read as one dataset. Otherwise the rows are added to the tdvt_results.sqlite database, which
+    has an index on suite and run id. Both are kept across runs.
+"""
+
+import logging
+import os
+import re
+import sqlite3
+import threading
+from typing import Any, Dict, List, Optional
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+from .resources import get_run_id
+
+COLUMNAR_FORMATS = ['auto', 'parquet', 'sqlite']
+PARQUET_DIR = 'tdvt_results'
+SQLITE_FILE = 'tdvt_results.sqlite'
+
+# Columns that aren't strings. Everything else, including the perflab columns that are always empty, is a string.
+COLUMN_TYPES = {
+    'Passed': bool,
+    'Closest Expected': int,
+    'Diff count': int,
+    'Query Time (ms)': float,
+    'Expected Query Time (ms)': float,
+    'Iteration': int,
+    'IterationComment1': bool,
+    'Result': float,
+}
+# Named so they don't clash with the Suite csv column, since SQLite column names aren't case sensitive.
+PARTITION_COLUMNS = ['suite_name', 'run_id']
+
+
+def convert_value(value: str, value_type) -> Any:
+    """Convert a csv value back to its type. Empty and 'None' values are null."""
+    if value_type is str:
+        return value
+    if value in ('', 'None'):
+        return None
+    try:
+        if value_type is bool:
+            return value == 'True'
+        return value_type(float(value)) if value_type is int else value_type(value)
+    except ValueError:
+        return None
+
+
+def get_typed_columns(csv_header: List[str], csv_rows: List[List[str]]) -> Dict[str, List[Any]]:
+    columns = {}
+    for i, name in enumerate(csv_header):
+        value_type = COLUMN_TYPES.get(name, str)
+        columns[name] = [convert_value(row[i], value_type) if i < len(row) else None for row in csv_rows]
+    return columns
+
+
+def get_partition_name(value: str) -> str:
+    return re.sub(r'[^\w.-]', '_', value) or '_'
+
+
+class ColumnarResultsWriter(object):
+    """Write the csv rows of each test set with typed columns. Called from the test runner threads."""
+
+    def __init__(self, output_dir: str, output_format: str = 'auto', run_id: Optional[str] = None):
+        if output_format == 'auto':
+            output_format = 'parquet' if pyarrow is not None else 'sqlite'
+        elif output_format == 'parquet' and pyarrow is None:
+            logging.warning("pyarrow is not installed, writing columnar results to SQLite instead of Parquet.")
+            output_format = 'sqlite'
+        self.output_dir = output_dir
+        self.output_format = output_format
+        self.run_id = run_id if run_id else get_run_id()
+        self.file_count = 0
+        self.lock = threading.Lock()
+
+    def add_test_set_results(self, suite: str, test_set_name: str, csv_header: List[str], csv_rows: List[List[str]]):
+        if not csv_rows:
+            return
+        columns = get_typed_columns(csv_header, csv_rows)
+        try:
+            if self.output_format == 'parquet':
+                self.write_parquet(suite, test_set_name, columns)
+            else:
+                self.write_sqlite(suite, 'perflab_results' if 'Result' in columns else 'results', columns,
+                                  len(csv_rows))
+        except Exception as e:
+            logging.error("Exception while writing columnar results: " + str(e))
+
+    def write_parquet(self, suite: str, test_set_name: str, columns: Dict[str, List[Any]]):
+        partition_dir = os.path.join(self.output_dir, PARQUET_DIR, 'suite_name=' + get_partition_name(suite),
+                                     'run_id=' + get_partition_name(self.run_id))
+        os.makedirs(partition_dir, exist_ok=True)
+        fields = []
+        for name in columns:
+            value_type = COLUMN_TYPES.get(name, str)
+            arrow_type = {bool: pyarrow.bool_(), int: pyarrow.int64(), float: pyarrow.float64()}.get(
+                value_type, pyarrow.string())
+            fields.append(pyarrow.field(name, arrow_type))
+        table = pyarrow.Table.from_pydict(columns, schema=pyarrow.schema(fields))
+        with self.lock:
+            self.file_count += 1
+            file_name = '{}-{}.parquet'.format(self.file_count, get_partition_name(test_set_name))
+        pyarrow.parquet.write_table(table, os.path.join(partition_dir, file_name))
+
+    def write_sqlite(self, suite: str, table_name: str, columns: Dict[str, List[Any]], row_count: int):
+        sql_types = {bool: 'INTEGER', int: 'INTEGER', float: 'REAL'}
+        with self.lock:
+            connection = sqlite3.connect(os.path.join(self.output_dir, SQLITE_FILE), timeout=60)
+            try:
+                with connection:
+                    connection.execute('CREATE TABLE IF NOT EXISTS "{}" (suite_name TEXT, run_id TEXT)'.format(table_name))
+                    connection.execute('CREATE INDEX IF NOT EXISTS "{0}_suite_name_run_id" ON "{0}" (suite_name, run_id)'.format(
+                        table_name))
+                    existing = set(row[1].lower() for row in connection.execute('PRAGMA table_info("{}")'.format(table_name)))
+                    # Optional columns like Expected SQL are added the first time a run has them.
+                    for name in columns:
+                        if name.lower() not in existing:
+                            connection.execute('ALTER TABLE "{}" ADD COLUMN "{}" {}'.format(
+                                table_name, name.replace('"', '""'), sql_types.get(COLUMN_TYPES.get(name), 'TEXT')))
+                    names = PARTITION_COLUMNS + list(columns)
+                    insert = 'INSERT INTO "{}" ({}) VALUES ({})'.format(
+                        table_name, ', '.join('"{}"'.format(n.replace('"', '""')) for n in names),
+                        ', '.join('?' * len(names)))
+                    values = [[suite, self.run_id] + [column[i] for column in columns.values()]
+                              for i in range(row_count)]
+                    connection.executemany(insert, values)
+            finally:
+                connection.close()
+
+
+_columnar_writer: Optional[ColumnarResultsWriter] = None
+_columnar_writer_lock = threading.Lock()
+
+
+def get_columnar_writer(output_dir: str, output_format: str) -> ColumnarResultsWriter:
+    """Return the writer of this run. Every test set of the run shares its run id."""
+    global _columnar_writer
+    with _columnar_writer_lock:
+        if _columnar_writer is None:
+            _columnar_writer = ColumnarResultsWriter(output_dir, output_format)
+        return _columnar_writer
@@ -1,18 +1,31 @@
 """
     Generate datasource specific logical query files based on a set of genericized input files.
+
+    With --generate-processes the files are written by a pool of processes when there are enough of them, one task per
+    input directory and logical config.
+
+    Regenerating with --generate is incremental. A manifest in the output directory records the hash of the input file
+    and of the logical config each generated file came from, and only the files whose input or config changed are
+    written again. Files of logical configs that no longer exist are removed.
 """
 
 import glob
+import hashlib
+import json
 import logging
+import multiprocessing
 import os
 import re
 import shutil
 
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from string import Template
-from typing import Dict, List, Tuple
+from typing import Dict, List, Optional, Tuple
 
 from .templates import template_attributes
 from ..constants import CALCS_FIELDS, STAPLES_FIELDS
+from ..process_pool import get_process_count
 
 
 def get_logical_config_templates(ds_registry):
@@ -128,43 +141,78 @@ def get_modified_line(line, attrs, fields, field_name_map):
     return new_line
 
 
+def is_bracketed_name(name) -> bool:
+    return len(name) >= 2 and name[0] == '[' and name[-1] == ']' and '[' not in name[1:-1] and ']' not in name[1:-1]
+
 
-def process_test_file(filename, ds_registry, output_dir, col_names: List[List[str]]):
-    logging.debug("Processing " + filename)
+def get_resolved_field_names(fields, field_name_map) -> Optional[Dict[str, str]]:
+    """Return what each field ends up as after the field replacements of get_modified_line, which run one after the
+    other so a field can be renamed to a field that is renamed again. None if the replacements can't be done in one
+    pass.
 
-    input_file = open(filename, 'r', encoding='utf-8')
+    When the fields and their new names are all a single [name], one occurrence can't overlap another or be created
+    by a replacement next to it, so replacing each field with where its chain of renames ends gives the same line."""
+    if not all(is_bracketed_name(f) and is_bracketed_name(field_name_map[f]) for f in fields):
+        return None
+    resolved = {}
+    for field in fields:
+        if field in resolved:
+            continue
+        name = field
+        for f in fields:
+            name = name.replace(f, field_name_map[f])
+        resolved[field] = name
+    return resolved
+
+
+class LogicalConfigRewriter(object):
+    """get_modified_line for one logical config, with the table names computed once and the fields replaced with one
+    regular expression."""
+
+    def __init__(self, attrs, fields, field_name_map):
+        self.fields = fields
+        self.field_name_map = field_name_map
+        self.calcs_table_name = get_customized_table_name(attrs, 'Calcs')
+        self.staples_table_name = get_customized_table_name(attrs, 'Staples')
+        self.field_regex = None
+        self.resolved_names = get_resolved_field_names(fields, field_name_map)
+        if self.resolved_names is not None:
+            renamed = [f for f, name in self.resolved_names.items() if f != name]
+            if renamed:
+                self.field_regex = re.compile('|'.join(re.escape(f) for f in sorted(renamed, key=len, reverse=True)))
+
+    def rename_field(self, match):
+        return self.resolved_names[match.group(0)]
+
+    def rewrite(self, line):
+        if 'test name' in line or 'query-function' in line or 'runquery-column' in line:
+            return line
+        if self.resolved_names is None:
+            for field in self.fields:
+                line = line.replace(field, self.field_name_map[field])
+        elif self.field_regex is not None:
+            line = self.field_regex.sub(self.rename_field, line)
+        return line.replace('$Calcs$', self.calcs_table_name).replace('$Staples$', self.staples_table_name)
+
+
+
+def get_test_name(filename):
     base_name = os.path.basename(filename)
-    logging.debug("base_name " + base_name)
     match = re.search('setup\.(.*)\.xml', base_name)
     if match:
-        test_name = match.group(1)
-    else:
-        test_name = os.path.splitext(base_name)[0]
-
-    logging.debug("Test " + test_name)
-
-    fields = []
-    for table in col_names:
-        fields += table
-
-    ds_file_map = {}
-    for ds in get_logical_config_templates(ds_registry):
-        setup_file = open(os.path.join(output_dir, 'setup.' + test_name + '.' + ds + '.xml'), 'w', encoding='utf-8')
-        field_name_map = get_field_name_map(fields, get_logical_config_template(ds_registry, ds))
-        ds_file_map[ds] = (setup_file, field_name_map)
+        return match.group(1)
+    return os.path.splitext(base_name)[0]
 
-    # Go through all the configurations in templates.py and generate logical configs for them.
-    for line in input_file:
-        for ds in ds_file_map:
-            new_line = get_modified_line(line, get_logical_config_template(ds_registry, ds), fields, ds_file_map[ds][1])
-            ds_file_map[ds][0].write(new_line)
 
-    for ds in ds_file_map:
-        ds_file_map[ds][0].close()
+def get_output_file_name(test_name, config_name):
+    return 'setup.' + test_name + '.' + config_name + '.xml'
 
-    input_file.close()
 
-    # Go through all the ini files and see if any of them define a logical config. Generate test files for those.
+def get_rewriters(ds_registry, fields: List[str]) -> Dict[str, LogicalConfigRewriter]:
+    rewriters = {}
+    for config_name, attrs in get_logical_config_templates(ds_registry).items():
+        rewriters[config_name] = LogicalConfigRewriter(attrs, fields, get_field_name_map(fields, attrs))
+    return rewriters
 
 
 def process_text(ds, text, attributes, fields, field_map):
@@ -219,11 +267,147 @@ def create_dir(new_dir):
         return
 
 
-def generate_logical_files(input_dir, output_dir, ds_registry, force=False):
+GENERATION_MANIFEST_FILE = 'generation_manifest.json'
+# Bump when a change to this module changes the generated files.
+GENERATION_VERSION = 1
+# Generation only starts more processes when each one gets at least this many files to write.
+GENERATE_MIN_FILES_PER_PROCESS = 200
+
+
+def get_file_hash(path) -> str:
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def get_config_hashes(ds_registry, fields: List[List[str]]) -> Dict[str, str]:
+    """Hash of each logical config's attributes, along with the fields and the generator version they apply to."""
+    hashes = {}
+    for config_name, attributes in get_logical_config_templates(ds_registry).items():
+        text = json.dumps([GENERATION_VERSION, fields, attributes], sort_keys=True, default=str)
+        hashes[config_name] = hashlib.sha256(text.encode('utf-8')).hexdigest()
+    return hashes
+
+
+def load_generation_manifest(path) -> Optional[Dict]:
+    """Return the generated files recorded in the manifest, or None if there isn't a usable one."""
+    try:
+        with open(path, 'r', encoding='utf-8') as manifest_file:
+            manifest = json.load(manifest_file)
+        if manifest.get('version') == GENERATION_VERSION:
+            return manifest['files']
+    except FileNotFoundError:
+        pass
+    except (IOError, ValueError, AttributeError, KeyError) as e:
+        logging.warning("Ignoring generated test manifest {}: {}".format(path, e))
+    return None
+
+
+def save_generation_manifest(path, files: Dict):
+    temp_path = path + '.tmp'
+    try:
+        with open(temp_path, 'w', encoding='utf-8') as manifest_file:
+            json.dump({'version': GENERATION_VERSION, 'files': files}, manifest_file, indent=1, sort_keys=True)
+        os.replace(temp_path, path)
+    except (IOError, OSError) as e:
+        logging.warning("Could not save generated test manifest {}: {}".format(path, e))
+
+
+def write_config_files(rewriter: LogicalConfigRewriter, config_name, input_paths: List[str], output_dir):
+    """Write the test file of one logical config for each input file. Runs in the generation pool."""
+    for input_path in input_paths:
+        output_path = os.path.join(output_dir, get_output_file_name(get_test_name(input_path), config_name))
+        with open(input_path, 'r', encoding='utf-8') as input_file, \
+                open(output_path, 'w', encoding='utf-8') as setup_file:
+            for line in input_file:
+                setup_file.write(rewriter.rewrite(line))
+
+
+class GenerationPool(object):
+    """Writes the generated test files, split into one task per input directory and logical config. Every task writes
+    its own files, so the output is the same however they are scheduled. None or 1 writes them on this process. With
+    more processes, or 0 for one per CPU, a process pool is started the first time there are enough files to keep more
+    than one process busy."""
+
+    def __init__(self, max_processes: Optional[int] = None):
+        self.max_processes = get_process_count(max_processes) if max_processes is not None else 1
+        self.executor = None
+
+    def run(self, tasks, file_count: int):
+        if self.executor is None and min(self.max_processes, file_count // GENERATE_MIN_FILES_PER_PROCESS) > 1:
+            logging.debug("Generating test files in {} processes.".format(self.max_processes))
+            self.executor = ProcessPoolExecutor(max_workers=self.max_processes,
+                                                mp_context=multiprocessing.get_context('spawn'))
+        if self.executor is not None:
+            try:
+                futures = [self.executor.submit(write_config_files, *task) for task in tasks]
+                for future in futures:
+                    future.result()
+                return
+            except BrokenProcessPool as e:
+                logging.warning("Generation process failed, generating on this process: " + str(e))
+                self.shutdown()
+        for task in tasks:
+            write_config_files(*task)
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+
+def generate_test_dir(input_dir, output_dir, ds_registry, fields: List[List[str]], config_hashes: Dict[str, str],
+                      manifest: Optional[Dict], pool: GenerationPool) -> Dict:
+    """Generate the test files of one input directory. Only the files whose input or logical config hash differs from
+    the manifest are written. Return the manifest entries of the output directory, keyed by output file name."""
+    if manifest is None:
+        # Without a manifest nothing is known about the files there, so start over.
+        clean_create_dir(output_dir)
+        manifest = {}
+    else:
+        create_dir(output_dir)
+
+    generated = {}
+    # The input files to write for each config, in the order os.walk finds them.
+    config_inputs: Dict[str, List[str]] = {}
+    for input_root, input_dirs, input_files in os.walk(input_dir):
+        for input_filename in input_files:
+            input_path = os.path.join(input_root, input_filename)
+            input_hash = get_file_hash(input_path)
+            test_name = get_test_name(input_path)
+            for config_name, config_hash in config_hashes.items():
+                output_name = get_output_file_name(test_name, config_name)
+                entry = {'input': input_hash, 'config': config_hash}
+                generated[output_name] = entry
+                if manifest.get(output_name) != entry or not os.path.isfile(os.path.join(output_dir, output_name)):
+                    config_inputs.setdefault(config_name, []).append(input_path)
+
+    written = sum(len(input_paths) for input_paths in config_inputs.values())
+    if written:
+        rewriters = get_rewriters(ds_registry, [f for table in fields for f in table])
+        tasks = [(rewriters[config_name], config_name, input_paths, output_dir)
+                 for config_name, input_paths in config_inputs.items()]
+        pool.run(tasks, written)
+
+    for output_name in manifest:
+        if output_name not in generated:
+            try:
+                os.remove(os.path.join(output_dir, output_name))
+            except FileNotFoundError:
+                pass
+    logging.debug("Wrote {} of {} test files to {}".format(written, len(generated), output_dir))
+    return generated
+
+
+def generate_logical_files(input_dir, output_dir, ds_registry, force=False, processes: Optional[int] = None):
     base_output_dir = output_dir
     create_dir(base_output_dir)
 
     fields = [CALCS_FIELDS, STAPLES_FIELDS]
+    manifest_path = os.path.join(base_output_dir, GENERATION_MANIFEST_FILE)
+    manifest = load_generation_manifest(manifest_path)
+    config_hashes = None
+    new_manifest = {}
+    pool = GenerationPool(processes)
 
     # Go through input and top level subdirs. Create those in the output and then process the files.
     for root, dirs, files in os.walk(input_dir):
@@ -234,7 +418,14 @@ def generate_logical_files(input_dir, output_dir, ds_registry, force=False):
             if not any_test_files or force:
                 print("Generating test files from: " + str(input_dir))
                 print("Writing test files to: " + str(output_dir))
-                clean_create_dir(output_dir)
-                for input_root, input_dirs, input_files in os.walk(input_dir):
-                    for input_filename in input_files:
-                        process_test_file(os.path.join(input_root, input_filename), ds_registry, output_dir, fields)
+                if config_hashes is None:
+                    config_hashes = get_config_hashes(ds_registry, fields)
+                dir_manifest = manifest.get(name) if manifest is not None and any_test_files else None
+                new_manifest[name] = generate_test_dir(input_dir, output_dir, ds_registry, fields, config_hashes,
+                                                       dir_manifest, pool)
+            elif manifest is not None and name in manifest:
+                new_manifest[name] = manifest[name]
+
+    pool.shutdown()
+    if config_hashes is not None:
+        save_generation_manifest(manifest_path, new_manifest)
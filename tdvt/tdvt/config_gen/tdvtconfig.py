@@ -35,6 +35,16 @@ class TdvtInvocation(object):
         self.generate_expected = False
         self.schema_name: Optional[str] = None
         self.loose_comparison = False
+        self.persistent_tabquery = False
+        self.shard_count = 1
+        self.stream_results = False
+        self.cache_expected = False
+        self.zip_compression_level: Optional[int] = None
+        self.columnar_output = ''
+        self.record_history = False
+        self.incremental = False
+        # Compare results in this many processes. 0 is one per CPU and None compares on the test set threads.
+        self.compare_processes: Optional[int] = None
 
         if from_args:
             self.init_from_args(from_args)
@@ -74,6 +84,24 @@ class TdvtInvocation(object):
             self.generate_expected = True
         if args.loose_comparison:
             self.loose_comparison = True
+        if args.persistent_tabquery:
+            self.persistent_tabquery = True
+        if args.shard_count:
+            self.shard_count = args.shard_count
+        if args.stream_results:
+            self.stream_results = True
+        if args.cache_expected:
+            self.cache_expected = True
+        if args.zip_compression_level is not None:
+            self.zip_compression_level = args.zip_compression_level
+        if args.columnar_output:
+            self.columnar_output = args.columnar_output
+        if args.record_history:
+            self.record_history = True
+        if args.incremental:
+            self.incremental = True
+        if args.compare_processes is not None:
+            self.compare_processes = args.compare_processes
 
 
     def init_from_json(self, json):
@@ -3,12 +3,55 @@
 
 """
 
-import glob
+import functools
 import re
-from typing import Optional
+from typing import Optional, Tuple
 
 from ..resources import *
 from ..tabquery_path import TabQueryPath
+from ..test_index import get_test_index
+
+# An inline flag group like (?i) applies to the whole regex, and older Pythons allow it anywhere with only a
+# DeprecationWarning. (?i:...) only applies to its own group.
+GLOBAL_FLAGS_PATTERN = re.compile(r'\(\?[aiLmsux]+\)')
+
+class ExclusionFilter(object):
+    """The test file exclusions of a test set, compiled into one alternation so a test path is searched once."""
+
+    def __init__(self, exclusions: Tuple[str, ...]):
+        regexes = []
+        for ex in exclusions:
+            try:
+                ex = ex.strip()
+                if not ex:
+                    continue
+                regexes.append(re.compile(ex))
+            except BaseException as e:
+                print ("Error compiling regular expression for test file exclusions: '" + str(ex) + "' exception: " +
+                       str(e))
+
+        # Patterns with groups keep their own regex, since they would renumber the groups of the patterns after them.
+        # So do patterns with inline flags, which would apply to all the other patterns.
+        def keep_separate(r):
+            return r.groups or GLOBAL_FLAGS_PATTERN.search(r.pattern)
+
+        combined = [r.pattern for r in regexes if not keep_separate(r)]
+        self.regexes = [r for r in regexes if keep_separate(r)]
+        if combined:
+            self.regexes.insert(0, re.compile('|'.join('(?:{})'.format(p) for p in combined)))
+
+    def search(self, test_path: str) -> bool:
+        for regex in self.regexes:
+            if regex.search(test_path):
+                return True
+        return False
+
+
+@functools.lru_cache(maxsize=None)
+def get_exclusion_filter(exclusions: Tuple[str, ...]) -> ExclusionFilter:
+    """Test sets with the same exclusions share the compiled filter."""
+    return ExclusionFilter(exclusions)
+
 
 class TestFile(object):
     """
@@ -97,7 +140,8 @@ class TestSet(object):
         added_test = len(tests_to_run)
         allowed_path = ''
 
-        #Check local dir first then the root package directory.
+        #Check local dir first then the root package directory. The directory listings come from the shared index.
+        test_index = get_test_index()
         checked_paths = []
         for test_dir in self.get_test_dirs():
             allowed_path = os.path.join(test_dir, self.test_pattern)
@@ -107,17 +151,13 @@ class TestSet(object):
                 tests_to_run.append(TestFile(test_dir, allowed_path))
             elif os.path.isdir(allowed_path):
                 logging.debug("Iterating directory " + allowed_path)
-                for f in os.listdir(allowed_path):
-                    full_filename = os.path.join(allowed_path, f)
-                    if os.path.isfile(full_filename):
-                        logging.debug("Adding file " + full_filename)
-                        tests_to_run.append(TestFile(test_dir, full_filename))
+                for full_filename in test_index.list_files(allowed_path):
+                    logging.debug("Adding file " + full_filename)
+                    tests_to_run.append(TestFile(test_dir, full_filename))
             else:
-                for f in glob.glob(allowed_path):
-                    full_filename = os.path.join(allowed_path, f)
-                    if os.path.isfile(full_filename):
-                        logging.debug("Adding globbed file " + full_filename)
-                        tests_to_run.append(TestFile(test_dir, full_filename))
+                for full_filename in test_index.glob(allowed_path):
+                    logging.debug("Adding globbed file " + full_filename)
+                    tests_to_run.append(TestFile(test_dir, full_filename))
             if tests_to_run:
                 break
 
@@ -126,24 +166,13 @@ class TestSet(object):
 
         logging.debug("Found " + str(len(tests_to_run)) + " tests to run before exclusions.")
 
-        regexes = []
-        for ex in exclude_tests:
-            try:
-                ex = ex.strip()
-                if not ex:
-                    continue
-                regex = re.compile(ex)
-                regexes.append(regex)
-            except BaseException as e:
-                print ("Error compiling regular expression for test file exclusions: '" + str(ex) + "' exception: " +
-                       str(e))
-
-        final_test_list = list(tests_to_run)
+        exclusion_filter = get_exclusion_filter(tuple(exclude_tests))
+        final_test_list = []
         for test in tests_to_run:
-            for regex in regexes:
-                if re.search(regex, test.test_path) and test in final_test_list:
-                    logging.debug("Removing test that matched: " + str(regex))
-                    final_test_list.remove(test)
+            if exclusion_filter.search(test.test_path):
+                logging.debug("Removing excluded test " + test.test_path)
+            else:
+                final_test_list.append(test)
 
         logging.debug("Found " + str(len(final_test_list)) + " tests to run after exclusions.")
         return sorted(final_test_list, key = lambda x: x.test_path)
@@ -0,0 +1,234 @@
+"""
+    Cache of parsed expected result files.
+
+    The same expected files are compared against the actual results of every datasource in a run, once for each
+    numbered expected variant. Parsed files are kept in memory, keyed by path, modification time and size, and the
+    least recently used files are dropped once the cached files hold more than max_values tuple values.
+
+    With --cache-expected the parsed files are also saved as JSON to tdvt_cache/expected_results, so later runs don't
+    parse the XML of expected files that haven't changed. JSON only holds data, so loading a cache file can't run
+    code.
+
+    Tests with several numbered expected files usually match the same one every time. ExpectedMatchIndex remembers
+    which one matched last for each datasource and test so it can be compared first.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from .resources import get_local_cache_dir
+from .test_results import ParsedTestCase, ResultTable, read_results_file
+
+EXPECTED_CACHE_DIR = 'expected_results'
+EXPECTED_CACHE_FORMAT_VERSION = 3
+EXPECTED_CACHE_MAX_VALUES = 2000000
+EXPECTED_MATCHES_FILE = 'expected_matches.json'
+
+
+def get_expected_cache_dir() -> str:
+    return os.path.join(get_local_cache_dir(), EXPECTED_CACHE_DIR)
+
+
+def get_file_key(path: str) -> Tuple[str, int, int]:
+    stat = os.stat(path)
+    return os.path.abspath(path), stat.st_mtime_ns, stat.st_size
+
+
+def get_cost(test_cases: List[ParsedTestCase]) -> int:
+    return sum(1 + (len(case.table.values) if case.table is not None else 0) for case in test_cases)
+
+
+def test_case_to_json(case: ParsedTestCase) -> list:
+    table = None
+    if case.table is not None:
+        digest = case.table.digest.hex() if case.table.digest is not None else None
+        table = [case.table.values, case.table.tuple_count, case.table.column_types, digest]
+    return [case.name, case.id, case.sql, case.query_time, case.error_message, case.error_type, case.tolerance, table]
+
+
+def test_case_from_json(saved: list) -> ParsedTestCase:
+    name, test_id, sql, query_time, error_message, error_type, tolerance, saved_table = saved
+    table = None
+    if saved_table is not None:
+        values, tuple_count, column_types, digest = saved_table
+        table = ResultTable(values, tuple_count, column_types)
+        table.digest = bytes.fromhex(digest) if digest is not None else None
+    return ParsedTestCase(name, test_id, sql, query_time, error_message, error_type, table, tolerance)
+
+
+class ExpectedResultsCache(object):
+    """Thread safe LRU cache of parsed expected files. Cached test cases are shared, callers must not modify them."""
+
+    def __init__(self, max_values: int = EXPECTED_CACHE_MAX_VALUES, cache_dir: Optional[str] = None):
+        self.max_values = max_values
+        self.cache_dir = cache_dir
+        self.entries: OrderedDict = OrderedDict()
+        self.total_cost = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, path: str, use_disk_cache: bool = False) -> List[ParsedTestCase]:
+        """Return the parsed test cases of the expected file. Raises ParseError like parsing the file would."""
+        key = get_file_key(path)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+
+        cache_dir = (self.cache_dir or get_expected_cache_dir()) if use_disk_cache else None
+        test_cases = self.load_from_disk(cache_dir, key) if cache_dir else None
+        if test_cases is None:
+            test_cases = read_results_file(path)
+            # Hash the values now so the digests are shared by every comparison and saved in the disk cache.
+            for case in test_cases:
+                if case.table is not None:
+                    case.table.get_digest()
+            if cache_dir:
+                self.save_to_disk(cache_dir, key, test_cases)
+        self.add(key, test_cases)
+        return test_cases
+
+    def add(self, key, test_cases: List[ParsedTestCase]):
+        cost = get_cost(test_cases)
+        if cost > self.max_values:
+            return
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = (test_cases, cost)
+            self.total_cost += cost
+            while self.total_cost > self.max_values:
+                _, (_, evicted_cost) = self.entries.popitem(last=False)
+                self.total_cost -= evicted_cost
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.total_cost = 0
+
+    @staticmethod
+    def get_disk_path(cache_dir: str, key) -> str:
+        return os.path.join(cache_dir, hashlib.sha1(key[0].encode('utf-8')).hexdigest() + '.json')
+
+    def load_from_disk(self, cache_dir: str, key) -> Optional[List[ParsedTestCase]]:
+        path = self.get_disk_path(cache_dir, key)
+        try:
+            with open(path, 'r', encoding='utf-8') as cache_file:
+                saved = json.load(cache_file)
+            if saved['version'] != EXPECTED_CACHE_FORMAT_VERSION or tuple(saved['key']) != key:
+                return None
+            return [test_case_from_json(case) for case in saved['test_cases']]
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logging.debug("Ignoring expected results cache file {}: {}".format(path, e))
+            return None
+
+    def save_to_disk(self, cache_dir: str, key, test_cases: List[ParsedTestCase]):
+        path = self.get_disk_path(cache_dir, key)
+        # Write to a temporary file first since other threads might be reading the same file.
+        temp_path = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            saved = {'version': EXPECTED_CACHE_FORMAT_VERSION, 'key': key,
+                     'test_cases': [test_case_to_json(case) for case in test_cases]}
+            with open(temp_path, 'w', encoding='utf-8') as cache_file:
+                json.dump(saved, cache_file, separators=(',', ':'))
+            os.replace(temp_path, path)
+        except (IOError, OSError, TypeError, ValueError) as e:
+            logging.warning("Could not save expected results cache file {}: {}".format(path, e))
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+
+
+class ExpectedMatchIndex(object):
+    """The expected file version that last matched, keyed by datasource and test file."""
+
+    def __init__(self, path: str = ''):
+        self.path = path
+        self.matches: Dict[str, int] = {}
+        self.changed = False
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def load(path: str = '') -> 'ExpectedMatchIndex':
+        if not path:
+            path = os.path.join(get_local_cache_dir(), EXPECTED_MATCHES_FILE)
+        index = ExpectedMatchIndex(path)
+        try:
+            with open(path, 'r', encoding='utf8') as matches_file:
+                index.matches = {k: int(v) for k, v in json.load(matches_file).items()}
+        except FileNotFoundError:
+            pass
+        except (IOError, ValueError, AttributeError) as e:
+            logging.warning("Ignoring expected matches file {}: {}".format(path, e))
+        return index
+
+    def save(self):
+        with self.lock:
+            if not self.changed:
+                return
+            matches = dict(self.matches)
+            self.changed = False
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, 'w', encoding='utf8') as matches_file:
+                json.dump(matches, matches_file, indent=1, sort_keys=True)
+        except IOError as e:
+            logging.warning("Could not save expected matches file {}: {}".format(self.path, e))
+
+    @staticmethod
+    def get_key(suite_name: str, test_file: str) -> str:
+        return suite_name + '|' + test_file
+
+    def get(self, suite_name: str, test_file: str) -> Optional[int]:
+        with self.lock:
+            return self.matches.get(self.get_key(suite_name, test_file))
+
+    def record(self, suite_name: str, test_file: str, version: int):
+        key = self.get_key(suite_name, test_file)
+        with self.lock:
+            if self.matches.get(key) != version:
+                self.matches[key] = version
+                self.changed = True
+
+    def order_expected_files(self, suite_name: str, test_file: str, expected_files: List[str]) -> List[Tuple[int, str]]:
+        """Return (version, path) for each expected file with the one that matched last time first."""
+        versions = list(enumerate(expected_files))
+        last_match = self.get(suite_name, test_file)
+        if last_match is not None and 0 < last_match < len(versions):
+            versions.insert(0, versions.pop(last_match))
+        return versions
+
+
+_expected_cache = ExpectedResultsCache()
+_expected_match_index: Optional[ExpectedMatchIndex] = None
+_expected_match_index_lock = threading.Lock()
+
+
+def get_expected_cache() -> ExpectedResultsCache:
+    return _expected_cache
+
+
+def get_expected_match_index() -> ExpectedMatchIndex:
+    """Return the match index of this process, loading it from tdvt_cache the first time."""
+    global _expected_match_index
+    with _expected_match_index_lock:
+        if _expected_match_index is None:
+            _expected_match_index = ExpectedMatchIndex.load()
+        return _expected_match_index
+
+
+def load_expected_results(path: str, use_disk_cache: bool = False) -> List[ParsedTestCase]:
+    return _expected_cache.get(path, use_disk_cache)
@@ -0,0 +1,157 @@
+"""
+    Reuse the results of tests whose inputs didn't change, with --incremental.
+
+    The result file of a test that passed is saved in tdvt_cache/incremental, keyed by a fingerprint of everything that
+    goes into running it: the test file, the tds file, the password file name, the -D overrides, the tabquerycli binary
+    and the files of any connector or plugin path passed with -D. A later run with the same fingerprint puts the saved
+    result file where tabquerycli would have written it instead of running the test. It's still compared to the
+    expected files, so changed expected files are picked up.
+"""
+
+import hashlib
+import logging
+import os
+import shutil
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from .resources import get_local_cache_dir
+from .tabquery import get_override_args, get_tabquery_exe
+
+INCREMENTAL_CACHE_DIR = 'incremental'
+INCREMENTAL_FORMAT_VERSION = 1
+
+_file_hashes: Dict[Tuple[str, int, int], str] = {}
+_file_hashes_lock = threading.Lock()
+
+
+def get_file_hash(path: str) -> str:
+    """sha256 of the file contents. Hashes are kept for the run, keyed by path, modification time and size, since
+    every test set hashes the same tabquerycli binary and plugins."""
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+    with _file_hashes_lock:
+        file_hash = _file_hashes.get(key)
+    if file_hash is None:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as hashed_file:
+            for block in iter(lambda: hashed_file.read(1024 * 1024), b''):
+                digest.update(block)
+        file_hash = digest.hexdigest()
+        with _file_hashes_lock:
+            _file_hashes[key] = file_hash
+    return file_hash
+
+
+def get_path_hash(path: str) -> str:
+    """Hash of a file, or of the names and contents of all the files in a directory."""
+    if os.path.isfile(path):
+        return get_file_hash(path)
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            file_path = os.path.join(root, name)
+            digest.update(os.path.relpath(file_path, path).replace('\\', '/').encode('utf-8') + b'\x00')
+            digest.update(get_file_hash(file_path).encode('ascii'))
+    return digest.hexdigest()
+
+
+def get_override_paths(d_override: str) -> Optional[List[str]]:
+    """The existing files and directories passed as -D override values, like -DConnectPluginsPath=..., split the way
+    tabquerycli gets them. None if an argument isn't a -D override or a value looks like a path that doesn't exist,
+    like a path with spaces, since the files it points at can't be fingerprinted."""
+    paths = []
+    for override in get_override_args(d_override):
+        if not override:
+            continue
+        if not override.startswith('-D'):
+            return None
+        value = override.split('=', 1)[1] if '=' in override else ''
+        if value and os.path.exists(value):
+            paths.append(value)
+        elif '/' in value or '\\' in value:
+            return None
+    return paths
+
+
+class IncrementalResultCache(object):
+    """Saved result files of passing tests, keyed by test fingerprint."""
+
+    def __init__(self, cache_dir: Optional[str] = None):
+        self.cache_dir = cache_dir if cache_dir else os.path.join(get_local_cache_dir(), INCREMENTAL_CACHE_DIR)
+
+    def get_environment_fingerprint(self, work) -> Optional[str]:
+        """Fingerprint of the inputs shared by all the tests of a test set. None if they can't all be fingerprinted."""
+        test_config = work.test_config
+        override_paths = get_override_paths(test_config.d_override)
+        if override_paths is None:
+            logging.info("Can't fingerprint the -D overrides [{}], running all the tests.".format(
+                test_config.d_override))
+            return None
+        digest = hashlib.sha256()
+
+        def add(name, value):
+            digest.update('{}={}\x00'.format(name, value).encode('utf-8'))
+
+        add('version', INCREMENTAL_FORMAT_VERSION)
+        add('logical', test_config.logical)
+        add('tds', get_file_hash(test_config.tds) if os.path.isfile(test_config.tds) else test_config.tds)
+        add('password_file', os.path.basename(work.test_set.get_password_file_name()))
+        add('d_override', test_config.d_override)
+        add('schema', test_config.schema_name)
+        tabquery = get_tabquery_exe(work)
+        add('tabquery', get_file_hash(tabquery) if tabquery and os.path.isfile(tabquery) else tabquery)
+        for path in override_paths:
+            add(path, get_path_hash(path))
+        return digest.hexdigest()
+
+    def get_test_fingerprint(self, environment_fingerprint: str, test_path: str) -> Optional[str]:
+        try:
+            digest = hashlib.sha256(environment_fingerprint.encode('ascii'))
+            digest.update(os.path.basename(test_path).encode('utf-8') + b'\x00')
+            digest.update(get_file_hash(test_path).encode('ascii'))
+            return digest.hexdigest()
+        except OSError as e:
+            logging.debug("Can't fingerprint test {}: {}".format(test_path, e))
+            return None
+
+    def get_cache_path(self, fingerprint: str) -> str:
+        return os.path.join(self.cache_dir, fingerprint[0:2], fingerprint + '.xml')
+
+    def restore(self, fingerprint: str, dst: str) -> bool:
+        """Copy the saved result file to dst. Return False if there isn't one."""
+        try:
+            shutil.copyfile(self.get_cache_path(fingerprint), dst)
+            return True
+        except FileNotFoundError:
+            return False
+        except (IOError, OSError) as e:
+            logging.warning("Could not reuse the result of an earlier run: " + str(e))
+            return False
+
+    def save(self, fingerprint: str, src: str):
+        path = self.get_cache_path(fingerprint)
+        temp_path = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            shutil.copyfile(src, temp_path)
+            os.replace(temp_path, path)
+        except (IOError, OSError) as e:
+            logging.warning("Could not save result file {} for incremental runs: {}".format(src, e))
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+
+
+_incremental_cache: Optional[IncrementalResultCache] = None
+_incremental_cache_lock = threading.Lock()
+
+
+def get_incremental_cache() -> IncrementalResultCache:
+    global _incremental_cache
+    with _incremental_cache_lock:
+        if _incremental_cache is None:
+            _incremental_cache = IncrementalResultCache()
+        return _incremental_cache
@@ -0,0 +1,52 @@
+"""
+    Process pool for comparing results with --compare-processes.
+
+    Parsing result files and diffing them against the expected files is Python code that holds the GIL, so with many
+    worker threads it runs on one core at a time. With --compare-processes the worker threads still run tabquerycli,
+    but hand the comparison of each test to a pool of processes and wait for the result. The output rows of each test
+    set are small next to the results they come from and are built on the test set thread.
+
+    The processes are started with spawn rather than fork since the worker threads are already running when the pool
+    is created. Spawned processes import the main module again, so the script that starts tdvt has to keep its
+    call to tdvt.main() behind an if __name__ == '__main__' guard, as tdvt_launcher.py does.
+"""
+
+import atexit
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+_compare_pool: Optional[ProcessPoolExecutor] = None
+_compare_pool_lock = threading.Lock()
+
+
+def get_process_count(processes: Optional[int]) -> int:
+    """0 or None means one process per CPU."""
+    return processes if processes and processes > 0 else (os.cpu_count() or 1)
+
+
+def get_compare_pool(processes: Optional[int] = None) -> ProcessPoolExecutor:
+    """Return the pool of this run, creating it on first use."""
+    global _compare_pool
+    with _compare_pool_lock:
+        if _compare_pool is None:
+            process_count = get_process_count(processes)
+            logging.info("Comparing results in {} processes.".format(process_count))
+            _compare_pool = ProcessPoolExecutor(max_workers=process_count,
+                                                mp_context=multiprocessing.get_context('spawn'))
+        return _compare_pool
+
+
+def shutdown_compare_pool():
+    global _compare_pool
+    with _compare_pool_lock:
+        pool = _compare_pool
+        _compare_pool = None
+    if pool is not None:
+        pool.shutdown()
+
+
+atexit.register(shutdown_compare_pool)
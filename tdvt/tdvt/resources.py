@@ -1,3 +1,4 @@
+import datetime
 from functools import reduce
 import hashlib
 import logging
@@ -35,6 +36,19 @@ def get_ini_path(base_ini_dir, base_ini_name):
 def get_local_test_dir():
     return os.path.join(os.getcwd(), "tests")
 
+def get_local_cache_dir():
+    """Directory for state TDVT keeps between runs, like test set timings."""
+    return os.path.join(os.getcwd(), "tdvt_cache")
+
+_run_id = None
+
+def get_run_id():
+    """Identifies the results of this run in the columnar output and the run history."""
+    global _run_id
+    if _run_id is None:
+        _run_id = datetime.datetime.now(datetime.timezone.utc).strftime('%Y%m%dT%H%M%SZ') + '-' + str(os.getpid())
+    return _run_id
+
 def get_extensions_dir():
     return os.path.join(os.getcwd(), "extensions")
 
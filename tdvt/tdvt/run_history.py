@@ -0,0 +1,200 @@
+"""
+    History of test results across runs.
+
+    Runs started with --record-history record each test case's result, diff count, matched expected file and query
+    time in tdvt_cache/run_history.sqlite. 'tdvt history' compares two runs with indexed queries and reports the new failures,
+    the fixed tests and the query time regressions between them.
+"""
+
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+from typing import List, Optional, Tuple
+from urllib.request import pathname2url
+
+from .columnar_output import COLUMN_TYPES, convert_value
+from .resources import get_local_cache_dir, get_run_id
+
+RUN_HISTORY_FILE = 'run_history.sqlite'
+
+# (history column, csv column, perflab csv column). Perflab rows don't have a test case name, so test cases are told
+# apart by their position in the test.
+HISTORY_COLUMNS = [
+    ('suite', 'Suite', 'TestGroup'),
+    ('test_set', 'Test Set', 'TestSubGroup'),
+    ('test_name', 'TestName', 'Test'),
+    ('test_case', 'Test Case', None),
+    ('passed', 'Passed', 'IterationComment1'),
+    ('diff_count', 'Diff count', None),
+    ('matched_expected', 'Closest Expected', None),
+    ('execution_time', 'Query Time (ms)', 'Result'),
+]
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS runs (run_id TEXT PRIMARY KEY, start_time REAL, command_line TEXT)',
+    'CREATE TABLE IF NOT EXISTS results (run_id TEXT, suite TEXT, test_set TEXT, test_name TEXT, test_case TEXT, '
+    'passed INTEGER, diff_count INTEGER, matched_expected INTEGER, execution_time REAL)',
+    'CREATE INDEX IF NOT EXISTS results_run_test ON results (run_id, suite, test_set, test_name, test_case)',
+]
+
+# The results of both runs for the tests that ran in both.
+COMPARE_RUNS = '''
+    SELECT new.suite, new.test_set, new.test_name, new.test_case, old.passed, new.passed, old.execution_time,
+        new.execution_time, new.diff_count, new.matched_expected
+    FROM results AS new JOIN results AS old
+        ON old.run_id = ? AND old.suite = new.suite AND old.test_set = new.test_set
+        AND old.test_name = new.test_name AND old.test_case = new.test_case
+    WHERE new.run_id = ? AND {}
+    ORDER BY new.suite, new.test_set, new.test_name, new.test_case
+'''
+
+
+def get_history_rows(run_id: str, csv_header: List[str], csv_rows: List[List[str]]) -> List[tuple]:
+    perf_run = 'Result' in csv_header and 'Passed' not in csv_header
+    indexes = []
+    for _, csv_column, perflab_column in HISTORY_COLUMNS:
+        name = perflab_column if perf_run else csv_column
+        indexes.append((csv_header.index(name), COLUMN_TYPES.get(name, str)) if name in csv_header else None)
+
+    rows = []
+    case_positions = {}
+    for row in csv_rows:
+        values = []
+        for index in indexes:
+            if index is None or index[0] >= len(row):
+                values.append(None)
+            else:
+                values.append(convert_value(row[index[0]], index[1]))
+        if indexes[3] is None:
+            key = tuple(values[0:3])
+            case_positions[key] = case_positions.get(key, -1) + 1
+            values[3] = str(case_positions[key])
+        rows.append(tuple([run_id] + values))
+    return rows
+
+
+class RunHistory(object):
+    """Thread safe writer and reader of the run history database."""
+
+    def __init__(self, path: str = '', run_id: Optional[str] = None, read_only: bool = False):
+        self.path = path if path else os.path.join(get_local_cache_dir(), RUN_HISTORY_FILE)
+        self.run_id = run_id if run_id else get_run_id()
+        self.run_recorded = False
+        # A read only history opens an existing database without creating or changing anything.
+        self.read_only = read_only
+        self.lock = threading.Lock()
+
+    def connect(self) -> sqlite3.Connection:
+        if self.read_only:
+            return sqlite3.connect('file:{}?mode=ro'.format(pathname2url(os.path.abspath(self.path))), timeout=60,
+                                   uri=True)
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        connection = sqlite3.connect(self.path, timeout=60)
+        with connection:
+            for statement in SCHEMA:
+                connection.execute(statement)
+        return connection
+
+    def add_test_set_results(self, csv_header: List[str], csv_rows: List[List[str]]):
+        """Record the csv rows of a test set. Called from the test runner threads."""
+        rows = get_history_rows(self.run_id, csv_header, csv_rows)
+        if not rows:
+            return
+        with self.lock:
+            try:
+                connection = self.connect()
+                try:
+                    with connection:
+                        if not self.run_recorded:
+                            connection.execute('INSERT OR IGNORE INTO runs VALUES (?, ?, ?)',
+                                               (self.run_id, time.time(), ' '.join(sys.argv)))
+                            self.run_recorded = True
+                        connection.executemany('INSERT INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+                finally:
+                    connection.close()
+            except sqlite3.Error as e:
+                logging.error("Could not save run history to {}: {}".format(self.path, e))
+
+    def get_runs(self) -> List[Tuple[str, float, str]]:
+        """All the runs, the latest first."""
+        connection = self.connect()
+        try:
+            return connection.execute('SELECT run_id, start_time, command_line FROM runs '
+                                      'ORDER BY start_time DESC, run_id DESC').fetchall()
+        finally:
+            connection.close()
+
+    def compare_runs(self, old_run: str, new_run: str, time_ratio: float = 1.5, min_time_difference: float = 10.0):
+        """Return the new failures, the fixed tests and the query time regressions of new_run compared to old_run."""
+        connection = self.connect()
+        try:
+            def query(condition, *parameters):
+                return connection.execute(COMPARE_RUNS.format(condition), (old_run, new_run) + parameters).fetchall()
+
+            new_failures = query('old.passed = 1 AND new.passed = 0')
+            fixed = query('old.passed = 0 AND new.passed = 1')
+            slower = query('new.execution_time > old.execution_time * ? AND '
+                           'new.execution_time - old.execution_time >= ?', time_ratio, min_time_difference)
+        finally:
+            connection.close()
+        return new_failures, fixed, slower
+
+
+_run_history: Optional[RunHistory] = None
+_run_history_lock = threading.Lock()
+
+
+def get_run_history() -> RunHistory:
+    global _run_history
+    with _run_history_lock:
+        if _run_history is None:
+            _run_history = RunHistory()
+        return _run_history
+
+
+def get_test_label(row) -> str:
+    suite, test_set, test_name, test_case = row[0:4]
+    return '{} {} {} [{}]'.format(suite, test_set, test_name, test_case)
+
+
+def print_run_history(old_run: Optional[str], new_run: Optional[str], list_runs: bool, time_ratio: float,
+                      min_time_difference: float, path: str = '') -> int:
+    history = RunHistory(path, read_only=True)
+    if not os.path.isfile(history.path):
+        print("There is no run history in {}. Use --record-history to record runs.".format(history.path))
+        return 1
+    runs = history.get_runs()
+    if list_runs:
+        for run_id, start_time, command_line in runs:
+            print('{}\t{}\t{}'.format(run_id, time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(start_time)),
+                                      command_line))
+        return 0
+
+    run_ids = [run[0] for run in runs]
+    if new_run is None:
+        # Compare the last run to old_run, or to the run before it by default.
+        if len(run_ids) < (1 if old_run else 2):
+            print("The run history in {} doesn't have enough runs to compare.".format(history.path))
+            return 1
+        new_run = run_ids[0]
+        old_run = old_run if old_run else run_ids[1]
+    for run_id in (old_run, new_run):
+        if run_id not in run_ids:
+            print("Run {} is not in the run history. Use --list to see the runs.".format(run_id))
+            return 1
+
+    new_failures, fixed, slower = history.compare_runs(old_run, new_run, time_ratio, min_time_difference)
+    print("Comparing run {} to run {}.\n".format(new_run, old_run))
+    print("{} new failure(s):".format(len(new_failures)))
+    for row in new_failures:
+        print("\t{} diff count: {} closest expected: {}".format(get_test_label(row), row[8], row[9]))
+    print("\n{} fixed test(s):".format(len(fixed)))
+    for row in fixed:
+        print("\t" + get_test_label(row))
+    print("\n{} query time regression(s):".format(len(slower)))
+    for row in slower:
+        print("\t{} {:.0f} ms -> {:.0f} ms".format(get_test_label(row), row[6], row[7]))
+    return 0
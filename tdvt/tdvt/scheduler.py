@@ -0,0 +1,256 @@
+"""
+    Decide the order test sets are handed to the worker threads.
+
+    Worker threads pull test sets from a shared queue, so the run finishes when the last long test set finishes.
+    Handing out the longest test sets first (longest processing time order) keeps a big set like logical.staples from
+    starting last and holding up the whole run on a single thread. Test set run times are taken from the previous runs.
+
+    TestSetScheduler is the queue. Besides the number of worker threads it limits how many test sets of one datasource
+    and of one tds run at the same time, and it lowers a datasource's limit when its test sets time out or lose their
+    connection, so one slow database doesn't get as many connections as the others. The shards of a test set split
+    with --shards are queued the same way and count towards the same limits.
+
+    SmokeTestGate holds back the test sets of a datasource until that datasource's smoke tests finish, so the other
+    datasources don't wait for the slowest smoke test before their test sets start.
+"""
+
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import Counter
+from typing import Dict, List, Optional
+
+from .resources import get_local_cache_dir
+
+TEST_SET_TIMINGS_FILE = 'test_set_timings.json'
+
+
+def get_test_set_key(suite_name: str, config_name: str) -> str:
+    return suite_name + '|' + config_name
+
+
+class TestSetTimings(object):
+    """Wall clock time of each test set from previous runs, keyed by suite and test set config name."""
+
+    def __init__(self, path: str = ''):
+        self.path = path
+        self.timings: Dict[str, float] = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def load(path: str = '') -> 'TestSetTimings':
+        if not path:
+            path = os.path.join(get_local_cache_dir(), TEST_SET_TIMINGS_FILE)
+        timings = TestSetTimings(path)
+        try:
+            with open(path, 'r', encoding='utf8') as timings_file:
+                timings.timings = {k: float(v) for k, v in json.load(timings_file).items()}
+        except FileNotFoundError:
+            pass
+        except (IOError, ValueError, AttributeError) as e:
+            logging.warning("Ignoring test set timings file {}: {}".format(path, e))
+        return timings
+
+    def save(self):
+        with self.lock:
+            timings = dict(self.timings)
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, 'w', encoding='utf8') as timings_file:
+                json.dump(timings, timings_file, indent=1, sort_keys=True)
+        except IOError as e:
+            logging.warning("Could not save test set timings file {}: {}".format(self.path, e))
+
+    def get(self, key: str):
+        with self.lock:
+            return self.timings.get(key)
+
+    def record(self, key: str, seconds: float):
+        with self.lock:
+            self.timings[key] = round(seconds, 3)
+
+
+def order_by_expected_runtime(runners: List, timings: TestSetTimings) -> List:
+    """Return the runners with the longest expected run time first. Test sets without history go first since they
+    could be long, otherwise the original order is kept."""
+    def sort_key(runner):
+        seconds = timings.get(runner.get_timing_key())
+        return (0, 0) if seconds is None else (1, -seconds)
+
+    return sorted(runners, key=sort_key)
+
+
+def record_runtimes(runners: List, timings: TestSetTimings):
+    for runner in runners:
+        if runner.run_time is None:
+            continue
+        if runner.test_set.test_is_enabled is False or runner.test_set.test_is_skipped:
+            continue
+        timings.record(runner.get_timing_key(), runner.run_time)
+
+
+# Process output that means the database is struggling rather than a test being wrong.
+CONNECTION_ERROR_PATTERN = re.compile(
+    r'test timed out|unable to connect|could not connect|too many connections|'
+    r'connection (was )?(refused|reset|closed|lost|timed out|failed)', re.IGNORECASE)
+CONNECTION_ERROR_COLUMNS = ['Error Msg', 'Error Type', 'ErrorString']
+
+
+def has_connection_errors(csv_header: List[str], csv_rows: List[List[str]]) -> bool:
+    """True if any test in the csv rows of a test set timed out or had a connection error."""
+    indexes = [csv_header.index(column) for column in CONNECTION_ERROR_COLUMNS if column in csv_header]
+    for row in csv_rows:
+        for i in indexes:
+            if i < len(row) and CONNECTION_ERROR_PATTERN.search(row[i]):
+                return True
+    return False
+
+
+class TestSetScheduler(object):
+    """Queue of test runners with the get/put/task_done/join methods of queue.Queue that the worker threads use.
+
+    get() hands out the first queued runner whose datasource and tds are below their limits and blocks while there is
+    none. A limit of 0 means no limit. When a runner of a datasource finishes with timeouts or connection errors, the
+    datasource's limit is halved, and it grows back by one for every runner that finishes without them."""
+
+    def __init__(self, datasource_limits: Optional[Dict[str, int]] = None, tds_limit: int = 0):
+        # Told about every finished runner before it's marked done, so it can queue more work. See SmokeTestGate.
+        self.gate = None
+        self.max_limits = {ds: limit for ds, limit in (datasource_limits or {}).items() if limit > 0}
+        self.limits = dict(self.max_limits)
+        self.tds_limit = tds_limit
+        self.pending = []
+        self.unfinished = 0
+        self.running_datasources = Counter()
+        self.running_tds = Counter()
+        self.condition = threading.Condition()
+
+    @staticmethod
+    def get_datasource(runner) -> str:
+        return runner.test_set.ds_name
+
+    @staticmethod
+    def get_tds(runner) -> str:
+        # Not test_config.tds, which a test set replaces with the full path of the tds file while it runs.
+        return runner.test_set.tds_name
+
+    @staticmethod
+    def get_finished_test_set(runner):
+        """The runner of the test set that finished with this work item, or None. A sharded test set finishes with
+        the last of its shards."""
+        get_finished = getattr(runner, 'get_finished_test_set', None)
+        return runner if get_finished is None else get_finished()
+
+    def can_start(self, runner) -> bool:
+        limit = self.limits.get(self.get_datasource(runner), 0)
+        if limit and self.running_datasources[self.get_datasource(runner)] >= limit:
+            return False
+        return not self.tds_limit or self.running_tds[self.get_tds(runner)] < self.tds_limit
+
+    def put(self, runner):
+        with self.condition:
+            self.pending.append(runner)
+            self.unfinished += 1
+            self.condition.notify_all()
+
+    def get(self):
+        with self.condition:
+            while True:
+                for i, runner in enumerate(self.pending):
+                    if self.can_start(runner):
+                        del self.pending[i]
+                        self.running_datasources[self.get_datasource(runner)] += 1
+                        self.running_tds[self.get_tds(runner)] += 1
+                        return runner
+                self.condition.wait()
+
+    def task_done(self, runner=None):
+        if runner is not None and self.gate is not None:
+            finished = self.get_finished_test_set(runner)
+            if finished is not None:
+                self.gate.test_set_done(finished, self)
+        with self.condition:
+            if runner is not None:
+                datasource = self.get_datasource(runner)
+                self.running_datasources[datasource] -= 1
+                self.running_tds[self.get_tds(runner)] -= 1
+                if getattr(runner, 'connection_errors', False):
+                    self.reduce_limit(datasource)
+                elif datasource in self.limits and self.limits[datasource] < self.max_limits.get(datasource, 0):
+                    self.limits[datasource] += 1
+            self.unfinished -= 1
+            self.condition.notify_all()
+
+    def reduce_limit(self, datasource: str):
+        # A datasource without a limit starts from the number of its test sets that were running.
+        current = self.limits.get(datasource) or self.running_datasources[datasource] + 1
+        self.limits[datasource] = max(1, current // 2)
+        self.max_limits.setdefault(datasource, current)
+        if self.limits[datasource] < current:
+            logging.warning("Timeouts or connection errors for {}, running at most {} of its test sets at a "
+                            "time.".format(datasource, self.limits[datasource]))
+
+    def join(self):
+        with self.condition:
+            while self.unfinished:
+                self.condition.wait()
+
+    def qsize(self) -> int:
+        with self.condition:
+            return len(self.pending)
+
+    def empty(self) -> bool:
+        return self.qsize() == 0
+
+
+class SmokeTestGate(object):
+    """Queue the test sets of each datasource once its smoke tests have finished.
+
+    If a smoke test of a datasource fails, its test sets are marked as skipped before they are queued, unless
+    force_run is set. Datasources without smoke tests aren't held back."""
+
+    def __init__(self, smoke_tests: List, held_work: List, force_run: bool = False):
+        self.smoke_tests = set(id(runner) for runner in smoke_tests)
+        self.remaining = Counter(runner.test_set.ds_name for runner in smoke_tests)
+        self.held: Dict[str, List] = {}
+        for runner in held_work:
+            self.held.setdefault(runner.test_set.ds_name, []).append(runner)
+        self.force_run = force_run
+        self.failing_ds = set()
+        self.smoke_test_end_time = None
+        self.lock = threading.Lock()
+
+    def get_ready_work(self) -> List:
+        """Return the test sets that don't wait for smoke tests."""
+        with self.lock:
+            ready = []
+            for ds_name in [ds for ds in self.held if not self.remaining[ds]]:
+                ready.extend(self.held.pop(ds_name))
+            return ready
+
+    def test_set_done(self, runner, scheduler: TestSetScheduler):
+        if id(runner) not in self.smoke_tests:
+            return
+        ds_name = runner.test_set.ds_name
+        with self.lock:
+            if runner.failed_tests:
+                self.failing_ds.add(ds_name)
+            self.remaining[ds_name] -= 1
+            if self.remaining[ds_name] > 0:
+                return
+            if not +self.remaining:
+                self.smoke_test_end_time = time.time()
+            work = self.held.pop(ds_name, [])
+            skip = ds_name in self.failing_ds and not self.force_run
+        if skip:
+            print("Smoke tests failed for {}, its tests will not be run.".format(ds_name))
+        elif work:
+            logging.info("Smoke tests passed for {}, queueing its {} test sets.".format(ds_name, len(work)))
+        # The work is queued before the smoke test is marked done, so the scheduler doesn't run out of work early.
+        for item in work:
+            if skip:
+                item.test_set.test_is_skipped = True
+            scheduler.put(item)
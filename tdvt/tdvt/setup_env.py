@@ -286,8 +286,7 @@ def updated_tds_as_str(f, connection_name) -> str:
         new_tds += new_line + '\n'
     return new_tds
 
-def get_failed_cmd_line(cls, index):
-    res_info = cls.combined_output[index]
+def get_failed_cmd_line_for_row(res_info):
     ds = res_info.get('Suite')
     tds_name = res_info.get('TDSName')
     ab_path = res_info.get('TestPath')
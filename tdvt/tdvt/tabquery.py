@@ -55,6 +55,17 @@ def get_max_process_level_of_parallelization(desired_threads):
     return desired_threads
 
 
+def get_tabquery_exe(work):
+    """The tabquerycli binary that runs the tests of work."""
+    if work.test_config.tested_run_time_config is not None and work.test_config.tested_run_time_config.has_customized_tabquery_path():
+        return work.test_config.tested_run_time_config.tabquery_paths.get_path(sys.platform)
+    return tab_cli_exe
+
+
+def get_override_args(d_override):
+    """The -D override string split into the arguments passed to tabquerycli."""
+    return d_override.split(' ') if d_override else []
+
 def build_tabquery_command_line(work):
     tb = TabqueryCommandLine()
 
@@ -76,12 +87,9 @@ class TabqueryCommandLine(object):
 
     def build_tabquery_command_line(self, work):
         """Build the command line string for calling tabquerycli."""
-        global tab_cli_exe
         cli_arg = "--query-file-list" if work.test_config.logical else "--expression-file-list"
 
-        cmdline = [tab_cli_exe]
-        if work.test_config.tested_run_time_config is not None and work.test_config.tested_run_time_config.has_customized_tabquery_path():
-            cmdline = [work.test_config.tested_run_time_config.tabquery_paths.get_path(sys.platform)]
+        cmdline = [get_tabquery_exe(work)]
 
         cmdline_base = [cli_arg, work.test_list_path]
         cmdline.extend(cmdline_base)
@@ -104,9 +112,7 @@ class TabqueryCommandLine(object):
         cmdline.extend(["-DLogDir=" + work.test_config.log_dir])
         cmdline.extend(["-DOverride=ProtocolServerNewLog"])
 
-        if work.test_config.d_override:
-            for override in work.test_config.d_override.split(' '):
-                cmdline.extend([override])
+        cmdline.extend(get_override_args(work.test_config.d_override))
 
         logical_rewrite_iter = next((i for i in cmdline if i.find('-DLogicalQueryRewriteDisable') != -1), None)
         if logical_rewrite_iter == None:
@@ -0,0 +1,205 @@
+"""
+    Long lived tabquerycli worker processes.
+
+    Starting tabquerycli pays for the Tableau engine startup, driver load and connection handshake every time. In
+    worker mode tabquerycli is started with the --worker argument and then receives test batches over stdin. The
+    workers are kept in a pool per executable. Each batch checks out an idle worker, or starts one if there is none,
+    and checks it back in when it's done, so there are never more workers than batches running at the same time
+    whichever threads run them. The protocol is line based JSON:
+
+        worker -> tdvt  {"ready": true, "protocol": 1}           Sent once after startup.
+        tdvt -> worker  {"args": ["--expression-file-list", ...]} The command line for one batch, without the exe.
+        worker -> tdvt  {"returncode": 0, "output": "..."}        Sent when the batch is finished.
+
+    Executables that do not answer the handshake are remembered and run the old way, one process per batch.
+"""
+
+import atexit
+import json
+import logging
+import queue
+import subprocess
+import threading
+import time
+from typing import Dict, List, Optional
+
+WORKER_MODE_ARG = '--worker'
+WORKER_PROTOCOL_VERSION = 1
+WORKER_STARTUP_TIMEOUT_SECONDS = 60
+
+_idle_workers: Dict[str, List['TabqueryWorker']] = {}
+_all_workers: List['TabqueryWorker'] = []
+_unsupported_executables = set()
+_registry_lock = threading.Lock()
+
+
+class TabqueryWorkerError(RuntimeError):
+    """The worker process stopped responding."""
+    pass
+
+
+class TabqueryWorkerUnsupported(TabqueryWorkerError):
+    """The executable doesn't implement worker mode."""
+    pass
+
+
+class TabqueryWorker(object):
+    """A warm tabquerycli process that runs test batches sent over a pipe."""
+
+    def __init__(self, base_cmdline: List[str]):
+        self.base_cmdline = base_cmdline
+        self.process: Optional[subprocess.Popen] = None
+        self.lines: queue.Queue = queue.Queue()
+        self.reader: Optional[threading.Thread] = None
+
+    def is_running(self) -> bool:
+        return self.process is not None and self.process.poll() is None
+
+    def start(self, timeout_seconds: float = WORKER_STARTUP_TIMEOUT_SECONDS):
+        """Start the process and wait for the handshake. Raise TabqueryWorkerUnsupported if there is no handshake."""
+        cmdline = self.base_cmdline + [WORKER_MODE_ARG]
+        logging.debug("Starting tabquery worker: " + ' '.join(cmdline))
+        try:
+            self.process = subprocess.Popen(cmdline, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                            stderr=subprocess.STDOUT, universal_newlines=True, encoding='utf8')
+        except OSError as e:
+            raise TabqueryWorkerUnsupported("Could not start tabquery worker: " + str(e))
+
+        self.lines = queue.Queue()
+        self.reader = threading.Thread(target=self._read_lines, args=(self.process.stdout, self.lines))
+        self.reader.daemon = True
+        self.reader.start()
+
+        try:
+            message = self._next_message(time.monotonic() + timeout_seconds)
+        except queue.Empty:
+            message = None
+        if not message or not message.get('ready') or message.get('protocol') != WORKER_PROTOCOL_VERSION:
+            self.stop()
+            raise TabqueryWorkerUnsupported("Tabquery does not support worker mode: " + ' '.join(cmdline))
+
+        with _registry_lock:
+            if self not in _all_workers:
+                _all_workers.append(self)
+
+    @staticmethod
+    def _read_lines(stream, lines: queue.Queue):
+        for line in stream:
+            lines.put(line)
+        lines.put(None)
+
+    def _next_message(self, deadline: Optional[float]) -> Optional[Dict]:
+        """Return the next JSON message from the worker, or None if it exited. Raises queue.Empty once the
+        time.monotonic() deadline passes, however much logging the worker writes before it."""
+        while True:
+            if deadline is None:
+                line = self.lines.get()
+            else:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise queue.Empty()
+                line = self.lines.get(timeout=remaining)
+            if line is None:
+                return None
+            try:
+                return json.loads(line)
+            except ValueError:
+                # Anything that isn't a protocol message is regular tabquery logging.
+                logging.debug("Tabquery worker: " + line.rstrip())
+
+    def run_batch(self, args: List[str], timeout_seconds: Optional[float] = None) -> str:
+        """Run one batch and return its output. Raises the same exceptions as subprocess.check_output."""
+        cmdline = self.base_cmdline + args
+        if not self.is_running():
+            self.start()
+
+        # The timeout covers the whole batch like it does for check_output, not each line the worker writes.
+        deadline = None if timeout_seconds is None else time.monotonic() + timeout_seconds
+
+        try:
+            self.process.stdin.write(json.dumps({'args': args}) + '\n')
+            self.process.stdin.flush()
+        except OSError as e:
+            self.stop()
+            raise TabqueryWorkerError("Lost connection to tabquery worker: " + str(e))
+
+        try:
+            message = self._next_message(deadline)
+        except queue.Empty:
+            self.stop(kill=True)
+            raise subprocess.TimeoutExpired(cmdline, timeout_seconds)
+
+        if message is None:
+            returncode = self.process.wait()
+            self.stop()
+            raise subprocess.CalledProcessError(returncode, cmdline, "Tabquery worker exited unexpectedly.")
+
+        output = message.get('output', '')
+        returncode = message.get('returncode', 0)
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, cmdline, output)
+        return output
+
+    def stop(self, kill: bool = False):
+        if self.process is None:
+            return
+        try:
+            if kill:
+                self.process.kill()
+            if self.process.poll() is None:
+                self.process.stdin.close()
+                self.process.wait(timeout=5)
+        except (OSError, subprocess.TimeoutExpired):
+            self.process.kill()
+            self.process.wait()
+        self.process = None
+
+
+def check_out_worker(exe: str) -> TabqueryWorker:
+    """Return an idle worker for the executable, or a new one. Hand it back with check_in_worker."""
+    with _registry_lock:
+        idle = _idle_workers.get(exe)
+        if idle:
+            return idle.pop()
+    return TabqueryWorker([exe])
+
+
+def check_in_worker(worker: TabqueryWorker):
+    with _registry_lock:
+        _idle_workers.setdefault(worker.base_cmdline[0], []).append(worker)
+
+
+def run_tabquery_batch(cmdline: List[str], timeout_seconds: Optional[float]) -> str:
+    """Run a tabquery command line on a warm worker. Fall back to a new process per batch when the executable doesn't
+    support worker mode."""
+    exe = cmdline[0]
+    with _registry_lock:
+        supported = exe not in _unsupported_executables
+    if supported:
+        worker = check_out_worker(exe)
+        try:
+            return worker.run_batch(cmdline[1:], timeout_seconds)
+        except TabqueryWorkerUnsupported as e:
+            worker = None
+            logging.warning(str(e) + " Falling back to one process per test set.")
+            with _registry_lock:
+                _unsupported_executables.add(exe)
+        finally:
+            # A worker that failed a batch is still usable, run_batch restarts it if it stopped.
+            if worker is not None:
+                check_in_worker(worker)
+
+    return str(subprocess.check_output(cmdline, stderr=subprocess.STDOUT, universal_newlines=True,
+                                       timeout=timeout_seconds))
+
+
+def shutdown_tabquery_workers():
+    with _registry_lock:
+        workers = list(_all_workers)
+        _all_workers.clear()
+        _idle_workers.clear()
+    for worker in workers:
+        worker.stop()
+
+
+atexit.register(shutdown_tabquery_workers)
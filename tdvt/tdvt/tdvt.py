@@ -10,25 +10,37 @@ if sys.version_info[0] < 3:
     raise EnvironmentError("TDVT requires Python 3 or greater.")
 
 import argparse
+import contextlib
 import csv
 import glob
+import heapq
+import itertools
 import json
 import pathlib
 import os
-import queue
 import shutil
 import threading
 import time
-import zipfile
 from pathlib import Path
-from typing import List, Optional, Tuple, Union
+from typing import Dict, List, Optional, Tuple, Union
 
+from .archiver import ResultArchiver
+from .columnar_output import COLUMNAR_FORMATS, get_columnar_writer
 from .config_gen.datasource_list import TestRegistry, print_ds, print_configurations, print_logical_configurations
 from .config_gen.tdvtconfig import TdvtInvocation
 from .config_gen.test_config import TestSet, SingleLogicalTestSet, SingleExpressionTestSet, FileTestSet, TestConfig, RunTimeTestConfig
-from .setup_env import create_test_environment, add_datasource, get_failed_cmd_line
+from .setup_env import create_test_environment, add_datasource, get_failed_cmd_line_for_row
 from .tabquery import *
-from .tdvt_core import generate_files, run_diff, run_tests, run_connectors_test_core, return_csv_dialect
+from .process_pool import shutdown_compare_pool
+from .tabquery_worker import shutdown_tabquery_workers
+from .test_index import get_test_index
+from .expected_cache import get_expected_match_index
+from .run_history import get_run_history, print_run_history
+from .scheduler import SmokeTestGate, TestSetScheduler, TestSetTimings, get_test_set_key, has_connection_errors, \
+    order_by_expected_runtime, record_runtimes
+from .tdvt_core import generate_files, run_diff, run_tests, run_connectors_test_core, return_csv_dialect, \
+    get_functions_count, get_test_shards, merge_shard_results, process_run_results, run_test_shard, set_tds_full_path, \
+    SHARD_DIR_PREFIX
 from .version import __version__
 
 # This contains the dictionary of configs you can run.
@@ -44,62 +56,196 @@ class TestOutputFiles(object):
     output_csv = "test_results_combined.csv"
     output_json = "tdvt_output_combined.json"
     all_output_files = [output_actuals, output_csv, output_json, output_tabquery_log]
-    combined_output = []
+    json_result_lists = ['failed_tests', 'successful_tests', 'skipped_tests', 'disabled_tests']
+    # The test runner threads publish their results here. They are keyed by the position of the test set in the run so
+    # the combined files don't depend on the order the test sets finish in.
+    results_lock = threading.Lock()
+    json_parts: Dict[int, str] = {}
+    # (csv header, sorted rows or the path of a csv file with them, csv dialect)
+    csv_parts: Dict[int, Tuple[List[str], Union[List[List[str]], str], str]] = {}
+    # Rows past this many are written to csv files in csv_parts_dir until the combined csv is written.
+    csv_max_rows_in_memory = 200000
+    csv_rows_in_memory = 0
+    csv_parts_dir = None
+    # The combined csv written by this run. It's merged with the new test sets when it is written again.
+    written_csv = None
 
     @classmethod
-    def copy_output_file(cls, src_name, src_dir, csv_dialect):
-        src = os.path.join(src_dir, src_name)
-        logging.debug("Copying {0} to output".format(src))
-        try:
-            with open(src, 'r', encoding='utf8') as src_file:
-                reader = csv.DictReader(src_file, dialect=csv_dialect)
-                for row in reader:
-                    cls.combined_output.append(row)
+    def reset(cls):
+        """Forget the results of an earlier run in this process."""
+        with cls.results_lock:
+            cls.json_parts = {}
+            cls.csv_parts = {}
+            cls.csv_rows_in_memory = 0
+            if cls.csv_parts_dir is not None:
+                shutil.rmtree(cls.csv_parts_dir, ignore_errors=True)
+                cls.csv_parts_dir = None
+            cls.written_csv = None
+
+    @classmethod
+    def get_output_path(cls, file_name: str, custom_output_dir: str = '') -> str:
+        if custom_output_dir:
+            return os.path.join(custom_output_dir, file_name)
+        return os.path.join(os.getcwd(), file_name)
 
+    @classmethod
+    def add_test_set_results(cls, index: int, csv_dialect: str, json_results: str, csv_header: List[str],
+                             csv_rows: List[List[str]]):
+        """Keep the results of a test set until the combined files are written. Called from the test runner threads."""
+        if 'Functions' in csv_header:
+            # The combined csv merges the rows of the test sets sorted on the number of functions. Sorting each test
+            # set's rows the same stable way gives the order a sort of all the rows would.
+            functions_index = csv_header.index('Functions')
+            csv_rows = sorted(csv_rows, key=lambda row: get_functions_count(row[functions_index]))
+        with cls.results_lock:
+            cls.json_parts[index] = json_results
+            if cls.csv_rows_in_memory + len(csv_rows) <= cls.csv_max_rows_in_memory:
+                cls.csv_rows_in_memory += len(csv_rows)
+                cls.csv_parts[index] = (csv_header, csv_rows, csv_dialect)
+                return
+            if cls.csv_parts_dir is None:
+                cls.csv_parts_dir = make_temp_dir(['csv_parts'])
+            dst = os.path.join(cls.csv_parts_dir, '{}_test_results.csv'.format(index))
+
+        try:
+            with open(dst, 'w', encoding='utf8') as dst_file:
+                writer = csv.writer(dst_file, dialect=csv_dialect, quoting=csv.QUOTE_MINIMAL)
+                writer.writerow(csv_header)
+                writer.writerows(csv_rows)
         except IOError as e:
-            logging.error("Exception while copying files: " + str(e))
+            logging.error("Exception while writing test results: " + str(e))
             return
+        with cls.results_lock:
+            cls.csv_parts[index] = (csv_header, dst, csv_dialect)
 
     @classmethod
-    def write_test_results_csv(cls, perf_run: bool, custom_output_dir: str = ''):
-        if not cls.combined_output:
-            logging.debug("write_test_results_csv called with no test output")
+    def merge_json_results(cls, chunks: List[dict]) -> dict:
+        """Concatenate the results of each chunk. A failed test is dropped when a test with the same name succeeds in
+        the same or a later chunk, ie when it passed on a rerun. Like the first copied file, the first chunk is taken
+        as it is."""
+        last_success = {}
+        for i, chunk in enumerate(chunks[1:], 1):
+            for test in chunk.get('successful_tests', []):
+                last_success[test.get('test_name')] = i
+
+        merged = dict(chunks[0])
+        for key in cls.json_result_lists:
+            merged[key] = []
+        for i, chunk in enumerate(chunks):
+            for key in cls.json_result_lists:
+                tests = chunk.get(key, [])
+                if key == 'failed_tests':
+                    tests = [test for test in tests if last_success.get(test.get('test_name'), -1) < i]
+                merged[key].extend(tests)
+        return merged
+
+    @classmethod
+    def write_test_results_json(cls, custom_output_dir: str = ''):
+        """Merge the published test set results into the combined JSON file, which is kept as the first chunk."""
+        with cls.results_lock:
+            parts = [cls.json_parts[index] for index in sorted(cls.json_parts)]
+            cls.json_parts = {}
+        if not parts:
             return
+        dst = cls.get_output_path(cls.output_json, custom_output_dir)
+        chunks = []
+        try:
+            if os.path.isfile(dst):
+                with open(dst, 'r', encoding='utf8') as dst_file:
+                    chunks.append(json.load(dst_file))
+            for part in parts:
+                try:
+                    chunks.append(json.loads(part))
+                except ValueError as e:
+                    logging.error("Skipping unreadable test results: {}".format(e))
+            if chunks:
+                with open(dst, 'w', encoding='utf8') as dst_file:
+                    json.dump(cls.merge_json_results(chunks), dst_file)
+        except (IOError, ValueError) as e:
+            logging.error("Exception while writing {}: {}".format(dst, e))
 
+    @classmethod
+    def add_failed_test_cmd_lines(cls, rows):
         # Create command line string for failed test.
-        failed_test_cmd = ''
-        for i in range(len(cls.combined_output)):
-            if cls.combined_output[i].get('Passed') == 'False':
-                failed_test_cmd = get_failed_cmd_line(cls, i)
-                cls.combined_output[i]['Error Msg'] += ' To run this test: \n' + failed_test_cmd
-
-        logging.debug("Copying output to {0}".format(cls.output_csv))
-        # Sort combined_output on the number of distinct functions (order of complexity)
-        sort_by_complexity = lambda row: len(row['Functions'].split(','))
-        try:
-            cls.combined_output.sort(key=sort_by_complexity)
-        except KeyError as e:
-            logging.debug("Tried to sort output on a key that doesn't exist. Leaving output unsorted.")
+        for row in rows:
+            if row.get('Passed') == 'False':
+                failed_test_cmd = get_failed_cmd_line_for_row(row)
+                row['Error Msg'] += ' To run this test: \n' + failed_test_cmd
+            yield row
+
+    @classmethod
+    def write_test_results_csv(cls, perf_run: bool, custom_output_dir: str = ''):
+        """Merge the csv files of the test sets into the combined csv, sorted on the number of distinct functions.
+        Each file is already sorted, so the rows are streamed through heapq.merge instead of being held in memory."""
+        with cls.results_lock:
+            parts = [cls.csv_parts[index] for index in sorted(cls.csv_parts)]
+        if not parts:
+            logging.debug("write_test_results_csv called with no test output")
+            return
 
         dst = os.path.join(os.getcwd(), cls.output_csv)
         if custom_output_dir != '':
             dst = os.path.join(Path(custom_output_dir), cls.output_csv)
-        try:
-            with open(dst, 'w', encoding='utf8') as dst_file:
-                writer = csv.DictWriter(
-                    dst_file,
-                    fieldnames=cls.combined_output[0],
-                    dialect=return_csv_dialect(perf_run),
-                    quoting=csv.QUOTE_MINIMAL
-                )
-                writer.writeheader()
-                for row in cls.combined_output:
-                    writer.writerow(row)
-        except IOError as e:
-            logging.error("Exception while writing to file: " + str(e))
-            return
 
-def do_test_queue_work(i, q):
+        parts = [(header, rows, dialect, True) for header, rows, dialect in parts]
+        if cls.written_csv and os.path.isfile(cls.written_csv):
+            # Rows from the previous phase already have the command lines for failed tests.
+            if cls.csv_parts_dir is None:
+                cls.csv_parts_dir = make_temp_dir(['csv_parts'])
+            previous = os.path.join(cls.csv_parts_dir, 'previous_' + cls.output_csv)
+            shutil.move(cls.written_csv, previous)
+            parts.insert(0, (None, previous, return_csv_dialect(perf_run), False))
+
+        logging.debug("Writing output to {0}".format(cls.output_csv))
+        with contextlib.ExitStack() as part_files:
+            readers = []
+            fieldnames = None
+            for header, rows, dialect, add_cmd_lines in parts:
+                if isinstance(rows, str):
+                    reader = csv.DictReader(part_files.enter_context(open(rows, 'r', encoding='utf8')),
+                                            dialect=dialect)
+                    header = reader.fieldnames
+                else:
+                    reader = (dict(zip(header, row)) for row in rows)
+                if fieldnames is None:
+                    fieldnames = header
+                readers.append(cls.add_failed_test_cmd_lines(reader) if add_cmd_lines else reader)
+
+            if fieldnames and 'Functions' in fieldnames:
+                # heapq.merge is stable, so rows with the same complexity stay in the order the test sets finished.
+                rows = heapq.merge(*readers, key=lambda row: len(row['Functions'].split(',')))
+            else:
+                logging.debug("Tried to sort output on a key that doesn't exist. Leaving output unsorted.")
+                rows = itertools.chain(*readers)
+
+            first_row = next(rows, None)
+            if first_row is None:
+                logging.debug("write_test_results_csv called with no test output")
+                return
+            try:
+                with open(dst, 'w', encoding='utf8') as dst_file:
+                    writer = csv.DictWriter(
+                        dst_file,
+                        fieldnames=fieldnames,
+                        dialect=return_csv_dialect(perf_run),
+                        quoting=csv.QUOTE_MINIMAL
+                    )
+                    writer.writeheader()
+                    writer.writerow(first_row)
+                    writer.writerows(rows)
+            except IOError as e:
+                logging.error("Exception while writing to file: " + str(e))
+                return
+
+        cls.written_csv = dst
+        with cls.results_lock:
+            cls.csv_parts = {}
+            cls.csv_rows_in_memory = 0
+            if cls.csv_parts_dir is not None:
+                shutil.rmtree(cls.csv_parts_dir, ignore_errors=True)
+                cls.csv_parts_dir = None
+
+def do_test_queue_work(i, q, archiver: ResultArchiver):
     """This will be called in a queue.join() context, so make sure to mark all work items as done and
     continue through the loop. Don't try and exit or return from here if there are still work items in the queue.
     See the python queue documentation."""
@@ -110,8 +256,14 @@ def do_test_queue_work(i, q):
         work: TestRunner = q.get()
 
         work.run()
+        # A sharded test set queues its shards before it's marked done, so they share the worker threads and limits.
+        for shard in work.get_queued_shards():
+            q.put(shard)
+        finished = work.get_finished_test_set()
+        if finished is not None:
+            finished.copy_files_and_cleanup(archiver)
 
-        q.task_done()
+        q.task_done(work)
 
 
 class TestRunner():
@@ -126,91 +278,78 @@ class TestRunner():
         self.thread_lock = lock
         self.temp_dir = make_temp_dir([self.test_config.suite_name, str(thread_id)])
         self.test_config.output_dir = self.temp_dir
-
-    def copy_files_to_zip(self, dst_file_name, src_dir, is_logs):
-        dst = os.path.join(os.getcwd(), dst_file_name)
-        custom_dir = self.test_config.custom_output_dir
-        if custom_dir != '':
-            dst = os.path.join(custom_dir, dst_file_name)
-        mode = 'w' if not os.path.isfile(dst) else 'a'
+        self.run_time = None
+        # Orders the results of this test set in the combined output files. Set by run_tests_impl to the position of
+        # the test set in the run, before the test sets are reordered by their expected run time.
+        self.output_index = 0
+        # Timeouts or connection errors make the scheduler run fewer test sets of this datasource at a time.
+        self.connection_errors = False
+        self.start_time = None
+        self.shards: List[ShardRunner] = []
+        self.remaining_shards = 0
+
+    def get_timing_key(self):
+        return get_test_set_key(self.test_config.suite_name, self.test_config.config_file)
+
+    def get_files_to_zip(self, src_dir, is_logs) -> List[Tuple[str, str]]:
+        """Return the (file path, name in archive) of the actuals or the logs of this test set."""
         optional_dir_name = self.test_config.config_file.replace('.', '_')
-        if is_logs is True:
-            log_dir = os.path.join(src_dir, optional_dir_name)
-            glob_path = glob.glob(os.path.join(log_dir, '*.txt'))
-            glob_path.extend(glob.glob(os.path.join(log_dir, '*.log')))
-            glob_path.extend(glob.glob(os.path.join(log_dir, 'crashdumps/*')))
-        else:
-            glob_path = glob.glob(os.path.join(src_dir, 'actual.*'))
-        with zipfile.ZipFile(dst, mode, zipfile.ZIP_DEFLATED) as myzip:
+        # Sharded test sets write their output to a subdirectory per shard.
+        shard_dirs = [''] + sorted(os.path.basename(d) for d in glob.glob(os.path.join(src_dir, SHARD_DIR_PREFIX + '*')))
+        files = []
+        for shard_dir in shard_dirs:
+            if is_logs is True:
+                log_dir = os.path.join(src_dir, shard_dir, optional_dir_name)
+                glob_path = glob.glob(os.path.join(log_dir, '*.txt'))
+                glob_path.extend(glob.glob(os.path.join(log_dir, '*.log')))
+                glob_path.extend(glob.glob(os.path.join(log_dir, 'crashdumps/*')))
+            else:
+                glob_path = glob.glob(os.path.join(src_dir, shard_dir, 'actual.*'))
             for actual in glob_path:
                 path = pathlib.PurePath(actual)
                 file_to_be_zipped = path.name
+                if is_logs is True and shard_dir:
+                    file_to_be_zipped = os.path.join(shard_dir, file_to_be_zipped)
                 inner_output = os.path.join(optional_dir_name, file_to_be_zipped)
-                myzip.write(actual, inner_output)
-
-    def copy_output_files(self, csv_dialect):
-        TestOutputFiles.copy_output_file("test_results.csv", self.temp_dir, csv_dialect)
+                files.append((actual, inner_output))
+        return files
 
-    def copy_test_result_file(self):
-        src = os.path.join(self.temp_dir, "tdvt_output.json")
-        dst = os.path.join(os.getcwd(), TestOutputFiles.output_json)
+    def copy_files_to_zip(self, archiver: ResultArchiver, dst_file_name, src_dir, is_logs):
+        dst = os.path.join(os.getcwd(), dst_file_name)
         custom_dir = self.test_config.custom_output_dir
         if custom_dir != '':
-            dst = os.path.join(custom_dir, TestOutputFiles.output_json)
-        try:
-            if not os.path.isfile(dst):
-                shutil.copyfile(src, dst)
-            else:
-                src_file = open(src, 'r', encoding='utf8')
-                results = json.load(src_file)
-                src_file.close()
-
-                dst_file = open(dst, 'r', encoding='utf8')
-                existing_results = json.load(dst_file)
-                dst_file.close()
-
-                existing_results['failed_tests'].extend(results['failed_tests'])
-
-                existing_results['successful_tests'].extend(results['successful_tests'])
-
-                existing_results['skipped_tests'].extend(results['skipped_tests'])
-
-                existing_results['disabled_tests'].extend(results['disabled_tests'])
-
-                # Check the newly succeeding tests, and if they are in the existing failed
-                # test list, remove them from the failed test list since they now succeed
-                for element in results['successful_tests']:
-                    for failed in existing_results['failed_tests']:
-                        if element['test_name'] == failed['test_name']:
-                            existing_results['failed_tests'].remove(failed)
-
-                dst_file = open(dst, 'w', encoding='utf8')
-                json.dump(existing_results, dst_file)
-                dst_file.close()
-        except IOError:
-            return
+            dst = os.path.join(custom_dir, dst_file_name)
+        archiver.add_files(dst, self.get_files_to_zip(src_dir, is_logs))
 
-    def copy_files_and_cleanup(self):
-        left_temp_dir = False
+    def publish_results(self, json_results: str, csv_header: List[str], csv_rows: List[List[str]]):
         csv_dialect = 'perflab' if self.test_config.run_as_perf else 'tdvt'
-        try:
-            self.copy_files_to_zip(TestOutputFiles.output_actuals, self.temp_dir, is_logs=False)
-            self.copy_files_to_zip(TestOutputFiles.output_tabquery_log, self.temp_dir, is_logs=True)
-            self.copy_output_files(csv_dialect)
-            self.copy_test_result_file()
-        except Exception as e:
-            print(e)
-            pass
-
+        TestOutputFiles.add_test_set_results(self.output_index, csv_dialect, json_results, csv_header, csv_rows)
+        self.connection_errors = has_connection_errors(csv_header, csv_rows)
+        if self.test_config.record_history:
+            get_run_history().add_test_set_results(csv_header, csv_rows)
+        if self.test_config.columnar_output:
+            output_dir = self.test_config.custom_output_dir or os.getcwd()
+            get_columnar_writer(output_dir, self.test_config.columnar_output).add_test_set_results(
+                self.test_config.suite_name, self.test_config.config_file, csv_header, csv_rows)
+
+    def cleanup(self):
         try:
             if not self.test_config.leave_temp_dir:
                 shutil.rmtree(self.temp_dir)
             else:
-                left_temp_dir = True
+                print("Left temp dir: " + self.temp_dir)
         except:
             pass
 
-        return left_temp_dir
+    def copy_files_and_cleanup(self, archiver: ResultArchiver):
+        """Hand the actuals and logs to the archiver. The temp dir is removed once the archiver has written them."""
+        try:
+            self.copy_files_to_zip(archiver, TestOutputFiles.output_actuals, self.temp_dir, is_logs=False)
+            self.copy_files_to_zip(archiver, TestOutputFiles.output_tabquery_log, self.temp_dir, is_logs=True)
+        except Exception as e:
+            print(e)
+            pass
+        archiver.call(self.cleanup)
 
     def run(self):
         # Send output to null.
@@ -221,17 +360,71 @@ class TestRunner():
         print("Running {0} {1} {2}\n".format(self.test_config.suite_name, self.test_config.config_file,
                                              str(self.thread_id)))
 
-        start_time = time.time()
+        self.start_time = time.time()
         self.test_config.thread_id = self.thread_id
-        failed_tests, skipped_tests, disabled_tests, total_tests = run_tests(self.test_config, self.test_set)
+        set_tds_full_path(self.test_config)
+        shards = get_test_shards(self.test_set, self.test_config)
+        if shards is not None:
+            logging.debug("Running {} in {} shards.".format(self.test_config.config_file, len(shards)))
+            self.shards = [ShardRunner(self, shard_id, shard_tests) for shard_id, shard_tests in enumerate(shards)]
+            self.remaining_shards = len(self.shards)
+            return
+        self.finish(run_tests(self.test_config, self.test_set, self.publish_results))
+
+    def finish(self, counts: Tuple[int, int, int, int]):
+        self.run_time = time.time() - self.start_time
         logging.debug("\nFinished tdvt " + str(self.test_config) + "\n")
         print("\nFinished {0} {1} {2}\n".format(self.test_config.suite_name, self.test_config.config_file,
                                                 str(self.thread_id)))
 
-        self.failed_tests = failed_tests
-        self.skipped_tests = skipped_tests
-        self.disabled_tests = disabled_tests
-        self.total_tests = total_tests
+        self.failed_tests, self.skipped_tests, self.disabled_tests, self.total_tests = counts
+
+    def shard_done(self) -> bool:
+        """Publish the results of the test set once its last shard is done. Return True if it was the last one."""
+        with self.thread_lock:
+            self.remaining_shards -= 1
+            if self.remaining_shards:
+                return False
+        all_test_results = merge_shard_results([shard.test_list for shard in self.shards],
+                                               [shard.results for shard in self.shards])
+        self.finish(process_run_results(self.test_config, all_test_results, self.publish_results))
+        return True
+
+    def get_queued_shards(self) -> List['ShardRunner']:
+        """The shards to queue after run(). The test set is finished by the last of them."""
+        return self.shards
+
+    def get_finished_test_set(self) -> Optional['TestRunner']:
+        return None if self.shards else self
+
+
+class ShardRunner(object):
+    """One shard of a sharded test set, queued like a test set so it runs on the worker threads within the limits of
+    the scheduler. The last shard to finish publishes the results of the whole test set."""
+
+    def __init__(self, test_set_runner: TestRunner, shard_id: int, test_list):
+        self.test_set_runner = test_set_runner
+        self.test_set = test_set_runner.test_set
+        self.test_config = test_set_runner.test_config
+        self.shard_id = shard_id
+        self.test_list = test_list
+        self.results = {}
+        self.connection_errors = False
+        self.finished = False
+
+    def run(self):
+        print("Running {0} {1} shard {2}\n".format(self.test_config.suite_name, self.test_config.config_file,
+                                                   self.shard_id))
+        self.results = run_test_shard(self.test_set, self.test_config, self.shard_id, self.test_list)
+        self.finished = self.test_set_runner.shard_done()
+        if self.finished:
+            self.connection_errors = self.test_set_runner.connection_errors
+
+    def get_queued_shards(self) -> List['ShardRunner']:
+        return []
+
+    def get_finished_test_set(self) -> Optional[TestRunner]:
+        return self.test_set_runner if self.finished else None
 
 
 def delete_output_files(root_dir):
@@ -485,9 +678,29 @@ run_connectors_test_usage_text = '''
 
 action_usage_text = '''
 '''
+history_usage_text = '''
+    Runs started with --record-history save their results to tdvt_cache/run_history.sqlite. Compare two runs to see the new failures, the fixed
+    tests and the query time regressions.
+
+    Compare the last two runs:
+        history
+    List the runs:
+        history --list
+    Compare two runs:
+        history 20240312T180000Z-1234 20240313T180000Z-5678
+    Report queries that take more than twice as long and at least 50 ms longer:
+        history --time-ratio 2 --min-time 50
+'''
 run_file_usage_text = '''
 '''
 
+def non_negative_int(value: str) -> int:
+    number = int(value)
+    if number < 0:
+        raise argparse.ArgumentTypeError("must be 0 or more, got {}".format(value))
+    return number
+
+
 def create_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(
         formatter_class=argparse.RawTextHelpFormatter,
@@ -532,6 +745,47 @@ def create_parser() -> argparse.ArgumentParser:
                                         help='Generate expected value files.', required=False)
     run_test_common_parser.add_argument('--perf-run', dest='perf_run', action='store_true', default=False)
     run_test_common_parser.add_argument('--iteration', dest='perf_iteration', type=int)
+    run_test_common_parser.add_argument('--persistent-tabquery', dest='persistent_tabquery', action='store_true',
+                                        help='Reuse warm tabquerycli worker processes, at most one per running test '
+                                             'set, instead of starting a new one for every test set.', required=False)
+    run_test_common_parser.add_argument('--shards', dest='shard_count', type=int,
+                                        help='Split large test sets into up to this many shards that are queued like '
+                                             'test sets, each with its own tabquerycli process.', required=False)
+    run_test_common_parser.add_argument('--stream-results', dest='stream_results', action='store_true',
+                                        help='Compare each result file as soon as tabquerycli writes it instead of '
+                                             'waiting for the process to exit.', required=False)
+    run_test_common_parser.add_argument('--cache-expected', dest='cache_expected', action='store_true',
+                                        help='Save parsed expected files in tdvt_cache so later runs can skip parsing '
+                                             'the ones that did not change.', required=False)
+    run_test_common_parser.add_argument('--zip-compression', dest='zip_compression_level', type=int,
+                                        choices=range(0, 10), metavar='[0-9]',
+                                        help='Compression level of the zip files with the actuals and logs, from 1 '
+                                             '(fastest) to 9 (smallest). 0 stores the files without compressing them.',
+                                        required=False)
+    run_test_common_parser.add_argument('--columnar-output', dest='columnar_output', choices=COLUMNAR_FORMATS,
+                                        nargs='?', const='auto',
+                                        help='Also write the results with typed columns, partitioned by suite and run '
+                                             'id, to Parquet files in tdvt_results if pyarrow is installed or to '
+                                             'tdvt_results.sqlite otherwise.', required=False)
+    run_test_common_parser.add_argument('--record-history', dest='record_history', action='store_true',
+                                        help='Save the results to the run history in tdvt_cache.', required=False)
+    run_test_common_parser.add_argument('--incremental', dest='incremental', action='store_true',
+                                        help='Reuse the results of tests that passed in an earlier run with the same '
+                                             'test file, tds, overrides, tabquerycli and plugins instead of running '
+                                             'them again.', required=False)
+    run_test_common_parser.add_argument('--threads-per-tds', dest='tds_thread_count', type=non_negative_int,
+                                        help='Max number of test sets that use the same tds file to run at a time. '
+                                             '0 means no limit.',
+                                        required=False)
+    run_test_common_parser.add_argument('--compare-processes', dest='compare_processes', type=int, nargs='?',
+                                        const=0, metavar='PROCESSES',
+                                        help='Compare the results in a pool of processes instead of on the test set '
+                                             'threads. Defaults to one process per CPU.',
+                                        required=False)
+    run_test_common_parser.add_argument('--generate-processes', dest='generate_processes', type=int, nargs='?',
+                                        const=0, metavar='PROCESSES',
+                                        help='Write the files for --generate from a pool of processes. Defaults to one '
+                                             'process per CPU.', required=False)
     subparsers = parser.add_subparsers(help='commands', dest='command')
 
     #Get information.
@@ -547,6 +801,15 @@ def create_parser() -> argparse.ArgumentParser:
     action_group.add_argument('--add_ds', dest='add_ds', help='Add a new datasource.', required=False)
     action_group.add_argument('--diff-test', '-dd', dest='diff', help='Diff the results of the given test (ie exprtests/standard/setup.calcs_data.txt) against the expected files. Can be used with the sql and tuple options.', required=False)
     action_group.add_argument('--generate', dest='action_generate', action='store_true', help='Generate logical query test files.', required=False)
+    action_group.add_argument('--generate-processes', dest='generate_processes', type=int, nargs='?', const=0, metavar='PROCESSES', help='Write the generated files from a pool of processes. Defaults to one process per CPU.', required=False)
+
+    #Run history.
+    history_parser = subparsers.add_parser('history', help='Compare the results of two runs from the run history.', usage=history_usage_text)
+    history_parser.add_argument('old_run', help='Run id to compare against. Default is the second to last run.', default=None, nargs='?')
+    history_parser.add_argument('new_run', help='Run id to compare. Default is the last run.', default=None, nargs='?')
+    history_parser.add_argument('--list', dest='list_runs', action='store_true', help='List the runs in the run history.', required=False)
+    history_parser.add_argument('--time-ratio', dest='time_ratio', type=float, default=1.5, help='Report queries that take this many times longer than before. Default is 1.5.', required=False)
+    history_parser.add_argument('--min-time', dest='min_time_difference', type=float, default=10.0, help='Only report queries that take at least this many more milliseconds than before. Default is 10.', required=False)
 
     #Run tests.
     run_test_parser = subparsers.add_parser('run', help='Run tests.', parents=[run_test_common_parser], usage=run_usage_text)
@@ -649,52 +912,66 @@ def active_thread_count(threads):
     return active
 
 
-def test_runner(all_tests: List[TestRunner], test_queue: queue.Queue, max_threads: int) -> Tuple[int, int, int, int]:
-    for i in range(0, max_threads):
-        worker = threading.Thread(target=do_test_queue_work, args=(i, test_queue))
-        worker.setDaemon(True)
-        worker.start()
-    test_queue.join()
+def get_test_counts(runners: List[TestRunner]) -> Tuple[int, int, int, int]:
     failed_tests = 0
     skipped_tests = 0
     disabled_tests = 0
     total_tests = 0
-    for work in all_tests:
-        if work.copy_files_and_cleanup():
-            print("Left temp dir: " + work.temp_dir)
+    for work in runners:
         failed_tests += work.failed_tests if work.failed_tests else 0
         skipped_tests += work.skipped_tests if work.skipped_tests else 0
         disabled_tests += work.disabled_tests if work.disabled_tests else 0
         total_tests += work.total_tests if work.total_tests else 0
+    return failed_tests, skipped_tests, disabled_tests, total_tests
+
+
+def test_runner(all_tests: List[TestRunner], test_queue: TestSetScheduler, max_threads: int) -> Tuple[int, int, int, int]:
+    """Run the test sets in the queue, and the ones its gate queues, until they are done. all_tests lists all of
+    them."""
+    # Each test set's files are zipped as soon as it finishes, while the other test sets are still running.
+    archiver = ResultArchiver(all_tests[0].test_config.zip_compression_level if all_tests else None)
+    for i in range(0, max_threads):
+        worker = threading.Thread(target=do_test_queue_work, args=(i, test_queue, archiver))
+        worker.setDaemon(True)
+        worker.start()
+    test_queue.join()
+    archiver.close()
     is_perf_run = all_tests[0].test_config.run_as_perf
     custom_output_dir = all_tests[0].test_config.custom_output_dir
     TestOutputFiles.write_test_results_csv(is_perf_run, custom_output_dir)
-    return failed_tests, skipped_tests, disabled_tests, total_tests
+    TestOutputFiles.write_test_results_json(custom_output_dir)
+    return get_test_counts(all_tests)
 
 
 def run_tests_impl(
     tests: List[Tuple[TestSet, TdvtInvocation]],
     max_threads: int,
     args: argparse.Namespace,
+    datasource_threads: Optional[Dict[str, int]] = None,
 ) -> Optional[Tuple[int, int, int, int]]:
     if not tests:
         print("No tests found. Check arguments.")
         sys.exit()
 
-    smoke_test_queue = queue.Queue()
+    tds_threads = getattr(args, 'tds_thread_count', None) or 0
     smoke_tests = []
-    test_queue = queue.Queue()
+    test_queue = TestSetScheduler(datasource_threads, tds_threads)
     all_work = []
     lock = threading.Lock()
+    timings = TestSetTimings.load()
 
-    for test_set, test_config in tests:
+    for i, (test_set, test_config) in enumerate(tests):
         runner = TestRunner(test_set, test_config, lock, args.verbose, len(all_work) + 1)
+        runner.output_index = i
         if test_set.smoke_test:
             smoke_tests.append(runner)
-            smoke_test_queue.put(runner)
         else:
             all_work.append(runner)
 
+    # Start the longest test sets first so a long one doesn't start last and keep the run waiting on one thread.
+    smoke_tests = order_by_expected_runtime(smoke_tests, timings)
+    all_work = order_by_expected_runtime(all_work, timings)
+
     logging.debug("smoke test queue size is: " + str(len(smoke_tests)))
     logging.debug("test queue size is: " + str(len(all_work)))
 
@@ -711,58 +988,58 @@ def run_tests_impl(
     if not all_work and not smoke_tests:
         sys.exit("No tests found. Check arguments.")
 
-    failing_ds = set()
-    failed_smoke_tests = 0
-    skipped_smoke_tests = 0
-    disabled_smoke_tests = 0
-    total_smoke_tests = 0
-    smoke_tests_run = 0
-
     absolute_start_time = time.time()
-    smoke_test_run_time = 0
 
-    if smoke_tests:
+    if require_smoke_test:
+        for runner in smoke_tests:
+            test_queue.put(runner)
         smoke_test_threads = min(len(smoke_tests), max_threads)
         print("Starting smoke tests. Creating", str(smoke_test_threads), "worker threads.\n")
-
         failed_smoke_tests, skipped_smoke_tests, disabled_smoke_tests, total_smoke_tests = test_runner(
-            smoke_tests, smoke_test_queue, smoke_test_threads
+            smoke_tests, test_queue, smoke_test_threads
         )
-
-        smoke_tests_run = total_smoke_tests - disabled_smoke_tests
-
-        print("{} smoke test(s) ran. {} smoke tests disabled.".format(smoke_tests_run, disabled_smoke_tests))
-
-        smoke_test_run_time = round(time.time() - absolute_start_time, 2)
-        print("Smoke tests ran in {} seconds.".format(smoke_test_run_time))
-
+        shutdown_tabquery_workers()
+        shutdown_compare_pool()
+        record_runtimes(smoke_tests, timings)
+        timings.save()
+        print("{} smoke test(s) ran. {} smoke tests disabled.".format(total_smoke_tests - disabled_smoke_tests,
+                                                                      disabled_smoke_tests))
+        print("Smoke tests ran in {} seconds.".format(round(time.time() - absolute_start_time, 2)))
         if failed_smoke_tests > 0:
             print("{} smoke test(s) failed. Please check logs for information.".format(failed_smoke_tests))
-            failing_ds = set(item.test_set.ds_name for item in smoke_tests if item.failed_tests > 0)
-            if require_smoke_test:
-                print("\nSmoke tests failed, exiting.")
-                sys.exit(1)
-
-        if require_smoke_test:
-            print("\nSmoke tests finished. Exiting.")
-            sys.exit(0)
-
-        if failing_ds and not force_run:
-            print("Tests for the following data source(s) will not be run: {}".format(', '.join(failing_ds)))
-
-    final_work = []
+            print("\nSmoke tests failed, exiting.")
+            sys.exit(1)
+        print("\nSmoke tests finished. Exiting.")
+        sys.exit(0)
 
-    for item in all_work:
-        if not force_run:
-            if item.test_set.ds_name in failing_ds:
-                item.test_set.test_is_skipped = True
-        final_work.append(item)
-        test_queue.put(item)
+    # The smoke tests and the main test sets share the worker threads. The test sets of a datasource are queued as
+    # soon as its own smoke tests finish, so a slow database doesn't hold up the others.
+    gate = SmokeTestGate(smoke_tests, all_work, force_run)
+    test_queue.gate = gate
+    for runner in smoke_tests + gate.get_ready_work():
+        test_queue.put(runner)
 
     print("\nStarting tests. Creating " + str(max_threads) + " worker threads.")
     logging.info("Testing using {} threads.".format(max_threads))
-    start_time = time.time()
-    failed_tests, skipped_tests, disabled_tests, total_tests = test_runner(final_work, test_queue, max_threads)
+    test_runner(smoke_tests + all_work, test_queue, max_threads)
+    shutdown_tabquery_workers()
+    shutdown_compare_pool()
+    record_runtimes(smoke_tests + all_work, timings)
+    timings.save()
+    get_expected_match_index().save()
+
+    failed_smoke_tests, skipped_smoke_tests, disabled_smoke_tests, total_smoke_tests = get_test_counts(smoke_tests)
+    failed_tests, skipped_tests, disabled_tests, total_tests = get_test_counts(all_work)
+    smoke_test_run_time = 0
+    if smoke_tests:
+        print("{} smoke test(s) ran. {} smoke tests disabled.".format(total_smoke_tests - disabled_smoke_tests,
+                                                                      disabled_smoke_tests))
+        if gate.smoke_test_end_time:
+            smoke_test_run_time = round(gate.smoke_test_end_time - absolute_start_time, 2)
+        if failed_smoke_tests > 0:
+            print("{} smoke test(s) failed. Please check logs for information.".format(failed_smoke_tests))
+        if gate.failing_ds and not force_run:
+            print("Tests for the following data source(s) were not run: {}".format(', '.join(sorted(gate.failing_ds))))
 
     failed_tests += failed_smoke_tests
     skipped_tests += skipped_smoke_tests
@@ -771,7 +1048,7 @@ def run_tests_impl(
     total_tests_run = total_tests - disabled_tests - skipped_tests
     total_passed_tests = total_tests_run - failed_tests
     now_time = time.time()
-    main_test_time = round(now_time - start_time, 2)
+    main_test_time = round(now_time - absolute_start_time - smoke_test_run_time, 2)
     total_run_time = round(now_time - absolute_start_time, 2)
 
     print('\nTest Count: {} tests'.format(total_tests))
@@ -821,6 +1098,7 @@ def run_desired_tests(
 
     max_threads = get_level_of_parallelization(args)
     test_sets: List[Tuple[TestSet, TestConfig], Tuple[TestSet, TdvtInvocation]] = []
+    datasource_threads = {}
 
     for ds in ds_to_run:
         ds_info = ds_registry.get_datasource_info(ds)
@@ -829,13 +1107,13 @@ def run_desired_tests(
 
         print("Testing " + ds)
         max_threads_per_datasource = ds_info.run_time_config.maxthread;
-        # if has multi datasource to run, then max_threads_per_datasource can not apply.
+        # With multiple datasources the setting limits how many of this datasource's test sets run at a time.
         if max_threads_per_datasource > 0:
             print("thread setting in " + ds + ".ini = " + str(max_threads_per_datasource))
             if len(ds_to_run) == 1:
                 max_threads = max_threads_per_datasource
             else:
-                print("Setting cannot apply since you are running multiple datasources.")
+                datasource_threads[ds] = max_threads_per_datasource
 
         suite = ds
         if args.command == 'run-pattern':
@@ -845,7 +1123,9 @@ def run_desired_tests(
         else:
             test_sets.extend(enqueue_tests(ds_info, args, suite))
 
-    failed_tests, skipped_tests, disabled_tests, total_tests = run_tests_impl(test_sets, max_threads, args)
+    get_test_index().save()
+    failed_tests, skipped_tests, disabled_tests, total_tests = run_tests_impl(test_sets, max_threads, args,
+                                                                             datasource_threads)
     return failed_tests
 
 def run_connectors_test(args):
@@ -877,15 +1157,16 @@ def run_file(run_file: Path, output_dir: Path, threads: int, args) -> int:
     return 0
 
 
-def run_generate(ds_registry):
+def run_generate(ds_registry, processes: Optional[int] = None):
     start_time = time.time()
-    generate_files(ds_registry, True)
+    generate_files(ds_registry, True, processes)
     end_time = time.time() - start_time
     print("Done: " + str(end_time))
 
 
 def main():
     parser, ds_registry, args = init()
+    TestOutputFiles.reset()
 
     if args.command == 'action':
         if args.setup:
@@ -897,11 +1178,11 @@ def main():
             generate_files(ds_registry, True)
             sys.exit(0)
         elif args.action_generate:
-            run_generate(ds_registry)
+            run_generate(ds_registry, args.generate_processes)
             sys.exit(0)
     elif is_test(args):
         if args.generate:
-            run_generate(ds_registry)
+            run_generate(ds_registry, args.generate_processes)
             # It's ok to call generate and then run some tests, so don't exit here.
         if args.command == 'run-file':
             output_dir = os.getcwd()
@@ -916,11 +1197,15 @@ def main():
         tdvt_invocation = TdvtInvocation(from_args=args)
         run_diff(tdvt_invocation, args.diff)
         sys.exit(0)
+    elif args.command == 'history':
+        sys.exit(print_run_history(args.old_run, args.new_run, args.list_runs, args.time_ratio,
+                                   args.min_time_difference))
     elif args.command == 'list-logical-configs':
         print_logical_configurations(ds_registry, args.list_logical_configs)
         sys.exit(0)
     elif args.command == 'list':
         print_configurations(ds_registry, [args.list_ds], args.verbose)
+        get_test_index().save()
         sys.exit(0)
 
     logging.error("Could not interpret arguments. Nothing done.")
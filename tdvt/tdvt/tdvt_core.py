@@ -14,20 +14,32 @@ import os
 import shutil
 import subprocess
 import sys
+import threading
 import time
 import zipfile
+from concurrent.futures.process import BrokenProcessPool
 from typing import Dict, List, Optional, Tuple
 
-from defusedxml.ElementTree import ParseError, parse
+from defusedxml.ElementTree import ParseError
 
 from .config_gen.genconfig import generate_config_files
 from .config_gen.gentests import generate_logical_files
 from .config_gen.test_config import TestSet
 from .constants import DEFAULT_CSV_HEADERS, PERFLAB_CSV_HEADERS, TUPLE_DISPLAY_LIMIT
+from .expected_cache import ExpectedMatchIndex, get_expected_match_index, load_expected_results
+from .incremental import get_incremental_cache
+from .process_pool import get_compare_pool
 from .resources import *
 from .tabquery import build_connectors_test_tabquery_command_line, build_tabquery_command_line
+from .tabquery_worker import run_tabquery_batch
 from .test_results import *
 
+# Test sets are only split when each shard gets at least this many test files.
+SHARD_MIN_TESTS = 25
+SHARD_DIR_PREFIX = 'shard_'
+# How often to look for finished result files when streaming results.
+STREAM_POLL_SECONDS = 0.25
+
 
 class ConnectorsTest(object):
     def __init__(self, conn_test_name, conn_test_file, conn_test_password_file):
@@ -84,6 +96,13 @@ class BatchQueueWork(object):
         self.setup_logs_and_tests()
         self.error_state = None
         self.metadata_map = {}
+        self.streamed_tests = set()
+        self.incremental_cache = get_incremental_cache() if test_config.incremental else None
+        self.test_fingerprints = {}
+        # Tests whose result file was reused from an earlier run with --incremental.
+        self.cached_tests = set()
+        self.compare_pool = get_compare_pool(test_config.compare_processes) \
+            if test_config.compare_processes is not None else None
 
     def get_thread_msg(self):
         return "Thread-[{0}] ".format(self.thread_id)
@@ -182,66 +201,131 @@ class BatchQueueWork(object):
         test_count = -1
         for f in test_list:
             test_count += 1
-            t = TestResultWork(f, self.test_config.output_dir, self.test_config.logical)
-
-            actual_filepath = t.test_file
-            base_test_filepath = t.test_file
-            existing_output_filepath = self.test_set.get_expected_output_file_path(t.test_file, self.test_config.output_dir)
-
-            # First check for systemic errors and set all the test results to that error.
-            if not os.path.isfile(existing_output_filepath):
-                if self.is_timeout():
-                    self.add_timeout_test_failure(t)
-                    sys.stdout.write('T')
-                    continue
-                elif self.is_aborted():
-                    self.add_aborted_test_failure(t)
-                    sys.stdout.write('A')
-                    continue
-                elif self.is_expected_error():
-                    self.add_expected_test_failure(t)
-                    sys.stdout.write('.')
-                    continue
-                elif self.is_skipped():
-                    self.handle_skipped_test_failure(t)
-                    sys.stdout.write('S')
-                    continue
-                elif self.is_disabled():
-                    self.handle_disabled_test_failure(t)
-                    sys.stdout.write('D')
-                    continue
-                elif self.is_error():
-                    self.add_other_test_failure(t, test_count)
-                    sys.stdout.write('E')
-                    continue
-                else:
-                    logging.error(self.get_thread_msg() + "Error: could not find test output file:" + existing_output_filepath)
-                    sys.stdout.write('?')
-                    self.add_missing_test_failure(t)
-                    continue
-
-            if self.test_config.logical:
-                # Copy the test process filename to the actual. filename.
-                actual_output_filepath, base_filepath = self.test_set.get_actual_and_base_file_path(
-                    t.test_file,
-                    self.test_config.output_dir
-                )
-                logging.debug(self.get_thread_msg() + "Copying test process output {0} to actual file {1}".format(
-                    existing_output_filepath, actual_output_filepath))
-                try_move(existing_output_filepath, actual_output_filepath)
-                base_test_filepath = base_filepath
-                actual_filepath = actual_output_filepath
-
+            if f.test_path in self.streamed_tests:
+                # Already compared while tabquery was running. The process output is only known now.
+                self.results[f.test_path].cmd_output = self.cmd_output
+                continue
+            self.process_test_result(f, test_count)
+
+    def process_test_result(self, f, test_count):
+        t = TestResultWork(f, self.test_config.output_dir, self.test_config.logical)
+
+        actual_filepath = t.test_file
+        base_test_filepath = t.test_file
+        existing_output_filepath = self.test_set.get_expected_output_file_path(t.test_file, self.test_config.output_dir)
+
+        # First check for systemic errors and set all the test results to that error.
+        if not os.path.isfile(existing_output_filepath):
+            if self.is_timeout():
+                self.add_timeout_test_failure(t)
+                sys.stdout.write('T')
+                return
+            elif self.is_aborted():
+                self.add_aborted_test_failure(t)
+                sys.stdout.write('A')
+                return
+            elif self.is_expected_error():
+                self.add_expected_test_failure(t)
+                sys.stdout.write('.')
+                return
+            elif self.is_skipped():
+                self.handle_skipped_test_failure(t)
+                sys.stdout.write('S')
+                return
+            elif self.is_disabled():
+                self.handle_disabled_test_failure(t)
+                sys.stdout.write('D')
+                return
+            elif self.is_error():
+                self.add_other_test_failure(t, test_count)
+                sys.stdout.write('E')
+                return
+            else:
+                logging.error(self.get_thread_msg() + "Error: could not find test output file:" + existing_output_filepath)
+                sys.stdout.write('?')
+                self.add_missing_test_failure(t)
+                return
+
+        if self.test_config.logical:
+            # Copy the test process filename to the actual. filename.
+            actual_output_filepath, base_filepath = self.test_set.get_actual_and_base_file_path(
+                t.test_file,
+                self.test_config.output_dir
+            )
+            logging.debug(self.get_thread_msg() + "Copying test process output {0} to actual file {1}".format(
+                existing_output_filepath, actual_output_filepath))
+            try_move(existing_output_filepath, actual_output_filepath)
+            base_test_filepath = base_filepath
+            actual_filepath = actual_output_filepath
+
+        if self.compare_pool is not None:
+            result = self.compare_results_in_process(t.test_name, base_test_filepath, t.test_file)
+        else:
             result = compare_results(t.test_name, base_test_filepath, t.test_file, self)
-            result.relative_test_file = t.relative_test_file
-            result.cmd_output = self.cmd_output
-
-            sys.stdout.write('.' if result.all_passed() else 'F')
-            sys.stdout.flush()
+        result.relative_test_file = t.relative_test_file
+        result.cmd_output = self.cmd_output
+        if t.test_file in self.cached_tests:
+            result.cached = True
+            result.cmd_output = 'Reused the result of an earlier run with the same inputs.'
+
+        sys.stdout.write(('C' if result.cached else '.') if result.all_passed() else 'F')
+        sys.stdout.flush()
+
+        if result.get_name() in self.metadata_map:
+            result.test_metadata = self.metadata_map[result.get_name()]
+        self.add_test_result(t.test_file, result)
+
+    def compare_results_in_process(self, test_name, test_file, full_test_file) -> TestResult:
+        """compare_results in the process pool. This thread waits without holding the GIL."""
+        match_index = get_expected_match_index()
+        suite_name = self.test_config.suite_name
+        try:
+            result = self.compare_pool.submit(compare_results_in_process, test_name, test_file, full_test_file,
+                                              ComparisonWork(self, full_test_file),
+                                              match_index.get(suite_name, full_test_file)).result()
+        except BrokenProcessPool as e:
+            logging.error(self.get_thread_msg() + "Comparison process failed, comparing on this thread: " + str(e))
+            return compare_results(test_name, test_file, full_test_file, self)
+        # Share this test set's config instead of keeping the copy that came back with each result.
+        result.test_config = self.test_config
+        result.test_set = self.test_set
+        if result.all_passed():
+            match_index.record(suite_name, full_test_file, result.matched_expected_version)
+        return result
 
-            if result.get_name() in self.metadata_map:
-                result.test_metadata = self.metadata_map[result.get_name()]
-            self.add_test_result(t.test_file, result)
+    def restore_cached_results(self, test_list):
+        """With --incremental, put the result files of tests that passed with the same inputs in an earlier run where
+        tabquery would write them. Return the tests that still need to run."""
+        if self.incremental_cache is None or self.error_state is not None:
+            return test_list
+        try:
+            environment_fingerprint = self.incremental_cache.get_environment_fingerprint(self)
+        except OSError as e:
+            logging.warning(self.get_thread_msg() + "Can't reuse earlier results: " + str(e))
+            return test_list
+        if environment_fingerprint is None:
+            return test_list
+
+        tests_to_run = []
+        for f in test_list:
+            fingerprint = self.incremental_cache.get_test_fingerprint(environment_fingerprint, f.test_path)
+            output_path = self.test_set.get_expected_output_file_path(f.test_path, self.test_config.output_dir)
+            if fingerprint:
+                self.test_fingerprints[f.test_path] = fingerprint
+                if output_path and self.incremental_cache.restore(fingerprint, output_path):
+                    self.cached_tests.add(f.test_path)
+                    continue
+            tests_to_run.append(f)
+        if self.cached_tests:
+            logging.info(self.get_thread_msg() + "Reusing {} of {} results in {}".format(
+                len(self.cached_tests), len(test_list), self.test_name))
+        return tests_to_run
+
+    def save_cached_result(self, test_file, actual_file):
+        """Save the result file of a test that passed so later --incremental runs can reuse it."""
+        fingerprint = self.test_fingerprints.get(test_file)
+        if self.incremental_cache is not None and fingerprint and test_file not in self.cached_tests:
+            self.incremental_cache.save(fingerprint, actual_file)
 
     def setup_files(self, test_list):
         # Setup a subdirectory for the log files.
@@ -255,8 +339,47 @@ class BatchQueueWork(object):
         self.load_test_metadata()
 
     def run_process(self, cmdline):
+        if self.test_config.persistent_tabquery:
+            self.cmd_output = run_tabquery_batch(cmdline, self.timeout_seconds)
+            return
         self.cmd_output = str(subprocess.check_output(cmdline, stderr=subprocess.STDOUT, universal_newlines=True,
                                                       timeout=self.timeout_seconds))
+
+    def run_process_and_stream_results(self, cmdline, test_list):
+        """Run tabquery while a background thread compares each result file as soon as tabquery finishes writing it,
+        so comparing overlaps with running the rest of the queries. Tabquery runs on this thread and process errors are
+        raised as they are by run_process."""
+        process_done = threading.Event()
+        compare_errors = []
+
+        def compare_finished_files():
+            try:
+                watcher = ResultFileWatcher()
+                pending = [(test_count, f,
+                            self.test_set.get_expected_output_file_path(f.test_path, self.test_config.output_dir))
+                           for test_count, f in enumerate(test_list)]
+                while pending and not process_done.wait(STREAM_POLL_SECONDS):
+                    ready = watcher.get_finished_files([output_path for test_count, f, output_path in pending])
+                    for test_count, f, output_path in pending:
+                        if output_path in ready:
+                            self.process_test_result(f, test_count)
+                            self.streamed_tests.add(f.test_path)
+                    pending = [p for p in pending if p[2] not in ready]
+            except Exception as e:
+                compare_errors.append(e)
+
+        compare_thread = threading.Thread(target=compare_finished_files)
+        compare_thread.daemon = True
+        compare_thread.start()
+        try:
+            self.run_process(cmdline)
+        finally:
+            process_done.set()
+            compare_thread.join()
+
+        if compare_errors:
+            raise compare_errors[0]
+
     def run(self, test_list):
 
         if self.test_set.test_is_enabled is False:
@@ -275,7 +398,10 @@ class BatchQueueWork(object):
 
         start_time = time.perf_counter()
         try:
-            self.run_process(cmdline)
+            if self.test_config.stream_results:
+                self.run_process_and_stream_results(cmdline, test_list)
+            else:
+                self.run_process(cmdline)
         except subprocess.CalledProcessError as e:
             error_output = str(e.output)
             logging.error(
@@ -308,7 +434,68 @@ class BatchQueueWork(object):
         return total_time_ms
 
 
-def do_work(work: BatchQueueWork):
+class ComparisonWork(object):
+    """What compare_results needs from a BatchQueueWork, for comparing a test in another process."""
+
+    def __init__(self, work: BatchQueueWork, test_file):
+        self.test_config = work.test_config
+        self.test_set = work.test_set
+        self.thread_id = work.thread_id
+        self.verbose = work.verbose
+        if hasattr(work, 'keep_actual_file'):
+            self.keep_actual_file = work.keep_actual_file
+        self.incremental_cache = work.incremental_cache
+        self.fingerprint = work.test_fingerprints.get(test_file)
+        self.cached = test_file in work.cached_tests
+
+    def get_thread_msg(self):
+        return "Thread-[{0}] ".format(self.thread_id)
+
+    def save_cached_result(self, test_file, actual_file):
+        if self.incremental_cache is not None and self.fingerprint and not self.cached:
+            self.incremental_cache.save(self.fingerprint, actual_file)
+
+
+def compare_results_in_process(test_name, test_file, full_test_file, work: ComparisonWork,
+                               last_match: Optional[int]) -> TestResult:
+    """Runs in the compare pool. The expected file that matched last time is passed in since the match index lives
+    in the main process, which records the new match."""
+    match_index = ExpectedMatchIndex()
+    if last_match is not None:
+        match_index.record(work.test_config.suite_name, full_test_file, last_match)
+    return compare_results(test_name, test_file, full_test_file, work, match_index)
+
+
+class ResultFileWatcher(object):
+    """Finds result files that tabquery has finished writing. A file is finished when its size didn't change since the
+    last check and it ends with the closing results tag."""
+
+    def __init__(self):
+        self.last_sizes = {}
+
+    def get_finished_files(self, paths):
+        finished = set()
+        for path in paths:
+            try:
+                size = os.stat(path).st_size
+            except OSError:
+                continue
+            if size and self.last_sizes.get(path) == size and self.ends_with_closing_tag(path, size):
+                finished.add(path)
+            self.last_sizes[path] = size
+        return finished
+
+    @staticmethod
+    def ends_with_closing_tag(path, size):
+        try:
+            with open(path, 'rb') as result_file:
+                result_file.seek(max(0, size - 64))
+                return result_file.read().rstrip().endswith(b'</results>')
+        except OSError:
+            return False
+
+
+def do_work(work: BatchQueueWork, test_list=None):
     logging.debug(work.get_thread_msg() + "Running test:" + work.test_name)
     if work.test_set.test_is_enabled is False:
         work.error_state = TestErrorDisabledTest()
@@ -316,8 +503,13 @@ def do_work(work: BatchQueueWork):
     if work.test_set.test_is_skipped is True:
         work.error_state = TestErrorSkippedTest()
 
-    final_test_list = work.test_set.generate_test_file_list()
-    work.run(final_test_list)
+    final_test_list = work.test_set.generate_test_file_list() if test_list is None else test_list
+    tests_to_run = work.restore_cached_results(final_test_list)
+    if tests_to_run or not final_test_list:
+        work.run(tests_to_run)
+    else:
+        # Every result was reused, so there is nothing for tabquery to run.
+        work.load_test_metadata()
     work.process_test_results(final_test_list)
 
     # If everything passed delete the log files so we don't collect a bunch of useless logs.
@@ -369,7 +561,7 @@ def save_results_diff(actual_file, diff_file, expected_file, diff_string):
     try:
         f = open(diff_file, 'w')
         f.write("Diff of [{}] and [{}].\n".format(actual_file, expected_file))
-        f.write(diff_string)
+        f.write(str(diff_string))
         f.close()
     except:
         pass
@@ -386,7 +578,8 @@ def compare_results(
         test_name,
         test_file,
         full_test_file,
-        work
+        work,
+        match_index: Optional[ExpectedMatchIndex] = None
 ) -> TestResult:
     """Return a TestResult object that specifies what was tested and whether it passed.
        test_file is the full path to the test file (base test name without any logical specification).
@@ -407,15 +600,18 @@ def compare_results(
         return result
 
     try:
-        actual_xml = parse(actual_file).getroot()
-        result.add_test_results(actual_xml, actual_file)
+        result.add_test_results_from_file(actual_file, actual_file)
     except ParseError as e:
         logging.error(work.get_thread_msg() + "Exception parsing actual file: " + actual_file + " exception: " + str(e))
         result.error_status = TestErrorMissingActual()
         return result
 
-    expected_file_version: int = 0
-    for expected_file in expected_files:
+    # Start with the expected file that matched last time. Most tests with several expected files match the same one
+    # every run, so the others don't need to be compared.
+    if match_index is None:
+        match_index = get_expected_match_index()
+    ordered_expected_files = match_index.order_expected_files(test_config.suite_name, full_test_file, expected_files)
+    for expected_file_version, expected_file in ordered_expected_files:
         if not os.path.isfile(expected_file):
             logging.error(work.get_thread_msg() + "Did not find expected file " + expected_file)
             if test_config.generate_expected:
@@ -436,7 +632,8 @@ def compare_results(
         logging.debug(work.get_thread_msg() + " Comparing " + actual_file + " to " + expected_file)
         expected_output = TestResult(test_config=test_config)
         try:
-            expected_output.add_test_results(parse(expected_file).getroot(), '')
+            expected_cases = load_expected_results(expected_file, test_config.cache_expected)
+            expected_output.add_parsed_test_cases(expected_cases, '')
         except ParseError as e:
             logging.error(
                 work.get_thread_msg() + "Exception parsing expected file: " + expected_file + " exception: " + str(e))
@@ -447,6 +644,8 @@ def compare_results(
         if result.all_passed():
             logging.debug(work.get_thread_msg() + " Results match expected number: " + str(expected_file_version))
             result.matched_expected_version = expected_file_version
+            match_index.record(test_config.suite_name, full_test_file, expected_file_version)
+            work.save_cached_result(full_test_file, actual_file)
             try:
                 if not work.verbose:
                     if not hasattr(work, 'keep_actual_file'):
@@ -458,9 +657,6 @@ def compare_results(
         else:
             result.error_status = TestErrorResults()
 
-        # Try another possible expected file.
-        expected_file_version = expected_file_version + 1
-
     # Exhausted all expected files. The test failed.
     if test_config.generate_expected:
         actual_file, actual_diff_file, setup, expected_files, next_path = get_test_file_paths(test_file_root,
@@ -486,8 +682,8 @@ def write_json_results(all_test_results):
     json_file.close()
 
 
-def write_standard_test_output(all_test_results: Dict[str, TestResult], output_dir: str):
-    """Write the standard output to JSON. """
+def get_standard_test_output(all_test_results: Dict[str, TestResult]) -> str:
+    """Return the standard output as a JSON string."""
     passed = [x for x in all_test_results.values()
               if x.all_passed() is True
               and x.test_set.test_is_enabled
@@ -507,7 +703,15 @@ def write_standard_test_output(all_test_results: Dict[str, TestResult], output_d
               'skipped_tests': skipped,
               'failed_tests': failed
               }
-    json_str = json.dumps(output, cls=TestOutputJSONEncoder)
+    return json.dumps(output, cls=TestOutputJSONEncoder)
+
+
+def write_standard_test_output(all_test_results: Dict[str, TestResult], output_dir: str):
+    """Write the standard output to JSON. """
+    save_standard_test_output(get_standard_test_output(all_test_results), output_dir)
+
+
+def save_standard_test_output(json_str: str, output_dir: str):
     json_file_path = os.path.join(output_dir, 'tdvt_output.json')
     try:
         json_file = open(json_file_path, 'w', encoding='utf8')
@@ -663,6 +867,11 @@ def return_csv_dialect(is_perf_run: bool = False):
         return 'tdvt'
 
 
+def get_functions_count(functions) -> int:
+    """The number of functions in the Functions column, counted the way it reads back from the csv file."""
+    return len(('' if functions is None else str(functions)).split(','))
+
+
 def get_csv_header_data(all_test_results, is_perf_run: bool) -> List[str]:
     if is_perf_run:
         csv_header = PERFLAB_CSV_HEADERS
@@ -683,56 +892,77 @@ def get_csv_header_data(all_test_results, is_perf_run: bool) -> List[str]:
     return csv_header
 
 
-def write_csv_test_output(
+def get_csv_test_output(
     all_test_results: Dict[str, TestResult],
     tds_file: str,
-    skip_header: bool,
-    output_dir: str,
-) -> Optional[Tuple[int, int, int, int]]:
-    csv_file_path = os.path.join(output_dir, 'test_results.csv')
-    try:
-        file_out = open(csv_file_path, 'w', encoding='utf8')
-    except IOError:
-        logging.error("Could not open output file [{0}].".format(csv_file_path))
-        return
-
-    # set writer to use correct csv dialect
+) -> Tuple[List[str], List[List[str]], Tuple[int, int, int, int]]:
+    """Return the csv header, the rows and the test counts. The values are strings, the way they read back from the
+    csv file."""
     is_perf_run = list(all_test_results.values())[0].test_config.run_as_perf
-    csv_out = csv.writer(file_out, dialect=return_csv_dialect(is_perf_run), quoting=csv.QUOTE_MINIMAL)
-
     tdsname = os.path.splitext(os.path.split(tds_file)[1])[0]
-    # Write the csv file.
     total_failed_tests = 0
     total_skipped_tests = 0
     total_disabled_tests = 0
     total_tests = 0
 
-    # get and write csv_header
     csv_header = get_csv_header_data(all_test_results, is_perf_run)
 
-    if not skip_header:
-        csv_out.writerow(csv_header)
-
+    rows = []
     for path, test_result in all_test_results.items():
-        generated_sql = ''
         test_name = test_result.get_name() if test_result.get_name() else path
         if not test_result or not test_result.get_test_case_count():
-            csv_out.writerow(get_csv_row_data(tdsname, test_name, path, test_result))
+            rows.append(get_csv_row_data(tdsname, test_name, path, test_result))
             if not test_result.all_passed():
                 total_failed_tests += 1
             total_tests += 1
         else:
-            test_case_index = 0
             total_failed_tests += test_result.get_failure_count()
             total_skipped_tests += test_result.get_skipped_count()
             total_disabled_tests += test_result.get_disabled_count()
             total_tests += test_result.get_test_case_count()
             for case_index in range(0, test_result.get_test_case_count()):
-                csv_out.writerow(get_csv_row_data(tdsname, test_name, path, test_result, case_index))
+                rows.append(get_csv_row_data(tdsname, test_name, path, test_result, case_index))
+    rows = [['' if value is None else str(value) for value in row] for row in rows]
+
+    return csv_header, rows, (total_failed_tests, total_skipped_tests, total_disabled_tests, total_tests)
+
+
+def save_csv_test_output(csv_header: List[str], rows: List[List[str]], is_perf_run: bool, skip_header: bool,
+                         output_dir: str) -> bool:
+    csv_file_path = os.path.join(output_dir, 'test_results.csv')
+    try:
+        file_out = open(csv_file_path, 'w', encoding='utf8')
+    except IOError:
+        logging.error("Could not open output file [{0}].".format(csv_file_path))
+        return False
+
+    # set writer to use correct csv dialect
+    with file_out:
+        csv_out = csv.writer(file_out, dialect=return_csv_dialect(is_perf_run), quoting=csv.QUOTE_MINIMAL)
+        if not skip_header:
+            csv_out.writerow(csv_header)
+        csv_out.writerows(rows)
+    return True
 
-    file_out.close()
 
-    return total_failed_tests, total_skipped_tests, total_disabled_tests, total_tests
+def write_csv_test_output(
+    all_test_results: Dict[str, TestResult],
+    tds_file: str,
+    skip_header: bool,
+    output_dir: str,
+) -> Optional[Tuple[int, int, int, int]]:
+    csv_header, rows, counts = get_csv_test_output(all_test_results, tds_file)
+    is_perf_run = list(all_test_results.values())[0].test_config.run_as_perf
+    if not save_csv_test_output(csv_header, rows, is_perf_run, skip_header, output_dir):
+        return
+    return counts
+
+
+def get_test_output(all_test_results: Dict[str, TestResult], tds_file: str):
+    """Return the JSON string, csv header, csv rows and test counts of a test set."""
+    json_str = get_standard_test_output(all_test_results)
+    csv_header, rows, counts = get_csv_test_output(all_test_results, tds_file)
+    return json_str, csv_header, rows, counts
 
 
 def process_test_results(
@@ -740,26 +970,40 @@ def process_test_results(
         tds_file,
         skip_header,
         output_dir,
+        results_sink=None,
+        write_files=True,
 ) -> Optional[Tuple[int, int, int, int]]:
+    """Write tdvt_output.json and test_results.csv to output_dir and/or pass the JSON string, csv header and sorted csv
+    rows to results_sink, which collects the results of all the test sets in memory."""
     if not all_test_results:
         return 0, 0, 0, 0
-    write_standard_test_output(all_test_results, output_dir)
-    return write_csv_test_output(all_test_results, tds_file, skip_header, output_dir)
-
-
-def generate_files(ds_registry, force=False):
-    """Generate the config files and logical query test permutations."""
+    if results_sink is None:
+        write_standard_test_output(all_test_results, output_dir)
+        return write_csv_test_output(all_test_results, tds_file, skip_header, output_dir)
+
+    json_str, csv_header, rows, counts = get_test_output(all_test_results, tds_file)
+    if write_files:
+        save_standard_test_output(json_str, output_dir)
+        is_perf_run = list(all_test_results.values())[0].test_config.run_as_perf
+        save_csv_test_output(csv_header, rows, is_perf_run, skip_header, output_dir)
+    results_sink(json_str, csv_header, rows)
+    return counts
+
+
+def generate_files(ds_registry, force=False, processes: Optional[int] = None):
+    """Generate the config files and logical query test permutations. processes opts in to writing them from a pool of
+    processes."""
     logical_input = get_path('logicaltests/generate/input/')
     logical_output = get_path('logicaltests/setup')
     logging.debug("Checking generated logical setup files...")
-    generate_logical_files(logical_input, logical_output, ds_registry, force)
+    generate_logical_files(logical_input, logical_output, ds_registry, force, processes)
 
     root_directory = get_local_logical_test_dir()
     if os.path.isdir(root_directory):
         logical_input = os.path.join(root_directory, 'generate/input/')
         logical_output = os.path.join(root_directory, 'setup/')
         logging.debug("Checking generated logical setup files...")
-        generate_logical_files(logical_input, logical_output, ds_registry, force)
+        generate_logical_files(logical_input, logical_output, ds_registry, force, processes)
     return 0
 
 
@@ -779,23 +1023,18 @@ def run_diff(test_config, diff):
         logging.debug('expected_path: ' + f)
         if os.path.isfile(f) and os.path.isfile(actual):
             logging.debug("Diffing " + actual + " and " + f)
-            actual_xml = None
-            expected_xml = None
+            result = TestResult(test_config=test_config)
             try:
-                actual_xml = parse(actual).getroot()
+                result.add_test_results_from_file(actual, actual)
             except ParseError as e:
                 logging.error("Exception parsing actual file: " + actual + " exception: " + str(e))
                 continue
+            expected_output = TestResult(test_config=test_config)
             try:
-                expected_xml = parse(f).getroot()
+                expected_output.add_parsed_test_cases(load_expected_results(f, test_config.cache_expected), '')
             except ParseError as e:
                 logging.error("Exception parsing expected file: " + f + " exception: " + str(e))
                 continue
-
-            result = TestResult(test_config=test_config)
-            result.add_test_results(actual_xml, actual)
-            expected_output = TestResult(test_config=test_config)
-            expected_output.add_test_results(expected_xml, '')
             num_diffs, diff_string = result.diff_test_results(expected_output)
             logging.debug(diff_string)
             diff_count_map[f] = sum(num_diffs)
@@ -805,9 +1044,63 @@ def run_diff(test_config, diff):
     return 0
 
 
+def split_test_list(test_list, shard_count: int, min_tests_per_shard: Optional[int] = None):
+    """Split the tests into at most shard_count shards with at least min_tests_per_shard tests each. Tests are dealt
+    out in turn so expensive neighbouring tests (ie all of the date tests) end up in different shards."""
+    if min_tests_per_shard is None:
+        min_tests_per_shard = SHARD_MIN_TESTS
+    shard_count = min(shard_count, len(test_list) // min_tests_per_shard)
+    if shard_count <= 1:
+        return [test_list]
+    return [test_list[i::shard_count] for i in range(shard_count)]
+
+
+def get_test_shards(test_set: TestSet, test_config: TdvtInvocation) -> Optional[List[list]]:
+    """Return the test lists of the shards of a test set, or None if it runs as one batch."""
+    if test_config.shard_count > 1 and test_config.output_dir and test_set.test_is_enabled \
+            and not test_set.test_is_skipped:
+        shards = split_test_list(test_set.generate_test_file_list(), test_config.shard_count)
+        if len(shards) > 1:
+            return shards
+    return None
+
+
+def run_test_shard(test_set: TestSet, test_config: TdvtInvocation, shard_id: int,
+                   shard_tests) -> Dict[str, TestResult]:
+    """Run one shard with its own test list, output directory and tabquery process."""
+    shard_config = copy.deepcopy(test_config)
+    shard_config.output_dir = os.path.join(test_config.output_dir, SHARD_DIR_PREFIX + str(shard_id))
+    os.makedirs(shard_config.output_dir, exist_ok=True)
+    work = BatchQueueWork(shard_config, test_set)
+    work.thread_id = test_config.thread_id
+    do_work(work, shard_tests)
+    return work.results
+
+
+def merge_shard_results(shards: List[list], shard_results: List[Dict[str, TestResult]]) -> Dict[str, TestResult]:
+    """Merge the results back in the original test order so the output files look the same as an unsharded run.
+    split_test_list dealt the tests out in turn, so they are taken back in turn."""
+    shard_results = [dict(results) for results in shard_results]
+    all_test_results = {}
+    for i in range(max(len(shard_tests) for shard_tests in shards)):
+        for shard_tests, results in zip(shards, shard_results):
+            if i < len(shard_tests) and shard_tests[i].test_path in results:
+                all_test_results[shard_tests[i].test_path] = results.pop(shard_tests[i].test_path)
+    for results in shard_results:
+        all_test_results.update(results)
+    return all_test_results
+
+
 def run_tests_impl(test_set: TestSet, test_config: TdvtInvocation):
     all_test_results = {}
-    all_work = []
+
+    shards = get_test_shards(test_set, test_config)
+    if shards is not None:
+        # Outside of the test set queue the shards run one after the other. The queue runs them in parallel, see
+        # TestRunner in tdvt.py.
+        logging.debug("Running {} in {} shards.".format(test_set.config_name, len(shards)))
+        return merge_shard_results(shards, [run_test_shard(test_set, test_config, shard_id, shard_tests)
+                                            for shard_id, shard_tests in enumerate(shards)])
 
     # Build the queue of work.
     work = BatchQueueWork(copy.deepcopy(test_config), test_set)
@@ -831,19 +1124,22 @@ def run_tests_serial(tests):
     return all_test_results
 
 
-def run_tests(tdvt_test_config: TdvtInvocation, test_set: TestSet):
-    # See if we need to generate test setup files.
-    root_directory = get_root_dir()
-    output_dir = tdvt_test_config.output_dir if tdvt_test_config.output_dir else root_directory
+def set_tds_full_path(tdvt_test_config: TdvtInvocation):
+    tdvt_test_config.tds = get_tds_full_path(get_root_dir(), tdvt_test_config.tds)
 
-    tds_file = get_tds_full_path(root_directory, tdvt_test_config.tds)
-    tdvt_test_config.tds = tds_file
 
-    tds_file = tdvt_test_config.tds
+def process_run_results(tdvt_test_config: TdvtInvocation, all_test_results: Dict[str, TestResult], results_sink=None):
+    output_dir = tdvt_test_config.output_dir if tdvt_test_config.output_dir else get_root_dir()
+    # With a results sink the per test set files are only needed to debug a run that keeps its temp dirs.
+    write_files = results_sink is None or tdvt_test_config.leave_temp_dir
+    return process_test_results(all_test_results, tdvt_test_config.tds, tdvt_test_config.noheader, output_dir,
+                                results_sink, write_files)
 
-    all_test_results = run_tests_impl(test_set, tdvt_test_config)
 
-    return process_test_results(all_test_results, tds_file, tdvt_test_config.noheader, output_dir)
+def run_tests(tdvt_test_config: TdvtInvocation, test_set: TestSet, results_sink=None):
+    set_tds_full_path(tdvt_test_config)
+    all_test_results = run_tests_impl(test_set, tdvt_test_config)
+    return process_run_results(tdvt_test_config, all_test_results, results_sink)
 
 
 def run_connectors_test_core(conn_test_name, conn_test_file, conn_test_password_file = None):
@@ -0,0 +1,116 @@
+"""
+    Index of the test files on disk.
+
+    Every TestSet finds its tests by listing or globbing the exprtests and logicaltests directories, and 'tdvt list',
+    enqueueing the tests and running them each do it again for every datasource. The index lists each test directory
+    once and keeps the names of its files. A directory is listed again when its modification time changes. The index is
+    shared by all the TestSets of the process and saved to tdvt_cache/test_index.json, so the next run only lists the
+    directories that changed.
+"""
+
+import fnmatch
+import glob
+import json
+import logging
+import os
+import threading
+from typing import Dict, List, Optional
+
+from .resources import get_local_cache_dir
+
+TEST_INDEX_FILE = 'test_index.json'
+TEST_INDEX_VERSION = 2
+
+
+class TestIndex(object):
+    """The files of each test directory, keyed by directory path and checked against its modification time."""
+
+    def __init__(self, path: str = ''):
+        self.path = path
+        self.dirs: Dict[str, dict] = {}
+        self.changed = False
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def load(path: str = '') -> 'TestIndex':
+        if not path:
+            path = os.path.join(get_local_cache_dir(), TEST_INDEX_FILE)
+        index = TestIndex(path)
+        try:
+            with open(path, 'r', encoding='utf8') as index_file:
+                saved = json.load(index_file)
+            if saved.get('version') == TEST_INDEX_VERSION:
+                index.dirs = saved['dirs']
+        except FileNotFoundError:
+            pass
+        except (IOError, ValueError, AttributeError, KeyError) as e:
+            logging.warning("Ignoring test index file {}: {}".format(path, e))
+        return index
+
+    def save(self):
+        with self.lock:
+            if not self.changed or not self.path:
+                return
+            saved = json.dumps({'version': TEST_INDEX_VERSION, 'dirs': self.dirs}, sort_keys=True)
+            self.changed = False
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, 'w', encoding='utf8') as index_file:
+                index_file.write(saved)
+        except IOError as e:
+            logging.warning("Could not save test index file {}: {}".format(self.path, e))
+
+    def get_dir_entry(self, dir_path: str) -> Optional[dict]:
+        """Return the index entry of a directory, listing it if it changed. None if it isn't a directory."""
+        dir_path = os.path.abspath(dir_path)
+        try:
+            mtime_ns = os.stat(dir_path).st_mtime_ns
+            with self.lock:
+                entry = self.dirs.get(dir_path)
+                if entry is not None and entry['mtime_ns'] == mtime_ns:
+                    return entry
+            names = sorted(e.name for e in os.scandir(dir_path) if e.is_file())
+        except (NotADirectoryError, FileNotFoundError):
+            return None
+        except OSError as e:
+            logging.debug("Can't index test directory {}: {}".format(dir_path, e))
+            return None
+
+        logging.debug("Indexing test directory " + dir_path)
+        entry = {'mtime_ns': mtime_ns, 'files': names}
+        with self.lock:
+            self.dirs[dir_path] = entry
+            self.changed = True
+        return entry
+
+    def list_files(self, dir_path: str) -> List[str]:
+        """Return the paths of the files in a directory, like os.listdir filtered with os.path.isfile."""
+        entry = self.get_dir_entry(dir_path)
+        if entry is None:
+            return []
+        return [os.path.join(dir_path, name) for name in entry['files']]
+
+    def glob(self, pattern: str) -> List[str]:
+        """glob.glob for the patterns TestSets use, where only the file name has wildcards. Other patterns are passed
+        to glob.glob."""
+        dir_path, name_pattern = os.path.split(pattern)
+        if glob.has_magic(dir_path) or not name_pattern:
+            return glob.glob(pattern)
+        entry = self.get_dir_entry(dir_path or os.curdir)
+        if entry is None:
+            return []
+        # glob doesn't match hidden files unless the pattern starts with a dot.
+        names = [name for name in entry['files'] if name_pattern.startswith('.') or not name.startswith('.')]
+        return [os.path.join(dir_path, name) for name in fnmatch.filter(names, name_pattern)]
+
+
+_test_index: Optional[TestIndex] = None
+_test_index_lock = threading.Lock()
+
+
+def get_test_index() -> TestIndex:
+    global _test_index
+    with _test_index_lock:
+        if _test_index is None:
+            _test_index = TestIndex.load()
+        return _test_index
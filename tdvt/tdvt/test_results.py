@@ -1,9 +1,17 @@
 """ Test result and configuration related classes. """
+import hashlib
 import logging
 import math
 import json
 import re
-from typing import Optional
+from typing import List, Optional
+
+from defusedxml.ElementTree import iterparse
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 from .config_gen.tdvtconfig import TdvtInvocation
 from .config_gen.test_config import TestSet
@@ -11,6 +19,7 @@ from .config_gen.test_config import TestSet
 TEST_DISABLED = "Test disabled in .ini file."
 TEST_SKIPPED = "Test not run because smoke tests failed."
 TEST_NOT_RUN = "Not run"
+DIFF_MAX_VALUE_MISMATCHES = 1000
 
 class TestMetadata(object):
     """Simple struct containing lists of categories and functions tested for a single test"""
@@ -36,6 +45,216 @@ class TestMetadata(object):
     def get_priority(self):
         return self.priority
 
+class ResultTable(object):
+    """The values of a <table> node, flattened in document order. Holding these instead of the XML elements keeps a
+    test case to a list of strings no matter how large the result file is."""
+    __slots__ = ('values', 'tuple_count', 'column_types', 'digest')
+
+    def __init__(self, values=None, tuple_count=0, column_types=None):
+        self.values = values if values is not None else []
+        self.tuple_count = tuple_count
+        self.column_types = column_types if column_types is not None else []
+        self.digest = None
+
+    def get_digest(self):
+        """Hash of the values, computed once. Tables with the same digest have the same values in the same order.
+        Values can't contain control characters in XML, so they are used as separators and for missing text."""
+        if self.digest is None:
+            text = str(len(self.values)) + '\x00' + '\x00'.join('\x01' if v is None else v for v in self.values)
+            self.digest = hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+        return self.digest
+
+    @staticmethod
+    def from_element(table):
+        result_table = ResultTable()
+        for column in table.findall('schema/column'):
+            result_table.column_types.append(column.attrib.get('return-type'))
+        for t in table.findall('tuple'):
+            result_table.add_tuple(t)
+        return result_table
+
+    def add_tuple(self, tuple_node):
+        self.digest = None
+        self.tuple_count += 1
+        for v in tuple_node.findall('value'):
+            self.values.append(v.text)
+
+
+def iter_test_nodes(results_file):
+    """Yield (index, test node, ResultTable or None) for each child of the <results> root of a results file.
+
+    Tuples are copied into the ResultTable and dropped as soon as they are parsed, and each test node is removed from
+    the tree after it is yielded, so only one test node without its tuples is held in memory at a time.
+    """
+    root = None
+    depth = 0
+    index = 0
+    table = None
+    table_node = None
+    in_table = False
+    for event, elem in iterparse(results_file, events=('start', 'end')):
+        if event == 'start':
+            depth += 1
+            if root is None:
+                root = elem
+            elif depth == 2:
+                table = None
+            elif depth == 3:
+                # Like find('table'), only the first table of a test counts.
+                in_table = elem.tag == 'table' and table is None
+                if in_table:
+                    table = ResultTable()
+                    table_node = elem
+            continue
+
+        depth -= 1
+        if depth == 3 and in_table and elem.tag == 'tuple':
+            table.add_tuple(elem)
+            table_node.remove(elem)
+        elif depth == 2 and in_table:
+            table.column_types = [column.attrib.get('return-type') for column in elem.findall('schema/column')]
+            in_table = False
+        elif depth == 1:
+            yield index, elem, table
+            index += 1
+            root.remove(elem)
+
+
+def clean_float_value(value: str) -> float:
+    return float(value.replace('"', '').replace('&quot;', ''))
+
+
+def compare_float_values(actual_values: List[str], expected_values: List[str], tolerance: float) -> List[Optional[bool]]:
+    """Compare float values with math.isclose(rel_tol=tolerance) in one pass. Uses NumPy when it's installed.
+    Returns None for the pairs that need TestResult.actual_expected_comparison, ie nulls and values that aren't
+    numbers."""
+    matches: List[Optional[bool]] = [None] * len(actual_values)
+    positions = []
+    actual_floats = []
+    expected_floats = []
+    for i, (actual_value, expected_value) in enumerate(zip(actual_values, expected_values)):
+        if actual_value is None or expected_value is None or expected_value == '%null%':
+            continue
+        try:
+            actual_float = clean_float_value(actual_value)
+            expected_float = clean_float_value(expected_value)
+        except ValueError:
+            continue
+        positions.append(i)
+        actual_floats.append(actual_float)
+        expected_floats.append(expected_float)
+
+    if numpy is not None and positions:
+        a = numpy.array(actual_floats, dtype=numpy.float64)
+        b = numpy.array(expected_floats, dtype=numpy.float64)
+        # Same as math.isclose: equal values (including infinities) match, otherwise both have to be finite and within
+        # the tolerance of either value.
+        with numpy.errstate(invalid='ignore', over='ignore'):
+            diff = numpy.abs(a - b)
+            close = (a == b) | (numpy.isfinite(a) & numpy.isfinite(b) &
+                                ((diff <= numpy.abs(tolerance * b)) | (diff <= numpy.abs(tolerance * a))))
+        close = close.tolist()
+    else:
+        close = [math.isclose(a, b, rel_tol=tolerance) for a, b in zip(actual_floats, expected_floats)]
+
+    for i, is_close in zip(positions, close):
+        matches[i] = is_close
+    return matches
+
+
+class ResultDiff(object):
+    """The differences found by TestResult.diff_test_results. Text and mismatched values are recorded as they are
+    found and only formatted when the diff is converted to a string, ie when it is saved next to the actual file.
+    Only the first max_value_mismatches mismatched values are kept, the rest are counted."""
+
+    def __init__(self, max_value_mismatches=DIFF_MAX_VALUE_MISMATCHES):
+        self.records = []
+        self.max_value_mismatches = max_value_mismatches
+        self.value_mismatches = 0
+        self.omitted_value_mismatches = 0
+
+    def add_text(self, text):
+        self.records.append(text)
+
+    def add_value_mismatch(self, actual_value, expected_value):
+        if self.value_mismatches >= self.max_value_mismatches:
+            self.omitted_value_mismatches += 1
+            return
+        self.value_mismatches += 1
+        self.records.append((actual_value, expected_value))
+
+    def replace_with_text(self, text):
+        self.records = [text]
+        self.value_mismatches = 0
+        self.omitted_value_mismatches = 0
+
+    def __str__(self):
+        parts = []
+        for record in self.records:
+            if isinstance(record, tuple):
+                parts.append("\t <<<< >>>> \n\tactual: {}\n\texpected: {}\n".format(*record))
+            else:
+                parts.append(record)
+        if self.omitted_value_mismatches:
+            parts.append("\t{} more mismatched values not shown.\n".format(self.omitted_value_mismatches))
+        return ''.join(parts)
+
+
+class ParsedTestCase(object):
+    """One test node of a results file. These don't depend on the test config so they can be shared between runs."""
+    __slots__ = ('name', 'id', 'sql', 'query_time', 'error_message', 'error_type', 'table', 'tolerance')
+
+    def __init__(self, name, id, sql, query_time, error_message, error_type, table, tolerance):
+        self.name = name
+        self.id = id
+        self.sql = sql
+        self.query_time = query_time
+        self.error_message = error_message
+        self.error_type = error_type
+        self.table: Optional[ResultTable] = table
+        self.tolerance = tolerance
+
+    @staticmethod
+    def from_node(test_child, test_id, table=None):
+        node = test_child.find('error')
+        error_msg = node.text if node is not None else ''
+
+        node = test_child.find('error-type')
+        error_type = node.text.strip() if node is not None else ''
+
+        node = test_child.find('query-time')
+        query_time = 0
+        try:
+            query_time = float(node.text if node is not None else '0')
+        except ValueError:
+            pass
+
+        node = test_child.find('sql')
+        sq = node.text if node is not None else ''
+
+        if table is None:
+            table = test_child.find('table')
+            if table is not None:
+                table = ResultTable.from_element(table)
+
+        return ParsedTestCase(test_child.get('name'), test_id, sq, query_time, error_msg, error_type, table,
+                              test_child.get('tolerance'))
+
+
+def read_test_cases(test_nodes):
+    """Return the ParsedTestCase for each named node of (index, test node, ResultTable or None)."""
+    test_cases = []
+    for i, test_child, table in test_nodes:
+        if not test_child.get('name'):
+            continue
+        test_cases.append(ParsedTestCase.from_node(test_child, str(i), table))
+    return test_cases
+
+
+def read_results_file(results_file):
+    return read_test_cases(iter_test_nodes(results_file))
+
+
 class TestCaseResult(object):
     """The actual or expected results of a test run.
 
@@ -47,7 +266,9 @@ class TestCaseResult(object):
         self.name = name
         self.id = id
         self.sql = sql
-        self.table = table
+        if table is not None and not isinstance(table, ResultTable):
+            table = ResultTable.from_element(table)
+        self.table: Optional[ResultTable] = table
         self.execution_time = query_time
         self.error_message = error_msg
         self.error_type: TestErrorState = error_type
@@ -68,15 +289,7 @@ class TestCaseResult(object):
         return self.sql
 
     def get_tuples(self):
-        tuple_list = []
-        tuples = self.table.findall('tuple') if self.table else None
-        if not tuples:
-            return tuple_list
-        for t in tuples:
-            for v in t.findall('value'):
-                tuple_list.append(v.text)
-
-        return tuple_list
+        return list(self.table.values) if self.table is not None else []
 
     def get_error_message(self):
         if self.error_message:
@@ -121,15 +334,7 @@ class TestCaseResult(object):
         return isinstance(self.error_type, TestErrorDisabledTest)
 
     def table_to_json(self):
-        json_str = 'tuple'
-        tuple_list = []
-        tuples = self.table.findall('tuple') if self.table else None
-        if tuples:
-            for t in tuples:
-                for v in t.findall('value'):
-                    tuple_list.append(v.text)
-
-        return {'tuples': tuple_list}
+        return {'tuples': self.get_tuples()}
 
     def __json__(self):
         return {'tested_sql': self.tested_config.tested_sql, 'tested_tuples': self.tested_config.tested_tuples,
@@ -214,6 +419,8 @@ class TestResult(object):
         self.overall_error_message = ''
         self.test_case_map: list[Optional[TestCaseResult]] = []
         self.cmd_output = ''
+        # The result file was reused from an earlier run with --incremental instead of running the test.
+        self.cached = False
         self.relative_test_file = relative_test_file
         self.test_set: Optional[TestSet] = test_set
         self.test_metadata: Optional[TestMetadata] = test_metadata
@@ -303,44 +510,30 @@ class TestResult(object):
         if not test_xml:
             return
 
-        temp_test_cases = []
-        for i in range(0, len(list(test_xml))):
-            test_child = test_xml[i]
-
-            node = test_child.find('error')
-            error_msg = node.text if node is not None else ''
+        self.add_parsed_test_cases(read_test_cases((i, test_child, None) for i, test_child in enumerate(test_xml)),
+                                   actual_path)
 
-            node = test_child.find('error-type')
-            error_type = node.text.strip() if node is not None else ''
+    def add_test_results_from_file(self, results_file, actual_path):
+        """Read the test cases from a results file. The file is parsed incrementally and each test node is discarded
+        once its values are copied out, so memory depends on the size of the results and not the XML document."""
+        self.add_parsed_test_cases(read_results_file(results_file), actual_path)
 
-            node = test_child.find('query-time')
-            query_time = 0
-            try:
-                query_time = float(node.text if node is not None else '0')
-            except ValueError:
-                pass
-
-            node = test_child.find('sql')
-            sq = node.text if node is not None else ''
-
-            test_child_name = test_child.get('name')
-
-            test_child_tolerance = test_child.get('tolerance')
-            if not test_child_name:
-                continue
-            test_result = TestCaseResult(
-                test_child_name,
-                str(i),
-                sq,
-                query_time,
-                error_msg,
-                error_type,
-                test_child.find('table'),
+    def add_parsed_test_cases(self, parsed_test_cases, actual_path):
+        self.path_to_actual = actual_path
+        temp_test_cases = []
+        for case in parsed_test_cases:
+            temp_test_cases.append(TestCaseResult(
+                case.name,
+                case.id,
+                case.sql,
+                case.query_time,
+                case.error_message,
+                case.error_type,
+                case.table,
                 self.test_config,
                 self.test_metadata,
-                test_child_tolerance
-            )
-            temp_test_cases.append(test_result)
+                case.tolerance
+            ))
 
         if temp_test_cases:
             # Clear any dummy place holders.
@@ -388,7 +581,9 @@ class TestResult(object):
 
     def set_best_matching_expected_output(self, expected_output, expected_path, expected_number, diff_counts):
         diff_count = sum(diff_counts)
-        if self.best_matching_expected_results is None or self.diff_count > diff_count:
+        # Expected files aren't always compared in order. Prefer the lower version when they have the same diff count.
+        if self.best_matching_expected_results is None or self.diff_count > diff_count or \
+                (self.diff_count == diff_count and expected_number < self.matched_expected_version):
             self.best_matching_expected_results = expected_output
             self.matched_expected_version = expected_number
             self.set_diff_counts(diff_counts)
@@ -470,11 +665,12 @@ class TestResult(object):
         return case
 
     def diff_test_results(self, expected_output: 'TestResult'):
-        """Compare the actual results to the expected test output based on the given rules."""
+        """Compare the actual results to the expected test output based on the given rules. Returns the diff count
+        of each test case and a ResultDiff, which is only formatted as text if it's converted to a string."""
 
         test_case_count = self.get_test_case_count()
         diff_counts = [0] * test_case_count
-        diff_string = ''
+        diff_string = ResultDiff()
         # Go through all test cases.
         for test_case in range(0, test_case_count):
             expected_testcase_self = expected_output.get_test_case(test_case)
@@ -547,81 +743,102 @@ class TestResult(object):
             self,
             actual_result: TestCaseResult,
             expected_result: TestCaseResult,
-            diff_string: str,
+            diff_string: ResultDiff,
             test_name: str
-    ) -> tuple[int, str]:
+    ) -> tuple[int, ResultDiff]:
         if actual_result.table is None or expected_result is None:
             return (-1, diff_string)
 
         # TODO: add flexibility about tolerance if it exists; maybe we want date stamp flexibility, etc.
 
         expected_result_table = expected_result.table
+        if expected_result_table is None:
+            expected_result_table = ResultTable()
         test_case_tolerance = self.get_test_case_tolerance(expected_result)
 
-        actual_tuples = actual_result.table.findall('tuple')
-        expected_tuples = expected_result_table.findall('tuple')
-        column_return_type = expected_result_table.findall('schema/column')
-
-        if actual_tuples == None and expected_tuples == None:
-            return (0, diff_string)
+        actual_tuple_count = actual_result.table.tuple_count
+        expected_tuple_count = expected_result_table.tuple_count
 
-        diff_string += "\nTuples - " + test_name + "\n"
-        if actual_tuples == None or expected_tuples == None:
-            diff_string += "\tTuples do not exist for one side.\n"
-            return (math.fabs(len(actual_tuples) - len(expected_tuples)), diff_string)
+        diff_string.add_text("\nTuples - " + test_name + "\n")
 
         # Compare all the values for the tuples.
-        if len(actual_tuples) != len(expected_tuples):
-            diff_string += "\tDifferent number of tuples.\n"
+        if actual_tuple_count != expected_tuple_count:
+            diff_string.add_text("\tDifferent number of tuples.\n")
 
-        if not len(actual_tuples):
+        if not actual_tuple_count:
             if actual_result.error_message:
-                diff_string += "\tData source threw an error: {}"\
-                    .format(actual_result.error_message.replace('\n', '').lstrip())
+                diff_string.add_text("\tData source threw an error: {}"
+                                     .format(actual_result.error_message.replace('\n', '').lstrip()))
             else:
-                diff_string += "\tNo 'actual' file tuples.\n"
+                diff_string.add_text("\tNo 'actual' file tuples.\n")
 
-        diff_count = 0
-
-        data_type_list = [item.attrib.get('return-type') for item in column_return_type]
+        data_type_list = list(expected_result_table.column_types)
 
         if not data_type_list:
             data_type_list = [None]
 
-        expected_tuple_list = []
-        for j in expected_tuples:
-            for k in j.findall('value'):
-                expected_tuple_list.append(k.text)
-
-        actual_tuple_list = []
-        for j in actual_tuples:
-            for k in j.findall('value'):
-                actual_tuple_list.append(k.text)
+        expected_tuple_list = expected_result_table.values
+        actual_tuple_list = actual_result.table.values
 
         full_count_data_type = data_type_list * (len(actual_tuple_list) // len(data_type_list))
 
         if len(full_count_data_type) != len(actual_tuple_list):
             logging.error("Data type list and actual tuple list are not the same length.")
-            return -1, 'Error: Data type list and actual tuple list are not the same length.'
+            diff_string.replace_with_text('Error: Data type list and actual tuple list are not the same length.')
+            return -1, diff_string
 
         loose_comparison_enabled = self.test_config.loose_comparison
 
+        # Identical values always compare equal, except for float columns compared with a tolerance where values like
+        # NaN never match. Most passing test cases take this path and skip comparing each value.
+        if not (loose_comparison_enabled and test_case_tolerance and 'float' in data_type_list) and \
+                actual_result.table.get_digest() == expected_result_table.get_digest():
+            return 0, diff_string
+
         diff_count = 0
         diff_count += abs(len(actual_tuple_list) - len(expected_tuple_list))
 
-        for actual_value, expected_value, data_type in zip(
+        float_matches = None
+        if loose_comparison_enabled and test_case_tolerance and test_case_tolerance > 0 and 'float' in data_type_list:
+            float_matches = self.compare_float_columns(actual_tuple_list, expected_tuple_list, data_type_list,
+                                                       test_case_tolerance, test_name)
+
+        for i, (actual_value, expected_value, data_type) in enumerate(zip(
             actual_tuple_list, expected_tuple_list, full_count_data_type
-        ):
-            if not self.actual_expected_comparison(
-                    actual_value, expected_value, test_case_tolerance, loose_comparison_enabled, data_type
-            ):
+        )):
+            match = float_matches[i] if float_matches is not None and i < len(float_matches) else None
+            if match is None:
+                match = self.actual_expected_comparison(
+                    actual_value, expected_value, test_case_tolerance, loose_comparison_enabled, data_type)
+            if not match:
                 diff_count += 1
-                diff_string += "\t <<<< >>>> \n"
-                diff_string += "\tactual: " + actual_value + "\n"
-                diff_string += "\texpected: " + expected_value + "\n"
+                diff_string.add_value_mismatch(actual_value, expected_value)
 
         return diff_count, diff_string
 
+    def compare_float_columns(self, actual_values: List[str], expected_values: List[str], data_type_list: List[str],
+                              tolerance: float, test_name: str) -> List[Optional[bool]]:
+        """Compare the values of the float columns with the tolerance, one column at a time. Returns None for values in
+        other columns and for values actual_expected_comparison has to handle."""
+        column_count = len(data_type_list)
+        row_count = min(len(actual_values), len(expected_values)) // column_count
+        matches: List[Optional[bool]] = [None] * (row_count * column_count)
+        compared = 0
+        mismatched = 0
+        for column, data_type in enumerate(data_type_list):
+            if data_type != 'float':
+                continue
+            end = row_count * column_count
+            column_matches = compare_float_values(actual_values[column:end:column_count],
+                                                  expected_values[column:end:column_count], tolerance)
+            matches[column:end:column_count] = column_matches
+            compared += sum(1 for m in column_matches if m is not None)
+            mismatched += sum(1 for m in column_matches if m is False)
+
+        logging.info("Loose comparison enabled for {}: test case {}, tolerance={}, {} float values compared, {} outside "
+                     "the tolerance.".format(self.name, test_name, tolerance, compared, mismatched))
+        return matches
+
     def get_test_case_tolerance(self, expected_result) -> Optional[float]:
         test_case_tolerance = expected_result.test_tolerance
         if test_case_tolerance:
@@ -636,10 +853,10 @@ class TestResult(object):
         if actual_sql == None and expected_sql == None:
             return (0, diff_string)
 
-        diff_string += "SQL\n"
+        diff_string.add_text("SQL\n")
         if actual_sql == None or expected_sql == None or (actual_sql != expected_sql):
-            diff_string += "<<<<\n" + actual_sql + "\n"
-            diff_string += ">>>>\n" + expected_sql + "\n"
+            diff_string.add_text("<<<<\n" + actual_sql + "\n")
+            diff_string.add_text(">>>>\n" + expected_sql + "\n")
             return (1, diff_string)
 
         return (0, diff_string)
@@ -648,10 +865,10 @@ class TestResult(object):
         if actual_error == None and expected_error == None:
             return (0, diff_string)
 
-        diff_string += "Error\n"
+        diff_string.add_text("Error\n")
         if actual_error == None or expected_error == None or (expected_error not in actual_error):
-            diff_string += "<<<<\n" + actual_error + "\n"
-            diff_string += ">>>>\n" + expected_error + "\n"
+            diff_string.add_text("<<<<\n" + actual_error + "\n")
+            diff_string.add_text(">>>>\n" + expected_error + "\n")
             return (1, diff_string)
 
         return (0, diff_string)
@@ -705,6 +922,8 @@ class TestOutputJSONEncoder(json.JSONEncoder):
                        'functions': obj.test_metadata.concat_functions() if obj.test_metadata else 'unknown',
                        'categories': obj.test_metadata.concat_categories() if obj.test_metadata else 'unknown'
                        }
+        if obj.cached:
+            json_output['cached'] = True
         if obj.all_passed():
             return json_output
 
@@ -26,4 +26,5 @@ import sys
 
 from tdvt import tdvt
 
-tdvt.main()
+if __name__ == '__main__':
+    tdvt.main()
@@ -13,32 +13,55 @@
 
 """
 
+import csv
+import glob
 import io
 import logging
 import platform
 import re
 import shutil
+import sqlite3
 import subprocess
 import sys
+import threading
+import time
+import types
 import unittest
+import zipfile
 
 from pathlib import Path
 from typing import List
 from unittest import mock
 
-from defusedxml.ElementTree import parse
+from defusedxml.ElementTree import ParseError, parse
 
 from tdvt import tdvt_core
+from tdvt.archiver import ResultArchiver
+from tdvt import columnar_output
+from tdvt.incremental import IncrementalResultCache, get_override_paths
+from tdvt.test_index import TestIndex
+from tdvt.process_pool import shutdown_compare_pool
+from tdvt.scheduler import SmokeTestGate, TestSetScheduler, has_connection_errors
+from tdvt.run_history import RunHistory, get_history_rows, print_run_history
 from tdvt.tdvt import enqueue_failed_tests, create_parser, get_ds_list
-from tdvt.config_gen import datasource_list
-from tdvt.config_gen.test_config import ExpressionTestSet, LogicalTestSet, RunTimeTestConfig, TestFile, TabQueryPath
+from tdvt.config_gen import datasource_list, gentests
+from tdvt.constants import CALCS_FIELDS, STAPLES_FIELDS
+from tdvt.config_gen.test_config import ExpressionTestSet, LogicalTestSet, RunTimeTestConfig, TestFile, TabQueryPath, \
+    ExclusionFilter, get_exclusion_filter
 from tdvt.test_results import *
+from tdvt import test_results as tdvt_test_results
+from tdvt.expected_cache import ExpectedMatchIndex, ExpectedResultsCache, get_cost
 from tdvt.tabquery import *
+from tdvt import tabquery_worker
+from tdvt.tabquery_worker import TabqueryWorker, TabqueryWorkerUnsupported, run_tabquery_batch, \
+    shutdown_tabquery_workers
 
 from tdvt.config_gen.test_creator import TestCreator
-from tdvt.setup_env import updated_tds_as_str, get_failed_cmd_line
+from tdvt.setup_env import updated_tds_as_str, get_failed_cmd_line_for_row
 from tdvt.tdvt_core import get_cleaned_results, do_work
-from tdvt.tdvt import TestOutputFiles
+from tdvt.tdvt import TestOutputFiles, TestRunner, register_tdvt_dialect
+from tdvt import tdvt as tdvt_main
+from tdvt.scheduler import TestSetTimings, get_test_set_key, order_by_expected_runtime, record_runtimes
 
 
 class DiffTest(unittest.TestCase):
@@ -1251,8 +1274,7 @@ class MangleTest(unittest.TestCase):
         )
 
 class TestOutputFilesTest(unittest.TestCase):
-    good_test_results = TestOutputFiles()
-    good_test_results.combined_output = [
+    good_test_results = [
         {'Suite': 'postgres', 'Test Set': 'StaplesConnectionTestpostgres', 'TDSName': 'Staples.postgres',
          'TestName': 'staples.connection.test',
          'TestPath': 'path/to/tdvt/root/logicaltests/setup/connection_test/setup.staples.connection.test.simple.xml',
@@ -1275,16 +1297,825 @@ class TestOutputFilesTest(unittest.TestCase):
          'Expected (100)tuples': '"key00"\n"key01"\n"key02"\n"key03"\n"key04"\n"key05"\n"key06"\n"key07"\n"key08"\n"key09"\n"key10"\n"key11"\n"key12"\n"key13"\n"key14"\n"key15"\n"key16"'}]
 
     def test_logical_test_return(self):
-        cmd_line = get_failed_cmd_line(self.good_test_results, 0)
+        cmd_line = get_failed_cmd_line_for_row(self.good_test_results[0])
         expected = 'python -m run-pattern postgres --logp path/to/tdvt/root/logicaltests/setup/connection_test/setup.staples.connection.test.simple.xml --tdp Staples.postgres.tds'
         self.assertEqual(cmd_line, expected)
 
     def test_expression_test_return(self):
-        cmd_line = get_failed_cmd_line(self.good_test_results, 1)
+        cmd_line = get_failed_cmd_line_for_row(self.good_test_results[1])
         expected = 'python -m run-pattern postgres --exp path/to/tdvt/root/tdvt/tdvt/tdvt/exprtests/pretest/connection_tests/calcs/setup.calcs_connection_test.txt --tdp cast_calcs.postgres.tds'
         self.assertEqual(cmd_line, expected)
 
 
+class TestOutputFilesJsonTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = make_temp_dir(['output_json'])
+        self.index = 0
+        TestOutputFiles.json_parts = {}
+
+    def tearDown(self):
+        TestOutputFiles.json_parts = {}
+        TestOutputFiles.csv_parts = {}
+        TestOutputFiles.csv_rows_in_memory = 0
+        shutil.rmtree(self.temp_dir)
+
+    def make_results(self, successful=(), failed=(), skipped=(), disabled=()):
+        return {'harness_name': 'TDVT', 'actual_exp_paths_relative_to': 'this',
+                'successful_tests': [{'test_name': t} for t in successful],
+                'disabled_tests': [{'test_name': t} for t in disabled],
+                'skipped_tests': [{'test_name': t} for t in skipped],
+                'failed_tests': [{'test_name': t} for t in failed]}
+
+    def append(self, results, index=None):
+        self.index += 1
+        TestOutputFiles.add_test_set_results(self.index if index is None else index, 'tdvt', json.dumps(results),
+                                             [], [])
+
+    def read_combined(self):
+        with open(os.path.join(self.temp_dir, TestOutputFiles.output_json), 'r', encoding='utf8') as combined:
+            return json.load(combined)
+
+    def names(self, results, key):
+        return [t['test_name'] for t in results[key]]
+
+    def test_merge(self):
+        self.append(self.make_results(successful=['a'], failed=['b', 'c']))
+        self.append(self.make_results(successful=['d'], failed=['e'], skipped=['f']))
+        self.append(self.make_results(successful=['b'], disabled=['g']))
+        TestOutputFiles.write_test_results_json(self.temp_dir)
+
+        combined = self.read_combined()
+        self.assertEqual(combined['harness_name'], 'TDVT')
+        self.assertEqual(self.names(combined, 'successful_tests'), ['a', 'd', 'b'])
+        self.assertEqual(self.names(combined, 'failed_tests'), ['c', 'e'])
+        self.assertEqual(self.names(combined, 'skipped_tests'), ['f'])
+        self.assertEqual(self.names(combined, 'disabled_tests'), ['g'])
+        self.assertEqual(TestOutputFiles.json_parts, {})
+
+    def test_merged_in_test_set_order(self):
+        self.append(self.make_results(successful=['b']), index=2)
+        self.append(self.make_results(successful=['a'], failed=['b']), index=1)
+        TestOutputFiles.write_test_results_json(self.temp_dir)
+        combined = self.read_combined()
+        self.assertEqual(self.names(combined, 'successful_tests'), ['a', 'b'])
+        self.assertEqual(self.names(combined, 'failed_tests'), [])
+
+    def test_rerun_merges_with_existing_results(self):
+        self.append(self.make_results(successful=['a'], failed=['b', 'c', 'c']))
+        TestOutputFiles.write_test_results_json(self.temp_dir)
+        self.assertEqual(self.names(self.read_combined(), 'failed_tests'), ['b', 'c', 'c'])
+
+        self.append(self.make_results(successful=['c'], failed=['b']))
+        TestOutputFiles.write_test_results_json(self.temp_dir)
+        combined = self.read_combined()
+        self.assertEqual(self.names(combined, 'successful_tests'), ['a', 'c'])
+        self.assertEqual(self.names(combined, 'failed_tests'), ['b', 'b'])
+
+    def test_no_results(self):
+        TestOutputFiles.write_test_results_json(self.temp_dir)
+        self.assertFalse(os.path.exists(os.path.join(self.temp_dir, TestOutputFiles.output_json)))
+
+
+class TestOutputFilesCsvTest(unittest.TestCase):
+    header = ['Suite', 'TDSName', 'TestName', 'TestPath', 'Passed', 'Test Type', 'Functions', 'Error Msg']
+
+    def setUp(self):
+        register_tdvt_dialect()
+        self.temp_dir = make_temp_dir(['output_csv'])
+        self.runner_count = 0
+        TestOutputFiles.csv_parts = {}
+        TestOutputFiles.csv_rows_in_memory = 0
+        TestOutputFiles.csv_parts_dir = None
+        TestOutputFiles.written_csv = None
+
+    def tearDown(self):
+        TestOutputFiles.csv_parts = {}
+        TestOutputFiles.json_parts = {}
+        TestOutputFiles.csv_rows_in_memory = 0
+        TestOutputFiles.csv_max_rows_in_memory = 200000
+        TestOutputFiles.written_csv = None
+        shutil.rmtree(self.temp_dir)
+
+    def add_runner_output(self, rows, header=None):
+        self.runner_count += 1
+        csv_rows = [['mydb', 'cast_calcs.mydb', name, 'exprtests/setup.' + name + '.txt', passed, 'expression',
+                     functions, 'error'] for name, functions, passed in rows]
+        TestOutputFiles.add_test_set_results(self.runner_count, 'tdvt', '{}', header or self.header, csv_rows)
+
+    def read_combined(self):
+        with open(os.path.join(self.temp_dir, TestOutputFiles.output_csv), 'r', encoding='utf8') as csv_file:
+            return list(csv.DictReader(csv_file, dialect='tdvt'))
+
+    def test_merge_sorted_runner_files(self):
+        self.add_runner_output([('a', 'f', 'True'), ('b', 'f,g', 'True'), ('c', 'f,g,h', 'True')])
+        self.add_runner_output([('d', 'f', 'False'), ('e', 'f,g,h', 'True')])
+        TestOutputFiles.write_test_results_csv(False, self.temp_dir)
+
+        rows = self.read_combined()
+        self.assertEqual([row['TestName'] for row in rows], ['a', 'd', 'b', 'c', 'e'])
+        self.assertEqual(rows[1]['Error Msg'], 'error To run this test: \n' +
+                         'python -m run-pattern mydb --exp exprtests/setup.d.txt --tdp cast_calcs.mydb.tds')
+        self.assertEqual(rows[0]['Error Msg'], 'error')
+        self.assertIsNone(TestOutputFiles.csv_parts_dir)
+
+    def test_second_phase_includes_first(self):
+        self.add_runner_output([('smoke', 'f,g', 'False')])
+        TestOutputFiles.write_test_results_csv(False, self.temp_dir)
+        self.add_runner_output([('a', 'f', 'True'), ('b', 'f,g', 'True')])
+        TestOutputFiles.write_test_results_csv(False, self.temp_dir)
+
+        rows = self.read_combined()
+        self.assertEqual([row['TestName'] for row in rows], ['a', 'smoke', 'b'])
+        self.assertEqual(rows[1]['Error Msg'].count('To run this test'), 1)
+
+    def test_rows_past_memory_limit_are_written_to_files(self):
+        TestOutputFiles.csv_max_rows_in_memory = 2
+        self.add_runner_output([('a', 'f', 'True'), ('c', 'f,g,h', 'True')])
+        self.add_runner_output([('b', 'f,g', 'False')])
+        self.assertIsInstance(TestOutputFiles.csv_parts[1][1], list)
+        self.assertTrue(os.path.isfile(TestOutputFiles.csv_parts[2][1]))
+        parts_dir = TestOutputFiles.csv_parts_dir
+        TestOutputFiles.write_test_results_csv(False, self.temp_dir)
+
+        rows = self.read_combined()
+        self.assertEqual([row['TestName'] for row in rows], ['a', 'b', 'c'])
+        self.assertEqual(rows[1]['Error Msg'].count('To run this test'), 1)
+        self.assertFalse(os.path.exists(parts_dir))
+
+    def test_runner_rows_in_test_order(self):
+        csv_rows = [['mydb', 'cast_calcs.mydb', name, 'exprtests/setup.' + name + '.txt', 'True', 'expression',
+                     functions, 'error'] for name, functions in [('c', 'f,g,h'), ('a', 'f'), ('b', 'f,g')]]
+        TestOutputFiles.add_test_set_results(0, 'tdvt', '{}', self.header, csv_rows)
+        # The runner's rows, which also go to the run history and the columnar output, keep their order.
+        self.assertEqual([row[2] for row in csv_rows], ['c', 'a', 'b'])
+        self.add_runner_output([('d', 'f', 'True')])
+        TestOutputFiles.write_test_results_csv(False, self.temp_dir)
+        self.assertEqual([row['TestName'] for row in self.read_combined()], ['a', 'd', 'b', 'c'])
+
+    def test_reset_forgets_earlier_run(self):
+        self.add_runner_output([('old', 'f', 'True')])
+        TestOutputFiles.write_test_results_csv(False, self.temp_dir)
+        TestOutputFiles.reset()
+        self.assertIsNone(TestOutputFiles.written_csv)
+        self.add_runner_output([('new', 'f', 'True')])
+        TestOutputFiles.write_test_results_csv(False, self.temp_dir)
+        self.assertEqual([row['TestName'] for row in self.read_combined()], ['new'])
+
+    def test_unsorted_without_functions(self):
+        header = [column for column in self.header if column != 'Functions'] + ['Other']
+        self.add_runner_output([('b', 'x', 'True'), ('a', 'y', 'True')], header)
+        TestOutputFiles.write_test_results_csv(False, self.temp_dir)
+        self.assertEqual([row['TestName'] for row in self.read_combined()], ['b', 'a'])
+
+
+class ResultArchiverTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = make_temp_dir(['archiver'])
+        self.zip_path = os.path.join(self.temp_dir, 'actuals.zip')
+        self.src_dir = os.path.join(self.temp_dir, 'src')
+        os.mkdir(self.src_dir)
+        for name in ['actual.a.txt', 'actual.b.txt']:
+            with open(os.path.join(self.src_dir, name), 'w', encoding='utf8') as src_file:
+                src_file.write('tuples ' * 100)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def archive(self, names, compression_level=None, callback=None):
+        archiver = ResultArchiver(compression_level)
+        archiver.add_files(self.zip_path, [(os.path.join(self.src_dir, n), 'config/' + n) for n in names])
+        if callback:
+            archiver.call(callback)
+        archiver.close()
+
+    def test_files_written_before_callback(self):
+        self.archive(['actual.a.txt', 'actual.b.txt'], callback=lambda: shutil.rmtree(self.src_dir))
+        self.assertFalse(os.path.exists(self.src_dir))
+        with zipfile.ZipFile(self.zip_path) as archive:
+            self.assertEqual(archive.namelist(), ['config/actual.a.txt', 'config/actual.b.txt'])
+            self.assertEqual(archive.getinfo('config/actual.a.txt').compress_type, zipfile.ZIP_DEFLATED)
+            self.assertEqual(archive.read('config/actual.b.txt').decode('utf8'), 'tuples ' * 100)
+
+    def test_store_only_appends_to_existing_archive(self):
+        self.archive(['actual.a.txt'])
+        self.archive(['actual.b.txt'], compression_level=0)
+        with zipfile.ZipFile(self.zip_path) as archive:
+            self.assertEqual(archive.namelist(), ['config/actual.a.txt', 'config/actual.b.txt'])
+            self.assertEqual(archive.getinfo('config/actual.b.txt').compress_type, zipfile.ZIP_STORED)
+
+    def test_no_files_no_archive(self):
+        self.archive([])
+        self.assertFalse(os.path.exists(self.zip_path))
+
+
+class ColumnarOutputTest(unittest.TestCase):
+    header = ['Suite', 'TestName', 'Passed', 'Diff count', 'Query Time (ms)']
+    rows = [['mydb', 'a', 'True', '0', '12.5'], ['mydb', 'b', 'False', 'None', '']]
+
+    def setUp(self):
+        self.temp_dir = make_temp_dir(['columnar'])
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_typed_columns(self):
+        columns = columnar_output.get_typed_columns(self.header, self.rows)
+        self.assertEqual(columns['TestName'], ['a', 'b'])
+        self.assertEqual(columns['Passed'], [True, False])
+        self.assertEqual(columns['Diff count'], [0, None])
+        self.assertEqual(columns['Query Time (ms)'], [12.5, None])
+
+    def test_sqlite(self):
+        writer = columnar_output.ColumnarResultsWriter(self.temp_dir, 'sqlite', 'run1')
+        writer.add_test_set_results('mydb', 'expression.standard', self.header, self.rows)
+        writer = columnar_output.ColumnarResultsWriter(self.temp_dir, 'sqlite', 'run2')
+        writer.add_test_set_results('mydb', 'expression.standard', self.header + ['Expected SQL'],
+                                    [['mydb', 'c', 'True', '1', '3', 'select 1']])
+
+        connection = sqlite3.connect(os.path.join(self.temp_dir, columnar_output.SQLITE_FILE))
+        try:
+            rows = connection.execute('SELECT run_id, TestName, Passed, "Diff count", "Query Time (ms)", '
+                                      '"Expected SQL" FROM results ORDER BY TestName').fetchall()
+        finally:
+            connection.close()
+        self.assertEqual(rows, [('run1', 'a', 1, 0, 12.5, None), ('run1', 'b', 0, None, None, None),
+                                ('run2', 'c', 1, 1, 3.0, 'select 1')])
+
+    @unittest.skipIf(columnar_output.pyarrow is None, 'pyarrow is not installed')
+    def test_parquet_partitions(self):
+        writer = columnar_output.ColumnarResultsWriter(self.temp_dir, 'parquet', 'run1')
+        writer.add_test_set_results('my db', 'expression.standard', self.header, self.rows)
+
+        partition_dir = os.path.join(self.temp_dir, columnar_output.PARQUET_DIR, 'suite_name=my_db', 'run_id=run1')
+        files = os.listdir(partition_dir)
+        self.assertEqual(files, ['1-expression.standard.parquet'])
+        table = columnar_output.pyarrow.parquet.read_table(os.path.join(partition_dir, files[0]))
+        self.assertEqual(str(table.schema.field('Passed').type), 'bool')
+        self.assertEqual(table.column('Query Time (ms)').to_pylist(), [12.5, None])
+
+
+class RunHistoryTest(unittest.TestCase):
+    header = ['Suite', 'Test Set', 'TestName', 'Passed', 'Closest Expected', 'Diff count', 'Test Case',
+              'Query Time (ms)']
+
+    def setUp(self):
+        self.temp_dir = make_temp_dir(['run_history'])
+        self.path = os.path.join(self.temp_dir, 'history', 'run_history.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def add_run(self, run_id, results):
+        rows = [['mydb', 'expression.standard', 'setup.' + test, str(passed), '0', '0' if passed else '2', case,
+                 str(query_time)] for test, case, passed, query_time in results]
+        RunHistory(self.path, run_id).add_test_set_results(self.header, rows)
+
+    def test_compare_runs(self):
+        self.add_run('run1', [('a', '1', True, 10), ('a', '2', False, 10), ('b', '1', True, 100), ('c', '1', True, 10)])
+        self.add_run('run2', [('a', '1', False, 10), ('a', '2', True, 10), ('b', '1', True, 200), ('c', '1', True, 19),
+                              ('d', '1', False, 10)])
+
+        new_failures, fixed, slower = RunHistory(self.path).compare_runs('run1', 'run2', 1.5, 10)
+        self.assertEqual([(r[2], r[3], r[8]) for r in new_failures], [('setup.a', '1', 2)])
+        self.assertEqual([(r[2], r[3]) for r in fixed], [('setup.a', '2')])
+        self.assertEqual([(r[2], r[6], r[7]) for r in slower], [('setup.b', 100.0, 200.0)])
+        self.assertEqual([run[0] for run in RunHistory(self.path).get_runs()], ['run2', 'run1'])
+
+    def test_perflab_rows(self):
+        header = ['TestGroup', 'TestSubGroup', 'Test', 'IterationComment1', 'Result']
+        rows = get_history_rows('run1', header, [['mydb', 'logical.calcs', 'setup.a', 'True', '5.5'],
+                                                 ['mydb', 'logical.calcs', 'setup.a', 'False', '7']])
+        self.assertEqual(rows, [('run1', 'mydb', 'logical.calcs', 'setup.a', '0', True, None, None, 5.5),
+                                ('run1', 'mydb', 'logical.calcs', 'setup.a', '1', False, None, None, 7.0)])
+
+    def test_unknown_run(self):
+        self.add_run('run1', [('a', '1', True, 10)])
+        with mock.patch('sys.stdout', new_callable=io.StringIO):
+            self.assertEqual(print_run_history(None, None, False, 1.5, 10, self.path), 1)
+            self.assertEqual(print_run_history('run0', 'run1', False, 1.5, 10, self.path), 1)
+            self.assertEqual(print_run_history('run1', 'run1', False, 1.5, 10, self.path), 0)
+
+
+    def test_history_is_opt_in(self):
+        parser = create_parser()
+        self.assertFalse(TdvtInvocation(from_args=parser.parse_args(['run', 'mydb'])).record_history)
+        self.assertTrue(TdvtInvocation(from_args=parser.parse_args(['run', 'mydb', '--record-history'])).record_history)
+
+    def test_missing_history_not_created(self):
+        with mock.patch('sys.stdout', new_callable=io.StringIO):
+            self.assertEqual(print_run_history(None, None, True, 1.5, 10, self.path), 1)
+        self.assertFalse(os.path.exists(os.path.dirname(self.path)))
+
+    def test_read_only(self):
+        self.add_run('run1', [('a', '1', True, 10)])
+        history = RunHistory(self.path, read_only=True)
+        self.assertEqual([run[0] for run in history.get_runs()], ['run1'])
+        with mock.patch('logging.error') as error:
+            history.add_test_set_results(self.header, [['mydb', 'expression.standard', 'setup.b', 'True', '0', '0', '1',
+                                                        '10']])
+        error.assert_called_once()
+
+
+class IncrementalTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = make_temp_dir(['incremental'])
+        self.test_path = self.temp_dir + '/'
+        suite_dir = os.path.join('tests', 'e', 'suite1')
+        shutil.copy(os.path.join(suite_dir, 'setup.mytest.txt'), self.temp_dir)
+        self.actual = os.path.join(self.temp_dir, 'actual.setup.mytest.txt')
+        shutil.copy(os.path.join(suite_dir, 'tuple_1', 'actual.setup.mytest.txt'), self.actual)
+        shutil.copy(self.actual, os.path.join(self.temp_dir, 'expected.setup.mytest.txt'))
+        self.cache = IncrementalResultCache(os.path.join(self.temp_dir, 'cache'))
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def run_incremental(self, d_override=''):
+        test_name = 'setup.mytest.txt'
+        mock_tests = [TestFile('tests', self.test_path + test_name)]
+        test_set = MockTestSet(self.test_path, test_name, 'mock ds', 'tests', 'mock config', 'mock.tds', '',
+                               'tests/*.txt', False, 'mock suite expression', '', '')
+        test_config = TdvtInvocation()
+        test_config.incremental = True
+        test_config.d_override = d_override
+        with mock.patch('tdvt.tdvt_core.get_incremental_cache', return_value=self.cache):
+            # Fails the test set if tabquery has to run.
+            mock_batch = MockBatchQueueWork(mock_tests, test_config, test_set, RuntimeError('tabquery ran'))
+            if os.path.isfile(self.actual):
+                mock_batch.runtime_exception = None
+            do_work(mock_batch, mock_tests)
+        return list(mock_batch.results.values())[0]
+
+    def test_passing_result_is_reused(self):
+        result = self.run_incremental()
+        self.assertTrue(result.all_passed())
+        self.assertFalse(result.cached)
+
+        os.remove(self.actual)
+        result = self.run_incremental()
+        self.assertTrue(result.all_passed())
+        self.assertTrue(result.cached)
+        self.assertTrue(os.path.isfile(self.actual))
+
+    def test_changed_test_file_runs_again(self):
+        self.run_incremental()
+        os.remove(self.actual)
+        with open(os.path.join(self.temp_dir, 'setup.mytest.txt'), 'a', encoding='utf8') as test_file:
+            test_file.write('\n')
+        result = self.run_incremental()
+        self.assertFalse(result.all_passed())
+        self.assertFalse(result.cached)
+
+    def test_failing_result_is_not_saved(self):
+        shutil.copy(os.path.join('tests', 'e', 'suite1', 'expected.setup.mytest.txt'), self.temp_dir)
+        self.assertFalse(self.run_incremental().all_passed())
+        self.assertFalse(os.path.exists(self.cache.cache_dir))
+
+    def test_override_paths(self):
+        plugin_dir = os.path.join(self.temp_dir, 'plugins')
+        os.mkdir(plugin_dir)
+        self.assertEqual(get_override_paths('-DConnectPluginsPath=' + plugin_dir + ' -DLogLevel=Debug'), [plugin_dir])
+        self.assertEqual(get_override_paths(''), [])
+        # Split on spaces like the tabquery command line, so neither part is a path that exists.
+        self.assertIsNone(get_override_paths('-DConnectPluginsPath=' + os.path.join(self.temp_dir, 'my plugins')))
+
+    def test_unparsed_override_runs_again(self):
+        d_override = '-DConnectPluginsPath=' + os.path.join(self.temp_dir, 'my plugins')
+        self.run_incremental(d_override)
+        os.remove(self.actual)
+        result = self.run_incremental(d_override)
+        self.assertFalse(result.all_passed())
+        self.assertFalse(result.cached)
+
+
+class TestSetSchedulerTest(unittest.TestCase):
+    def make_runner(self, ds, tds=None):
+        tds = tds or ds + '.tds'
+        return types.SimpleNamespace(test_set=types.SimpleNamespace(ds_name=ds, tds_name=tds),
+                                     test_config=types.SimpleNamespace(tds=tds), connection_errors=False)
+
+    def get_now(self, scheduler):
+        """get() without blocking. None if no test set can start."""
+        with scheduler.condition:
+            if not any(scheduler.can_start(r) for r in scheduler.pending):
+                return None
+        return scheduler.get()
+
+    def test_datasource_limit(self):
+        scheduler = TestSetScheduler({'slow': 1})
+        runners = [self.make_runner('slow'), self.make_runner('slow'), self.make_runner('fast')]
+        for runner in runners:
+            scheduler.put(runner)
+        self.assertIs(self.get_now(scheduler), runners[0])
+        self.assertIs(self.get_now(scheduler), runners[2])
+        self.assertIsNone(self.get_now(scheduler))
+        scheduler.task_done(runners[0])
+        self.assertIs(self.get_now(scheduler), runners[1])
+
+    def test_tds_limit(self):
+        scheduler = TestSetScheduler(tds_limit=1)
+        runners = [self.make_runner('a', 'calcs.tds'), self.make_runner('a', 'calcs.tds'),
+                   self.make_runner('a', 'staples.tds')]
+        for runner in runners:
+            scheduler.put(runner)
+        self.assertIs(self.get_now(scheduler), runners[0])
+        self.assertIs(self.get_now(scheduler), runners[2])
+        self.assertIsNone(self.get_now(scheduler))
+
+    def test_tds_limit_after_tds_resolved(self):
+        scheduler = TestSetScheduler(tds_limit=1)
+        # A running test set replaces the tds name with its full path, and queues its shards after that.
+        shard = self.make_runner('a', 'calcs.tds')
+        shard.test_config.tds = '/tds/calcs.tds'
+        runners = [shard, self.make_runner('a', 'calcs.tds')]
+        for runner in runners:
+            scheduler.put(runner)
+        self.assertIs(self.get_now(scheduler), runners[0])
+        self.assertIsNone(self.get_now(scheduler))
+        scheduler.task_done(runners[0])
+        self.assertIs(self.get_now(scheduler), runners[1])
+
+    def test_negative_tds_limit_rejected(self):
+        parser = create_parser()
+        self.assertEqual(parser.parse_args(['run', 'mydb', '--threads-per-tds', '0']).tds_thread_count, 0)
+        with mock.patch('sys.stderr', new_callable=io.StringIO), self.assertRaises(SystemExit):
+            parser.parse_args(['run', 'mydb', '--threads-per-tds', '-1'])
+
+    def test_limit_reduced_on_connection_errors(self):
+        scheduler = TestSetScheduler({'db': 4})
+        runners = [self.make_runner('db') for _ in range(8)]
+        for runner in runners:
+            scheduler.put(runner)
+        running = [self.get_now(scheduler) for _ in range(4)]
+        self.assertIsNone(self.get_now(scheduler))
+
+        running[0].connection_errors = True
+        scheduler.task_done(running[0])
+        self.assertEqual(scheduler.limits['db'], 2)
+        self.assertIsNone(self.get_now(scheduler))
+        scheduler.task_done(running[1])
+        self.assertEqual(scheduler.limits['db'], 3)
+        scheduler.task_done(running[2])
+        self.assertEqual(scheduler.limits['db'], 4)
+        self.assertIsNotNone(self.get_now(scheduler))
+
+    def test_join_with_worker_threads(self):
+        scheduler = TestSetScheduler({'a': 1, 'b': 2})
+        done = []
+
+        def work():
+            while True:
+                runner = scheduler.get()
+                done.append(runner)
+                scheduler.task_done(runner)
+
+        for _ in range(3):
+            threading.Thread(target=work, daemon=True).start()
+        for i in range(20):
+            scheduler.put(self.make_runner('a' if i % 2 else 'b'))
+        scheduler.join()
+        self.assertEqual(len(done), 20)
+
+    def test_has_connection_errors(self):
+        header = ['TestName', 'Error Msg', 'Error Type']
+        self.assertFalse(has_connection_errors(header, [['a', 'None', 'Actual does not match expected.']]))
+        self.assertTrue(has_connection_errors(header, [['a', 'None', 'Test timed out.']]))
+        self.assertTrue(has_connection_errors(header, [['a', 'ERROR: Connection refused by server', 'Error.']]))
+
+
+class SmokeTestGateTest(unittest.TestCase):
+    def make_runner(self, ds, failed_tests=0):
+        return types.SimpleNamespace(test_set=types.SimpleNamespace(ds_name=ds, tds_name=ds + '.tds',
+                                                                    test_is_skipped=False),
+                                     test_config=types.SimpleNamespace(tds=ds + '.tds'), failed_tests=failed_tests)
+
+    def make_gate(self, force_run=False):
+        self.smoke = {ds: self.make_runner(ds) for ds in ['a', 'b']}
+        self.work = [self.make_runner(ds) for ds in ['a', 'a', 'b', 'c']]
+        gate = SmokeTestGate(list(self.smoke.values()), self.work, force_run)
+        scheduler = TestSetScheduler()
+        scheduler.gate = gate
+        for runner in list(self.smoke.values()) + gate.get_ready_work():
+            scheduler.put(runner)
+        return gate, scheduler
+
+    def test_datasource_work_queued_after_its_smoke_tests(self):
+        gate, scheduler = self.make_gate()
+        self.assertEqual(scheduler.qsize(), 3)
+        self.assertIs(scheduler.get(), self.smoke['a'])
+        self.assertIs(scheduler.get(), self.smoke['b'])
+        self.assertIs(scheduler.get(), self.work[3])
+        scheduler.task_done(self.smoke['a'])
+        self.assertEqual(scheduler.pending, self.work[0:2])
+        self.assertIsNone(gate.smoke_test_end_time)
+        scheduler.task_done(self.smoke['b'])
+        self.assertEqual(scheduler.pending, self.work[0:3])
+        self.assertIsNotNone(gate.smoke_test_end_time)
+        self.assertFalse(any(runner.test_set.test_is_skipped for runner in self.work))
+
+    def test_failed_smoke_test_skips_only_its_datasource(self):
+        gate, scheduler = self.make_gate()
+        for _ in range(3):
+            scheduler.get()
+        self.smoke['b'].failed_tests = 1
+        scheduler.task_done(self.smoke['b'])
+        scheduler.task_done(self.smoke['a'])
+        self.assertEqual(gate.failing_ds, {'b'})
+        self.assertEqual([runner.test_set.test_is_skipped for runner in self.work], [False, False, True, False])
+
+    def test_force_run(self):
+        gate, scheduler = self.make_gate(force_run=True)
+        for _ in range(3):
+            scheduler.get()
+        self.smoke['b'].failed_tests = 1
+        scheduler.task_done(self.smoke['b'])
+        self.assertFalse(self.work[2].test_set.test_is_skipped)
+        self.assertIn(self.work[2], scheduler.pending)
+
+
+class CompareProcessesTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = make_temp_dir(['compare_processes'])
+        self.test_path = self.temp_dir + '/'
+        suite_dir = os.path.join('tests', 'e', 'suite1')
+        shutil.copy(os.path.join(suite_dir, 'setup.mytest.txt'), self.temp_dir)
+        actual = os.path.join(suite_dir, 'tuple_1', 'actual.setup.mytest.txt')
+        shutil.copy(actual, self.temp_dir)
+        shutil.copy(os.path.join(suite_dir, 'expected.setup.mytest.txt'), self.temp_dir)
+        shutil.copy(actual, os.path.join(self.temp_dir, 'expected.setup.mytest.1.txt'))
+
+    def tearDown(self):
+        shutdown_compare_pool()
+        shutil.rmtree(self.temp_dir)
+
+    def run_compare(self, compare_processes):
+        test_name = 'setup.mytest.txt'
+        mock_tests = [TestFile('tests', self.test_path + test_name)]
+        test_set = MockTestSet(self.test_path, test_name, 'mock ds', 'tests', 'mock config', 'mock.tds', '',
+                               'tests/*.txt', False, 'mock suite expression', '', '')
+        test_config = TdvtInvocation()
+        test_config.compare_processes = compare_processes
+        mock_batch = MockBatchQueueWork(mock_tests, test_config, test_set)
+        match_index = ExpectedMatchIndex()
+        with mock.patch('tdvt.tdvt_core.get_expected_match_index', return_value=match_index):
+            mock_batch.run(mock_tests)
+            mock_batch.process_test_results(mock_tests)
+            json_str, csv_header, rows, counts = tdvt_core.get_test_output(mock_batch.results, 'mock.tds')
+        return mock_batch.results, match_index, rows
+
+    def test_same_results_as_threads(self):
+        thread_results, thread_index, thread_rows = self.run_compare(None)
+        process_results, process_index, process_rows = self.run_compare(1)
+        thread_result = list(thread_results.values())[0]
+        process_result = list(process_results.values())[0]
+        self.assertTrue(process_result.all_passed())
+        self.assertEqual(process_result.matched_expected_version, thread_result.matched_expected_version)
+        self.assertEqual(process_index.matches, thread_index.matches)
+        self.assertEqual(process_rows, thread_rows)
+
+    def test_output_on_thread(self):
+        results, match_index, rows = self.run_compare(1)
+        sink = []
+        with mock.patch('tdvt.process_pool.ProcessPoolExecutor') as executor:
+            counts = tdvt_core.process_test_results(results, 'mock.tds', False, self.temp_dir,
+                                                    lambda *output: sink.append(output), False)
+        executor.assert_not_called()
+        self.assertEqual(counts, (0, 0, 0, 1))
+        self.assertEqual(sink[0][2], rows)
+
+    def test_pool_started_from_launcher(self):
+        # Spawned processes import the launcher again as __mp_main__, which must not run tdvt a second time.
+        launcher = os.path.abspath(os.path.join('..', 'tdvt_launcher.py'))
+        script = ('import os, runpy, sys\n'
+                  'sys.path.insert(0, os.path.dirname({0!r}))\n'
+                  'from tdvt import tdvt\n'
+                  'from tdvt.process_pool import get_compare_pool\n'
+                  'tdvt.main = lambda: print(get_compare_pool(2).submit(os.getpid).result() != os.getpid())\n'
+                  'runpy.run_path({0!r}, run_name="__main__")\n'.format(launcher))
+        output = subprocess.run([sys.executable, '-c', script], stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                universal_newlines=True, timeout=120).stdout
+        self.assertEqual(output.strip(), 'True')
+
+
+class TestIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = make_temp_dir(['test_index'])
+        for name in ['setup.a.txt', 'setup.b.txt', 'setup.c.1.txt', 'expected.setup.a.txt', 'expected.setup.a.1.txt',
+                     'expected.setup.a.3.txt', 'expected.setup.c.1.txt', '.hidden.txt', 'readme.md']:
+            with open(os.path.join(self.temp_dir, name), 'w') as f:
+                f.write(name)
+        os.mkdir(os.path.join(self.temp_dir, 'setup.dir.txt'))
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_glob_and_list_match_os(self):
+        index = TestIndex()
+        for pattern in ['setup.*.txt', '*', '.*', 'setup.?.txt', 'missing*', os.path.join('missing', '*')]:
+            path = os.path.join(self.temp_dir, pattern)
+            self.assertEqual(sorted(index.glob(path)), sorted(f for f in glob.glob(path) if os.path.isfile(f)))
+        files = [os.path.join(self.temp_dir, f) for f in os.listdir(self.temp_dir)]
+        self.assertEqual(sorted(index.list_files(self.temp_dir)), sorted(f for f in files if os.path.isfile(f)))
+        self.assertEqual(index.list_files(os.path.join(self.temp_dir, 'missing')), [])
+
+    def test_directory_change_invalidates(self):
+        index = TestIndex()
+        pattern = os.path.join(self.temp_dir, 'setup.*.txt')
+        self.assertEqual(len(index.glob(pattern)), 3)
+        with open(os.path.join(self.temp_dir, 'setup.d.txt'), 'w') as f:
+            f.write('d')
+        stat = os.stat(self.temp_dir)
+        os.utime(self.temp_dir, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000))
+        self.assertEqual(len(index.glob(pattern)), 4)
+
+    def test_save(self):
+        cache_dir = make_temp_dir(['test_index_cache'])
+        self.addCleanup(shutil.rmtree, cache_dir)
+        path = os.path.join(cache_dir, 'test_index.json')
+        index = TestIndex(path)
+        self.assertEqual(len(index.list_files(self.temp_dir)), 9)
+        index.save()
+
+        loaded = TestIndex.load(path)
+        self.assertEqual(loaded.dirs, index.dirs)
+        with mock.patch('os.scandir', side_effect=AssertionError('listed again')):
+            self.assertEqual(len(loaded.list_files(self.temp_dir)), 9)
+
+    def test_test_set_uses_index(self):
+        test_set = ExpressionTestSet('ds', self.temp_dir, 'config', 'ds.tds', 'setup.b', 'setup.*.txt', 'suite')
+        with mock.patch('tdvt.config_gen.test_config.get_test_index', return_value=TestIndex()):
+            tests = test_set.generate_test_file_list()
+        self.assertEqual([os.path.basename(t.test_path) for t in tests], ['setup.a.txt', 'setup.c.1.txt'])
+
+
+class ExclusionFilterTest(unittest.TestCase):
+    paths = ['exprtests/standard/setup.date.datepart.txt', 'exprtests/standard/setup.string.left.txt',
+             'exprtests/standard/expected.setup.string.left.txt', 'logicaltests/setup/calcs/setup.bugs.b1.dbo.xml',
+             'exprtests/standard/setup.Math.abs.txt']
+
+    def assert_same_as_separate_regexes(self, exclusions):
+        exclusion_filter = ExclusionFilter(tuple(exclusions))
+        for path in self.paths:
+            expected = any(re.search(ex.strip(), path) for ex in exclusions if ex.strip())
+            self.assertEqual(exclusion_filter.search(path), expected, path)
+        return exclusion_filter
+
+    def test_combined(self):
+        exclusion_filter = self.assert_same_as_separate_regexes(['string.left', ' date', 'b1\\.', 'expected.', ''])
+        self.assertEqual(len(exclusion_filter.regexes), 1)
+
+    def test_groups_and_flags(self):
+        exclusion_filter = self.assert_same_as_separate_regexes(['(s)etup.\\1tring', 'logical'])
+        self.assertEqual(len(exclusion_filter.regexes), 2)
+        exclusion_filter = self.assert_same_as_separate_regexes(['(?i)math', 'date'])
+        self.assertEqual(len(exclusion_filter.regexes), 2)
+        exclusion_filter = self.assert_same_as_separate_regexes(['date', '(?i)MATH', 'STRING', '(?i:LOGICAL)'])
+        self.assertEqual(len(exclusion_filter.regexes), 2)
+        with mock.patch('re.compile', side_effect=re.compile) as compile_mock:
+            ExclusionFilter(('date', '(?i)math'))
+        self.assertNotIn(mock.call('(?:date)|(?:(?i)math)'), compile_mock.call_args_list)
+
+    def test_invalid_pattern_ignored(self):
+        exclusion_filter = ExclusionFilter(('string[', 'date'))
+        self.assertTrue(exclusion_filter.search(self.paths[0]))
+        self.assertFalse(exclusion_filter.search(self.paths[1]))
+
+    def test_cached(self):
+        self.assertIs(get_exclusion_filter(('a', 'b')), get_exclusion_filter(('a', 'b')))
+
+
+class GenerateLogicalFilesTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = make_temp_dir(['generate_logical_files'])
+        self.input_dir = os.path.join(self.temp_dir, 'input')
+        self.output_dir = os.path.join(self.temp_dir, 'setup')
+        os.makedirs(os.path.join(self.input_dir, 'calcs'))
+        for name in ['a', 'b']:
+            self.write_input(name, '<query>[Calcs].[int0] $Calcs$ ' + name + '</query>\n')
+        self.configs = {'plain': {'tablename': '$dsName'}, 'upper': {'tablename': '$dsName', 'fieldnameUpper': True}}
+        self.ds_info = types.SimpleNamespace(logical_config={})
+        self.ds_registry = types.SimpleNamespace(dsnames=['mydb'], get_datasource_info=lambda ds: self.ds_info)
+        patcher = mock.patch('tdvt.config_gen.gentests.template_attributes', self.configs)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def write_input(self, name, text):
+        with open(os.path.join(self.input_dir, 'calcs', 'setup.' + name + '.xml'), 'w') as f:
+            f.write(text)
+
+    def generate(self, force=True):
+        written = []
+        real_write_config_files = gentests.write_config_files
+
+        def write_config_files(rewriter, config_name, input_paths, output_dir):
+            written.extend(gentests.get_output_file_name(gentests.get_test_name(p), config_name) for p in input_paths)
+            real_write_config_files(rewriter, config_name, input_paths, output_dir)
+
+        with mock.patch('tdvt.config_gen.gentests.write_config_files', side_effect=write_config_files):
+            gentests.generate_logical_files(self.input_dir, self.output_dir, self.ds_registry, force)
+        return sorted(written)
+
+    def read_output(self, name):
+        with open(os.path.join(self.output_dir, 'calcs', name)) as f:
+            return f.read()
+
+    def test_only_changed_files_are_written(self):
+        self.assertEqual(self.generate(), ['setup.a.plain.xml', 'setup.a.upper.xml', 'setup.b.plain.xml',
+                                           'setup.b.upper.xml'])
+        self.assertEqual(self.read_output('setup.a.upper.xml'), '<query>[Calcs].[INT0] [Calcs] a</query>\n')
+        self.assertEqual(self.generate(), [])
+        self.assertEqual(self.generate(force=False), [])
+
+        self.write_input('b', '<query>$Staples$ b</query>\n')
+        self.assertEqual(self.generate(), ['setup.b.plain.xml', 'setup.b.upper.xml'])
+        self.assertEqual(self.read_output('setup.b.plain.xml'), '<query>[Staples] b</query>\n')
+
+        self.ds_info.logical_config = {'mydb': {'tablename': 'my_$dsName'}}
+        self.assertEqual(self.generate(), ['setup.a.mydb.xml', 'setup.b.mydb.xml'])
+        self.configs['upper']['tablenamePostfix'] = '_v'
+        self.assertEqual(self.generate(), ['setup.a.upper.xml', 'setup.b.upper.xml'])
+
+        self.ds_info.logical_config = {}
+        self.assertEqual(self.generate(), [])
+        self.assertEqual(sorted(os.listdir(os.path.join(self.output_dir, 'calcs'))),
+                         ['setup.a.plain.xml', 'setup.a.upper.xml', 'setup.b.plain.xml', 'setup.b.upper.xml'])
+
+    def test_missing_output_and_manifest(self):
+        self.generate()
+        os.remove(os.path.join(self.output_dir, 'calcs', 'setup.a.plain.xml'))
+        self.assertEqual(self.generate(), ['setup.a.plain.xml'])
+        with open(os.path.join(self.output_dir, 'calcs', 'setup.old.plain.xml'), 'w') as f:
+            f.write('old')
+        os.remove(os.path.join(self.output_dir, gentests.GENERATION_MANIFEST_FILE))
+        self.assertEqual(len(self.generate()), 4)
+        self.assertFalse(os.path.exists(os.path.join(self.output_dir, 'calcs', 'setup.old.plain.xml')))
+
+    def test_pool_is_opt_in(self):
+        with mock.patch('tdvt.config_gen.gentests.GENERATE_MIN_FILES_PER_PROCESS', 1):
+            with mock.patch('tdvt.config_gen.gentests.ProcessPoolExecutor') as executor:
+                self.generate()
+        executor.assert_not_called()
+        self.assertEqual(gentests.GenerationPool().max_processes, 1)
+
+    def test_pool_output_same_as_serial(self):
+        self.generate()
+        serial_dir = os.path.join(self.output_dir, 'calcs')
+        pool_dir = os.path.join(self.temp_dir, 'pool')
+        os.mkdir(pool_dir)
+        inputs = sorted(glob.glob(os.path.join(self.input_dir, 'calcs', '*')))
+        rewriters = gentests.get_rewriters(self.ds_registry, CALCS_FIELDS + STAPLES_FIELDS)
+        pool = gentests.GenerationPool(2)
+        with mock.patch('tdvt.config_gen.gentests.GENERATE_MIN_FILES_PER_PROCESS', 1):
+            pool.run([(rewriters[c], c, inputs, pool_dir) for c in rewriters], len(inputs) * len(rewriters))
+        self.assertIsNotNone(pool.executor)
+        pool.shutdown()
+        self.assertEqual(sorted(os.listdir(pool_dir)), sorted(os.listdir(serial_dir)))
+        for name in os.listdir(pool_dir):
+            with open(os.path.join(pool_dir, name), 'rb') as pool_file, \
+                    open(os.path.join(serial_dir, name), 'rb') as serial_file:
+                self.assertEqual(pool_file.read(), serial_file.read())
+
+
+class LogicalConfigRewriterTest(unittest.TestCase):
+    fields = CALCS_FIELDS + STAPLES_FIELDS
+
+    def assert_same_as_get_modified_line(self, attrs, lines, fields=None, field_name_map=None):
+        fields = fields if fields is not None else self.fields
+        if field_name_map is None:
+            field_name_map = gentests.get_field_name_map(fields, attrs)
+        rewriter = gentests.LogicalConfigRewriter(attrs, fields, field_name_map)
+        for line in lines:
+            self.assertEqual(rewriter.rewrite(line), gentests.get_modified_line(line, attrs, fields, field_name_map))
+        return rewriter
+
+    def test_same_output_for_all_templates(self):
+        input_dir = os.path.join(get_root_dir(), 'logicaltests', 'generate', 'input', 'calcs')
+        lines = ['<test name="[int0] $Calcs$">\n', '$Staples$Calcs$ $Calcs$Staples$ [[int0]] [Int0] [int0][int0]\n']
+        for name in sorted(os.listdir(input_dir))[0:10]:
+            with open(os.path.join(input_dir, name), 'r', encoding='utf-8') as f:
+                lines.extend(f.readlines())
+        for attrs in gentests.template_attributes.values():
+            rewriter = self.assert_same_as_get_modified_line(attrs, lines)
+            self.assertIsNotNone(rewriter.resolved_names)
+
+    def test_chained_renames(self):
+        fields = ['[a]', '[b]', '[a]', '[c]']
+        field_name_map = {'[a]': '[b]', '[b]': '[c]', '[c]': '[a]'}
+        lines = ['[a] [b] [c] [[a]] [a][b]c] $Calcs$\n']
+        rewriter = self.assert_same_as_get_modified_line({'tablename': '$dsName'}, lines, fields, field_name_map)
+        self.assertEqual(rewriter.resolved_names, {'[a]': '[a]', '[b]': '[a]', '[c]': '[a]'})
+
+    def test_fallback_for_unbracketed_names(self):
+        field_name_map = {'[a]': 'a]', '[b]': '[b]'}
+        lines = ['[a] [[a]b] [b]\n']
+        rewriter = self.assert_same_as_get_modified_line({'tablename': '$dsName'}, lines, ['[a]', '[b]'],
+                                                         field_name_map)
+        self.assertIsNone(rewriter.resolved_names)
+
+
 class Do_WorkFunctionTest(unittest.TestCase):
     def setUp(self):
         error_message = 'Mock RunTime Error'
@@ -1412,6 +2243,655 @@ class ToleranceTest(unittest.TestCase):
         )
 
 
+@unittest.skipIf(sys.platform.startswith('win'), "The stand-in tabquery is a python script.")
+class TabqueryWorkerTest(unittest.TestCase):
+    def setUp(self):
+        worker_dir = os.path.join(TEST_DIRECTORY, 'tabquery_worker')
+        self.standin = os.path.join(worker_dir, 'tabquery_standin.py')
+        self.standin_no_worker = os.path.join(worker_dir, 'tabquery_standin_no_worker.py')
+
+    def tearDown(self):
+        shutdown_tabquery_workers()
+
+    def test_worker_reuses_process(self):
+        worker = TabqueryWorker([self.standin])
+        first = worker.run_batch(['--expression-file-list', 'a.txt'], 10)
+        second = worker.run_batch(['--expression-file-list', 'b.txt'], 10)
+        self.assertIn('args=--expression-file-list a.txt', first)
+        self.assertIn('args=--expression-file-list b.txt', second)
+        self.assertEqual(first.split(' ')[0], second.split(' ')[0])
+        worker.stop()
+
+    def test_worker_error_return_code(self):
+        worker = TabqueryWorker([self.standin])
+        with self.assertRaises(subprocess.CalledProcessError) as context:
+            worker.run_batch(['--fail'], 10)
+        self.assertEqual(context.exception.returncode, 3)
+        self.assertTrue(worker.is_running())
+        worker.stop()
+
+    def test_worker_timeout_restarts_process(self):
+        worker = TabqueryWorker([self.standin])
+        with self.assertRaises(subprocess.TimeoutExpired):
+            worker.run_batch(['--sleep', '5'], 0.5)
+        self.assertFalse(worker.is_running())
+        self.assertIn('args=again', worker.run_batch(['again'], 10))
+        worker.stop()
+
+    def test_worker_timeout_covers_whole_batch(self):
+        worker = TabqueryWorker([self.standin])
+        with self.assertRaises(subprocess.TimeoutExpired):
+            worker.run_batch(['--chatty', '5'], 0.5)
+        self.assertFalse(worker.is_running())
+        worker.stop()
+
+    def test_unsupported_worker(self):
+        worker = TabqueryWorker([self.standin_no_worker])
+        self.assertRaises(TabqueryWorkerUnsupported, worker.start, 10)
+
+    def test_run_batch_reuses_worker(self):
+        first = run_tabquery_batch([self.standin, 'one'], 10)
+        with self.assertRaises(subprocess.CalledProcessError):
+            run_tabquery_batch([self.standin, '--fail'], 10)
+        second = run_tabquery_batch([self.standin, 'two'], 10)
+        self.assertEqual(first.split(' ')[0], second.split(' ')[0])
+
+    def test_worker_shared_by_threads(self):
+        outputs = []
+        for name in ['one', 'two', 'three']:
+            thread = threading.Thread(target=lambda: outputs.append(run_tabquery_batch([self.standin, name], 10)))
+            thread.start()
+            thread.join()
+        self.assertEqual(len(set(output.split(' ')[0] for output in outputs)), 1)
+        self.assertEqual(len(tabquery_worker._all_workers), 1)
+
+    def test_run_batch_falls_back_to_process(self):
+        first = run_tabquery_batch([self.standin_no_worker, 'one'], 10)
+        second = run_tabquery_batch([self.standin_no_worker, 'two'], 10)
+        self.assertIn('args=one', first)
+        self.assertIn('args=two', second)
+        self.assertNotEqual(first.split(' ')[0], second.split(' ')[0])
+
+    def test_batch_queue_work_persistent(self):
+        test_config = TdvtInvocation()
+        test_config.persistent_tabquery = True
+        test_set = ExpressionTestSet('', TEST_DIRECTORY, 'mytest', 'mytds.tds', '', 'some/test/file.txt', '')
+        work = tdvt_core.BatchQueueWork(test_config, test_set)
+        work.run_process([self.standin, '--expression-file-list', 'tests.txt'])
+        self.assertIn('args=--expression-file-list tests.txt', work.cmd_output)
+
+
+class MockTimedRunner(object):
+    def __init__(self, name, run_time=None, test_is_skipped=False):
+        self.name = name
+        self.run_time = run_time
+        self.test_set = ExpressionTestSet('', '', name, '', '', '', '', test_is_skipped=test_is_skipped)
+
+    def get_timing_key(self):
+        return get_test_set_key('suite', self.name)
+
+
+class SchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = make_temp_dir(['scheduler'])
+        self.timings_path = os.path.join(self.temp_dir, 'timings.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_longest_first(self):
+        timings = TestSetTimings(self.timings_path)
+        timings.record(get_test_set_key('suite', 'short'), 1)
+        timings.record(get_test_set_key('suite', 'long'), 100)
+        timings.record(get_test_set_key('suite', 'medium'), 10)
+        runners = [MockTimedRunner(name) for name in ['short', 'new1', 'long', 'medium', 'new2']]
+        ordered = order_by_expected_runtime(runners, timings)
+        self.assertEqual([r.name for r in ordered], ['new1', 'new2', 'long', 'medium', 'short'])
+
+    def test_record_and_reload(self):
+        timings = TestSetTimings.load(self.timings_path)
+        record_runtimes([MockTimedRunner('ran', 12.5), MockTimedRunner('skipped', 0.1, True),
+                         MockTimedRunner('not_run')], timings)
+        timings.save()
+
+        reloaded = TestSetTimings.load(self.timings_path)
+        self.assertEqual(reloaded.get(get_test_set_key('suite', 'ran')), 12.5)
+        self.assertIsNone(reloaded.get(get_test_set_key('suite', 'skipped')))
+        self.assertIsNone(reloaded.get(get_test_set_key('suite', 'not_run')))
+
+    def test_load_bad_file(self):
+        with open(self.timings_path, 'w') as timings_file:
+            timings_file.write('not json')
+        self.assertEqual(TestSetTimings.load(self.timings_path).timings, {})
+
+    def test_output_order_is_enqueue_order(self):
+        tests = []
+        for name in ['short', 'long', 'longest']:
+            test_config = TdvtInvocation()
+            test_config.suite_name = 'suite'
+            test_config.config_file = name
+            tests.append((ExpressionTestSet('mydb', '', name, 'mydb.tds', '', '', ''), test_config))
+        timings = TestSetTimings(self.timings_path)
+        timings.record(get_test_set_key('suite', 'short'), 1)
+        timings.record(get_test_set_key('suite', 'long'), 10)
+        timings.record(get_test_set_key('suite', 'longest'), 100)
+        args = types.SimpleNamespace(command='run', smoke_test=False, force_run=False, verbose=False,
+                                     tds_thread_count=0)
+        queued = []
+
+        def test_runner(all_tests, test_queue, max_threads):
+            queued.extend(all_tests)
+            raise KeyboardInterrupt()
+
+        with mock.patch('tdvt.tdvt.TestSetTimings.load', return_value=timings), \
+                mock.patch('tdvt.tdvt.test_runner', side_effect=test_runner), \
+                mock.patch('sys.stdout', new_callable=io.StringIO):
+            self.assertRaises(KeyboardInterrupt, tdvt_main.run_tests_impl, tests, 2, args)
+        for runner in queued:
+            shutil.rmtree(runner.temp_dir, ignore_errors=True)
+        self.assertEqual([runner.test_config.config_file for runner in queued], ['longest', 'long', 'short'])
+        self.assertEqual([runner.output_index for runner in queued], [2, 1, 0])
+
+
+class ShardTest(unittest.TestCase):
+    def test_split_test_list(self):
+        tests = list(range(10))
+        self.assertEqual(tdvt_core.split_test_list(tests, 1, 1), [tests])
+        self.assertEqual(tdvt_core.split_test_list(tests, 4, 5), [[0, 2, 4, 6, 8], [1, 3, 5, 7, 9]])
+        self.assertEqual(tdvt_core.split_test_list(tests, 3, 1), [[0, 3, 6, 9], [1, 4, 7], [2, 5, 8]])
+        self.assertEqual(tdvt_core.split_test_list(tests, 4, 20), [tests])
+
+    @unittest.skipIf(sys.platform.startswith('win'), "The stand-in tabquery is a python script.")
+    def test_sharded_run(self):
+        standin = os.path.join(TEST_DIRECTORY, 'tabquery_worker', 'tabquery_standin_no_worker.py')
+        rt = RunTimeTestConfig()
+        rt.set_tabquery_paths(standin, standin, standin, standin)
+        test_config = TdvtInvocation()
+        test_config.set_run_time_test_config(rt)
+        test_config.shard_count = 2
+        test_config.output_dir = make_temp_dir(['shard_test'])
+        test_set = ExpressionTestSet('', ROOT_DIRECTORY, 'expression.shard', 'cast_calcs.tde.tds', '',
+                                     'tool_test/exprtests/setup.*.txt', '')
+        try:
+            with mock.patch.object(tdvt_core, 'SHARD_MIN_TESTS', 1):
+                all_test_results = tdvt_core.run_tests_impl(test_set, test_config)
+
+            test_paths = [t.test_path for t in test_set.generate_test_file_list()]
+            self.assertEqual(len(test_paths), 2)
+            self.assertEqual(list(all_test_results.keys()), test_paths)
+            for shard_id, test_path in enumerate(test_paths):
+                shard_tests = os.path.join(test_config.output_dir, 'shard_' + str(shard_id), 'expression_shard',
+                                           'tests.txt')
+                with open(shard_tests) as shard_tests_file:
+                    self.assertEqual(shard_tests_file.read(), test_path + '\n')
+        finally:
+            shutil.rmtree(test_config.output_dir)
+
+
+    @unittest.skipIf(sys.platform.startswith('win'), "The stand-in tabquery is a python script.")
+    def test_shards_share_the_queue(self):
+        standin = os.path.join(TEST_DIRECTORY, 'tabquery_worker', 'tabquery_standin_no_worker.py')
+        rt = RunTimeTestConfig()
+        rt.set_tabquery_paths(standin, standin, standin, standin)
+        output_dir = make_temp_dir(['shard_queue_test'])
+        test_config = TdvtInvocation()
+        test_config.set_run_time_test_config(rt)
+        test_config.shard_count = 2
+        test_config.suite_name = 'mydb'
+        test_config.config_file = 'expression.shard'
+        test_config.tds = 'cast_calcs.tde.tds'
+        test_config.custom_output_dir = output_dir
+        test_set = ExpressionTestSet('mydb', ROOT_DIRECTORY, 'expression.shard', 'cast_calcs.tde.tds', '',
+                                     'tool_test/exprtests/setup.*.txt', '')
+        register_tdvt_dialect()
+        runner = TestRunner(test_set, test_config, threading.Lock(), False, 1)
+        # One test set of the datasource at a time, so the shards have to wait for each other on the two threads.
+        scheduler = TestSetScheduler({'mydb': 1})
+        scheduler.put(runner)
+        running = []
+        max_running = []
+        real_run_test_shard = tdvt_main.run_test_shard
+
+        def run_test_shard(*args):
+            running.append(args[2])
+            max_running.append(len(running))
+            try:
+                return real_run_test_shard(*args)
+            finally:
+                running.remove(args[2])
+
+        try:
+            with mock.patch.object(tdvt_core, 'SHARD_MIN_TESTS', 1), \
+                    mock.patch('tdvt.tdvt.run_test_shard', side_effect=run_test_shard) as shard_mock:
+                counts = tdvt_main.test_runner([runner], scheduler, 2)
+            self.assertEqual(shard_mock.call_count, 2)
+            self.assertEqual(max(max_running), 1)
+            self.assertEqual(counts[3], 2)
+            self.assertIsNotNone(runner.run_time)
+            with open(os.path.join(output_dir, TestOutputFiles.output_json), 'r', encoding='utf8') as output_json:
+                results = json.load(output_json)
+            test_paths = [t.test_path for t in test_set.generate_test_file_list()]
+            self.assertEqual(len(results['successful_tests']) + len(results['failed_tests']), len(test_paths))
+        finally:
+            TestOutputFiles.written_csv = None
+            shutil.rmtree(output_dir)
+
+
+class MockStreamingBatchQueueWork(MockBatchQueueWork):
+    """Keeps 'running' until the result file was compared, like a long tabquery batch would."""
+    def run_process(self, cmdline):
+        self.process_thread = threading.current_thread()
+        self.compared_while_running = False
+        for i in range(100):
+            if self.results:
+                self.compared_while_running = True
+                break
+            time.sleep(0.05)
+        self.cmd_output = 'mock output'
+
+
+class StreamResultsTest(unittest.TestCase):
+    def test_result_compared_while_running(self):
+        test_name = 'setup.mytest.txt'
+        test_path = './tests/e/suite1/'
+        mock_tests = [TestFile('tests', test_path + test_name)]
+        test_config = TdvtInvocation()
+        test_config.stream_results = True
+        test_set = MockTestSet(test_path, test_name, 'mock ds', 'tests', 'mock config', 'mock.tds', '', 'tests/*.txt',
+                               False, 'mock suite expression', '', '')
+        mock_batch = MockStreamingBatchQueueWork(mock_tests, test_config, test_set)
+        mock_batch.run(mock_tests)
+        mock_batch.process_test_results(mock_tests)
+
+        self.assertTrue(mock_batch.compared_while_running)
+        # Tabquery runs on the test set thread, only the comparisons are moved to another thread.
+        self.assertIs(mock_batch.process_thread, threading.current_thread())
+        self.assertEqual(len(mock_batch.results), 1)
+        for test_file in mock_batch.results:
+            self.assertTrue(mock_batch.results[test_file].all_passed())
+            self.assertEqual(mock_batch.results[test_file].cmd_output, 'mock output')
+
+    def test_streamed_process_error(self):
+        test_config = TdvtInvocation()
+        test_config.stream_results = True
+        mock_tests = [TestFile('tests', './tests/e/suite1/missing_actual_1/setup.mytest.txt')]
+        test_set = MockTestSet('./tests/e/suite1/missing_actual_1/', 'setup.mytest.txt', 'mock ds', 'tests',
+                               'mock config', 'mock.tds', '', 'tests/*.txt', False, 'mock suite expression', '', '')
+        mock_batch = MockBatchQueueWork(mock_tests, test_config, test_set, subprocess.TimeoutExpired('test', 1))
+        mock_batch.run(mock_tests)
+        mock_batch.process_test_results(mock_tests)
+        self.assertIsInstance(mock_batch.error_state, TestErrorTimeout)
+        for test_file in mock_batch.results:
+            self.assertIsInstance(mock_batch.results[test_file].error_status, TestErrorTimeout)
+
+    def test_result_file_watcher(self):
+        temp_dir = make_temp_dir(['watcher'])
+        try:
+            path = os.path.join(temp_dir, 'actual.setup.test.txt')
+            watcher = tdvt_core.ResultFileWatcher()
+            self.assertEqual(watcher.get_finished_files([path]), set())
+            with open(path, 'w') as result_file:
+                result_file.write('<results>\n  <test name=\'a\'>\n')
+            self.assertEqual(watcher.get_finished_files([path]), set())
+            self.assertEqual(watcher.get_finished_files([path]), set())
+            with open(path, 'a') as result_file:
+                result_file.write('  </test>\n</results>\n')
+            self.assertEqual(watcher.get_finished_files([path]), set())
+            self.assertEqual(watcher.get_finished_files([path]), {path})
+        finally:
+            shutil.rmtree(temp_dir)
+
+
+class ResultFileParseTest(unittest.TestCase):
+    def load_results(self, path, test_config, from_file):
+        result = TestResult(test_config=test_config)
+        if from_file:
+            result.add_test_results_from_file(path, path)
+        else:
+            result.add_test_results(parse(path).getroot(), path)
+        return result
+
+    def test_file_parse_matches_tree_parse(self):
+        diff_dir = os.path.join(TEST_DIRECTORY, 'diff_tests')
+        for item in sorted(os.listdir(diff_dir)):
+            if not item.startswith('expected.'):
+                continue
+            expected_file = os.path.join(diff_dir, item)
+            actual_file = os.path.join(diff_dir, item.replace('expected', 'actual', 1))
+            test_config = TdvtInvocation()
+            test_config.tested_sql = True
+            test_config.tested_tuples = True
+            test_config.tested_error = True
+
+            diffs = []
+            for from_file in (False, True):
+                actual = self.load_results(actual_file, test_config, from_file)
+                expected = self.load_results(expected_file, test_config, from_file)
+                self.assertEqual(actual.path_to_actual, actual_file)
+                diff_counts, diff = actual.diff_test_results(expected)
+                diffs.append((diff_counts, str(diff), [tc.get_tuples() for tc in actual.test_case_map],
+                              [tc.id for tc in actual.test_case_map]))
+            self.assertEqual(diffs[0], diffs[1], item)
+
+    def test_tuple_values_and_ids(self):
+        temp_dir = make_temp_dir(['result_parse'])
+        try:
+            path = os.path.join(temp_dir, 'actual.setup.test.txt')
+            with open(path, 'w') as result_file:
+                result_file.write(
+                    "<results>\n"
+                    "  <comment>not a test</comment>\n"
+                    "  <test name='a'>\n"
+                    "    <sql>select 1</sql>\n"
+                    "    <table>\n"
+                    "      <schema><column return-type='integer'>x</column><column>y</column></schema>\n"
+                    "      <tuple><value>1</value><value>2</value></tuple>\n"
+                    "      <tuple><value>3</value><value>4</value></tuple>\n"
+                    "    </table>\n"
+                    "    <table><tuple><value>ignored</value></tuple></table>\n"
+                    "  </test>\n"
+                    "  <test name='b'>\n"
+                    "    <error>failed</error>\n"
+                    "    <error-type> Other </error-type>\n"
+                    "  </test>\n"
+                    "</results>\n")
+            result = self.load_results(path, TdvtInvocation(), True)
+            self.assertEqual(result.get_test_case_count(), 2)
+            first = result.get_test_case(0)
+            self.assertEqual(first.id, '1')
+            self.assertEqual(first.sql, 'select 1')
+            self.assertEqual(first.get_tuples(), ['1', '2', '3', '4'])
+            self.assertEqual(first.table.tuple_count, 2)
+            self.assertEqual(first.table.column_types, ['integer', None])
+            second = result.get_test_case(1)
+            self.assertEqual(second.id, '2')
+            self.assertIsNone(second.table)
+            self.assertEqual(second.error_message, 'failed')
+            self.assertEqual(second.error_type, 'Other')
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_parse_error_keeps_placeholders(self):
+        temp_dir = make_temp_dir(['result_parse_error'])
+        try:
+            path = os.path.join(temp_dir, 'actual.setup.test.txt')
+            with open(path, 'w') as result_file:
+                result_file.write("<results>\n  <test name='a'><sql>select 1</sql></test>\n  <test name=")
+            result = TestResult(test_config=TdvtInvocation())
+            with self.assertRaises(ParseError):
+                result.add_test_results_from_file(path, path)
+            self.assertEqual(result.get_test_case_count(), 0)
+            self.assertEqual(result.path_to_actual, '')
+        finally:
+            shutil.rmtree(temp_dir)
+
+
+class ExpectedCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = make_temp_dir(['expected_cache'])
+        self.expected_file = os.path.join(self.temp_dir, 'expected.setup.test.txt')
+        shutil.copy(os.path.join(TEST_DIRECTORY, 'diff_tests', 'expected.tuples.match.txt'), self.expected_file)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_cache_hit_and_invalidation(self):
+        cache = ExpectedResultsCache()
+        first = cache.get(self.expected_file)
+        self.assertIs(cache.get(self.expected_file), first)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+        with open(self.expected_file, 'a') as expected:
+            expected.write('\n')
+        second = cache.get(self.expected_file)
+        self.assertIsNot(second, first)
+        self.assertEqual([case.name for case in second], [case.name for case in first])
+        self.assertEqual(cache.misses, 2)
+
+    def test_lru_limit(self):
+        other_file = os.path.join(self.temp_dir, 'expected.setup.other.txt')
+        shutil.copy(self.expected_file, other_file)
+        cost = get_cost(read_results_file(self.expected_file))
+        cache = ExpectedResultsCache(max_values=cost * 2 - 1)
+        cache.get(self.expected_file)
+        cache.get(other_file)
+        self.assertEqual(len(cache.entries), 1)
+        self.assertEqual(cache.total_cost, cost)
+        cache.get(other_file)
+        self.assertEqual(cache.hits, 1)
+
+    def test_disk_cache(self):
+        cache_dir = os.path.join(self.temp_dir, 'cache')
+        parsed = ExpectedResultsCache(cache_dir=cache_dir).get(self.expected_file, use_disk_cache=True)
+        self.assertEqual(len(os.listdir(cache_dir)), 1)
+
+        with mock.patch('tdvt.expected_cache.read_results_file', side_effect=AssertionError('parsed the file')):
+            cached = ExpectedResultsCache(cache_dir=cache_dir).get(self.expected_file, use_disk_cache=True)
+        def fields(case):
+            table = case.table
+            return ([getattr(case, name) for name in ParsedTestCase.__slots__ if name != 'table'] +
+                    ([table.values, table.tuple_count, table.column_types, table.digest] if table else [None]))
+
+        self.assertEqual([fields(c) for c in cached], [fields(c) for c in parsed])
+        self.assertTrue(any(c.table is not None and c.table.digest for c in cached))
+
+        # A changed file isn't read from the disk cache.
+        with open(self.expected_file, 'a') as expected:
+            expected.write('\n')
+        with mock.patch('tdvt.expected_cache.read_results_file', return_value=[]) as read_file:
+            ExpectedResultsCache(cache_dir=cache_dir).get(self.expected_file, use_disk_cache=True)
+            read_file.assert_called_once()
+
+
+    def test_unreadable_disk_cache_ignored(self):
+        cache_dir = os.path.join(self.temp_dir, 'cache')
+        ExpectedResultsCache(cache_dir=cache_dir).get(self.expected_file, use_disk_cache=True)
+        cache_file = os.path.join(cache_dir, os.listdir(cache_dir)[0])
+        for content in [b'\x80\x04not json', b'{"version": 3, "key": [], "test_cases": []}', b'[1, 2]']:
+            with open(cache_file, 'wb') as f:
+                f.write(content)
+            cached = ExpectedResultsCache(cache_dir=cache_dir).get(self.expected_file, use_disk_cache=True)
+            self.assertEqual(len(cached), len(read_results_file(self.expected_file)))
+
+
+class TupleDigestTest(unittest.TestCase):
+    def make_case(self, values, column_types=None, tolerance=None):
+        table = ResultTable(list(values), len(values), column_types or ['str'])
+        return TestCaseResult('case', '0', '', 0, '', '', table, TdvtInvocation(), None, tolerance)
+
+    def test_digest(self):
+        self.assertEqual(ResultTable(['a', 'b']).get_digest(), ResultTable(['a', 'b']).get_digest())
+        self.assertNotEqual(ResultTable(['a', 'b']).get_digest(), ResultTable(['b', 'a']).get_digest())
+        self.assertNotEqual(ResultTable(['ab']).get_digest(), ResultTable(['a', 'b']).get_digest())
+        self.assertNotEqual(ResultTable(['']).get_digest(), ResultTable([None]).get_digest())
+        self.assertNotEqual(ResultTable([]).get_digest(), ResultTable(['']).get_digest())
+
+    def test_identical_values_skip_value_comparison(self):
+        result = TestResult()
+        values = ['"{}"'.format(i) for i in range(1000)]
+        with mock.patch.object(TestResult, 'actual_expected_comparison') as compare:
+            diff, diff_string = result.diff_table_node(self.make_case(values), self.make_case(values), ResultDiff(),
+                                                       'case')
+            compare.assert_not_called()
+        self.assertEqual(diff, 0)
+        self.assertEqual(str(diff_string), "\nTuples - case\n")
+
+        diff, diff_string = result.diff_table_node(self.make_case(values), self.make_case(values[:-1] + ['x']),
+                                                   ResultDiff(), 'case')
+        self.assertEqual(diff, 1)
+        self.assertIn("\texpected: x\n", str(diff_string))
+
+    def test_loose_float_comparison_still_compares_values(self):
+        test_config = TdvtInvocation()
+        test_config.loose_comparison = True
+        result = TestResult(test_config=test_config)
+        actual = self.make_case(['nan', '1.0'], ['float'], '0.01')
+        expected = self.make_case(['nan', '1.0'], ['float'], '0.01')
+        diff, diff_string = result.diff_table_node(actual, expected, ResultDiff(), 'case')
+        self.assertEqual(diff, 1)
+
+
+class ExpectedMatchIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = make_temp_dir(['expected_match_index'])
+        self.test_path = self.temp_dir + '/'
+        suite_dir = os.path.join('tests', 'e', 'suite1')
+        shutil.copy(os.path.join(suite_dir, 'setup.mytest.txt'), self.temp_dir)
+        actual = os.path.join(suite_dir, 'tuple_1', 'actual.setup.mytest.txt')
+        shutil.copy(actual, self.temp_dir)
+        # Two expected files with one wrong value, then one that matches.
+        wrong_expected = os.path.join(suite_dir, 'expected.setup.mytest.txt')
+        shutil.copy(wrong_expected, os.path.join(self.temp_dir, 'expected.setup.mytest.txt'))
+        shutil.copy(wrong_expected, os.path.join(self.temp_dir, 'expected.setup.mytest.1.txt'))
+        shutil.copy(actual, os.path.join(self.temp_dir, 'expected.setup.mytest.2.txt'))
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def run_compare(self, match_index):
+        test_name = 'setup.mytest.txt'
+        mock_tests = [TestFile('tests', self.test_path + test_name)]
+        test_set = MockTestSet(self.test_path, test_name, 'mock ds', 'tests', 'mock config', 'mock.tds', '',
+                               'tests/*.txt', False, 'mock suite expression', '', '')
+        mock_batch = MockBatchQueueWork(mock_tests, TdvtInvocation(), test_set)
+        loaded = []
+
+        def load_expected(path, use_disk_cache=False):
+            loaded.append(os.path.basename(path))
+            return read_results_file(path)
+
+        with mock.patch('tdvt.tdvt_core.get_expected_match_index', return_value=match_index), \
+                mock.patch('tdvt.tdvt_core.load_expected_results', side_effect=load_expected):
+            mock_batch.run(mock_tests)
+            mock_batch.process_test_results(mock_tests)
+        result = list(mock_batch.results.values())[0]
+        return result, loaded
+
+    def test_last_match_is_tried_first(self):
+        match_index = ExpectedMatchIndex(os.path.join(self.temp_dir, 'cache', 'matches.json'))
+        result, loaded = self.run_compare(match_index)
+        self.assertTrue(result.all_passed())
+        self.assertEqual(result.matched_expected_version, 2)
+        self.assertEqual(len(loaded), 3)
+
+        match_index.save()
+        match_index = ExpectedMatchIndex.load(match_index.path)
+        result, loaded = self.run_compare(match_index)
+        self.assertTrue(result.all_passed())
+        self.assertEqual(result.matched_expected_version, 2)
+        self.assertEqual(loaded, ['expected.setup.mytest.2.txt'])
+
+    def test_failure_reports_lowest_best_version(self):
+        os.remove(os.path.join(self.temp_dir, 'expected.setup.mytest.2.txt'))
+        match_index = ExpectedMatchIndex()
+        match_index.record('', self.test_path + 'setup.mytest.txt', 1)
+        result, loaded = self.run_compare(match_index)
+        self.assertFalse(result.all_passed())
+        self.assertEqual(loaded, ['expected.setup.mytest.1.txt', 'expected.setup.mytest.txt'])
+        self.assertEqual(result.matched_expected_version, 0)
+        self.assertEqual(result.diff_count, 1)
+        with open(os.path.join(self.temp_dir, 'actual.setup.mytest_diff.txt')) as diff_file:
+            self.assertIn('expected.setup.mytest.txt', diff_file.read())
+
+    def test_order_expected_files(self):
+        match_index = ExpectedMatchIndex()
+        files = ['a', 'a.1', 'a.2']
+        self.assertEqual(match_index.order_expected_files('ds', 'test', files), [(0, 'a'), (1, 'a.1'), (2, 'a.2')])
+        match_index.record('ds', 'test', 2)
+        self.assertEqual(match_index.order_expected_files('ds', 'test', files), [(2, 'a.2'), (0, 'a'), (1, 'a.1')])
+        self.assertEqual(match_index.order_expected_files('ds', 'test', files[:2]), [(0, 'a'), (1, 'a.1')])
+        self.assertEqual(match_index.order_expected_files('other ds', 'test', files)[0], (0, 'a'))
+
+
+class ResultDiffTest(unittest.TestCase):
+    def make_case(self, name, values, sql='select 1'):
+        table = ResultTable(list(values), len(values), ['str'])
+        return TestCaseResult(name, '0', sql, 0, '', '', table, TdvtInvocation(), None)
+
+    def test_diff_text(self):
+        test_config = TdvtInvocation()
+        test_config.tested_sql = True
+        actual = TestResult(test_config=test_config)
+        actual.test_case_map = [self.make_case('a', ['1', '2'], 'select a'), self.make_case('b', ['3'])]
+        expected = TestResult(test_config=test_config)
+        expected.test_case_map = [self.make_case('a', ['1', '5'], 'select a'), self.make_case('b', ['3', '4'], 'b')]
+
+        diff_counts, diff = actual.diff_test_results(expected)
+        self.assertEqual(diff_counts, [1, 1])
+        self.assertEqual(str(diff),
+                         "SQL\n"
+                         "\nTuples - a\n"
+                         "\t <<<< >>>> \n\tactual: 2\n\texpected: 5\n"
+                         "SQL\n<<<<\nselect 1\n>>>>\nb\n"
+                         "\nTuples - b\n"
+                         "\tDifferent number of tuples.\n")
+
+    def test_value_mismatch_cap(self):
+        diff = ResultDiff(max_value_mismatches=2)
+        diff.add_text("\nTuples - a\n")
+        for i in range(5):
+            diff.add_value_mismatch(str(i), 'x')
+        self.assertEqual(len(diff.records), 3)
+        self.assertEqual(str(diff),
+                         "\nTuples - a\n"
+                         "\t <<<< >>>> \n\tactual: 0\n\texpected: x\n"
+                         "\t <<<< >>>> \n\tactual: 1\n\texpected: x\n"
+                         "\t3 more mismatched values not shown.\n")
+
+        diff.replace_with_text('Error')
+        self.assertEqual(str(diff), 'Error')
+
+
+class FloatColumnComparisonTest(unittest.TestCase):
+    values = [('1.01', '1.05'), ('1.01', '1.25'), ('1', '1.0100000'), ('&quot;2.5&quot;', '"2.5"'), ('nan', 'nan'),
+              ('inf', 'inf'), ('inf', '-inf'), ('1e308', '-1e308'), ('0', '0.0'), ('0', '1e-300'),
+              ('%null%', '%null%'), ('1.00', '%null%'), ('%null%', '1.00'), ('abc', 'abc'), ('abc', 'abd')]
+
+    def expected_matches(self, tolerance):
+        tr = TestResult()
+        return [tr.actual_expected_comparison(a, e, tolerance, True, 'float') for a, e in self.values]
+
+    def check_matches(self, tolerance):
+        actual_values = [a for a, e in self.values]
+        expected_values = [e for a, e in self.values]
+        matches = compare_float_values(actual_values, expected_values, tolerance)
+        tr = TestResult()
+        resolved = [m if m is not None else tr.actual_expected_comparison(a, e, tolerance, True, 'float')
+                    for m, (a, e) in zip(matches, self.values)]
+        self.assertEqual(resolved, self.expected_matches(tolerance))
+        # Nulls and values that aren't numbers are left to actual_expected_comparison.
+        self.assertEqual([i for i, m in enumerate(matches) if m is None], [10, 11, 12, 13, 14])
+
+    def test_python_comparison(self):
+        with mock.patch('tdvt.test_results.numpy', None):
+            for tolerance in (0.05, 1e-9, 1.5):
+                self.check_matches(tolerance)
+
+    @unittest.skipIf(tdvt_test_results.numpy is None, "NumPy is not installed.")
+    def test_numpy_comparison(self):
+        for tolerance in (0.05, 1e-9, 1.5):
+            self.check_matches(tolerance)
+
+    def test_diff_table_node_float_columns(self):
+        test_config = TdvtInvocation()
+        test_config.loose_comparison = True
+        result = TestResult(test_config=test_config)
+        actual_values = ['a', '1.01', '"x"', 'b', '2.0', '%null%']
+        expected_values = ['a', '1.02', '"x"', 'c', '2.5', '%null%']
+        column_types = ['str', 'float', 'str']
+        actual = TestCaseResult('case', '0', '', 0, '', '', ResultTable(actual_values, 2, column_types),
+                                test_config, None)
+        expected = TestCaseResult('case', '0', '', 0, '', '', ResultTable(expected_values, 2, column_types),
+                                  test_config, None, '0.05')
+
+        with self.assertLogs(level='INFO') as logs:
+            diff, diff_string = result.diff_table_node(actual, expected, ResultDiff(), 'case')
+        self.assertEqual(diff, 2)
+        self.assertEqual(len([line for line in logs.output if 'Loose comparison' in line]), 1)
+        self.assertIn("\tactual: 2.0\n\texpected: 2.5\n", str(diff_string))
+        self.assertIn("\tactual: b\n\texpected: c\n", str(diff_string))
+
+
 ROOT_DIRECTORY = pkg_resources.resource_filename(__name__, '')
 TEST_DIRECTORY = pkg_resources.resource_filename(__name__, 'tool_test')
 print("Using root dir " + str(ROOT_DIRECTORY))
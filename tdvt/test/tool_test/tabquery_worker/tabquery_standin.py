@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+"""Stand-in for tabquerycli that implements the worker mode protocol. Used by the TDVT tests."""
+
+import json
+import os
+import sys
+import time
+
+
+def run_batch(args):
+    if '--sleep' in args:
+        time.sleep(float(args[args.index('--sleep') + 1]))
+    if '--chatty' in args:
+        # Keep logging for a while, like a slow batch that writes progress.
+        for _ in range(int(float(args[args.index('--chatty') + 1]) * 10)):
+            print('Still running.', flush=True)
+            time.sleep(0.1)
+    output = 'pid={} args={}'.format(os.getpid(), ' '.join(args))
+    return (3 if '--fail' in args else 0), output
+
+
+def main():
+    if sys.argv[1:] != ['--worker']:
+        returncode, output = run_batch(sys.argv[1:])
+        print(output)
+        sys.exit(returncode)
+
+    print(json.dumps({'ready': True, 'protocol': 1}), flush=True)
+    for line in sys.stdin:
+        args = json.loads(line)['args']
+        returncode, output = run_batch(args)
+        print('Some log line that is not part of the protocol.', flush=True)
+        print(json.dumps({'returncode': returncode, 'output': output}), flush=True)
+
+
+if __name__ == '__main__':
+    main()
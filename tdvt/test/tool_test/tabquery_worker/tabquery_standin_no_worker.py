@@ -0,0 +1,7 @@
+#!/usr/bin/env python3
+"""Stand-in for a tabquerycli that predates worker mode. Used by the TDVT tests."""
+
+import os
+import sys
+
+print('pid={} args={}'.format(os.getpid(), ' '.join(sys.argv[1:])))